@@ -1,12 +1,13 @@
 import React, { useState, useRef, useEffect, useCallback } from 'react';
 import './Grid.css';
 
-const ROWS = 100;
-const COLS = 26;
+export const ROWS = 100;
+export const COLS = 26;
 
 function Grid({
   cells,
   onCellChange,
+  onRangeChange,
   onUndo,
   onRedo,
   canUndo,
@@ -428,6 +429,16 @@ function Grid({
     }
   };
 
+  const handlePaste = (e) => {
+    if (editingCell || !onRangeChange || document.activeElement === formulaBarRef.current) return;
+    const text = e.clipboardData.getData('text/plain');
+    if (!text) return;
+    e.preventDefault();
+    // Таблица из буфера (строки через перевод строки, ячейки через табуляцию) - одним блоком
+    const values = text.replace(/\r\n/g, '\n').replace(/\n$/, '').split('\n').map(line => line.split('\t'));
+    onRangeChange(selectedCell.row, selectedCell.column, values);
+  };
+
   const handleKeyDown = (e) => {
     if (document.activeElement === formulaBarRef.current) return;
 
@@ -451,7 +462,14 @@ function Grid({
           }
         }
       };
-      if (selectionRange) {
+      if (selectionRange && onRangeChange) {
+        // Выделение очищается одним сообщением; стили ячеек сохраняются
+        const { start, end } = selectionRange;
+        const minRow = Math.min(start.row, end.row), maxRow = Math.max(start.row, end.row);
+        const minCol = Math.min(start.column, end.column), maxCol = Math.max(start.column, end.column);
+        const values = Array.from({ length: maxRow - minRow + 1 }, () => Array(maxCol - minCol + 1).fill(''));
+        onRangeChange(minRow, minCol, values);
+      } else if (selectionRange) {
         const { start, end } = selectionRange;
         applyClear(
           Math.min(start.row, end.row), Math.max(start.row, end.row),
@@ -566,6 +584,7 @@ function Grid({
         className="grid-container"
         ref={gridRef}
         onKeyDown={handleKeyDown}
+        onPaste={handlePaste}
         tabIndex={0}
         onClick={() => { setShowColorPicker(false); setShowFormulaMenu(false); }}
       >
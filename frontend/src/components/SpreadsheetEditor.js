@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useCallback, useRef } from 'react';
 import './SpreadsheetEditor.css';
 import SheetTabs from './SheetTabs';
-import Grid from './Grid';
+import Grid, { ROWS, COLS } from './Grid';
 import ShareDialog from './ShareDialog';
 import api from '../services/api';
 import wsService from '../services/websocket';
@@ -18,6 +18,9 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
   const [historyIndex, setHistoryIndex] = useState(-1);
   const historyRef = useRef({ history: [], index: -1 });
   
+  // Номер последнего изменения таблицы, с которым синхронизированы ячейки
+  const sequenceRef = useRef(null);
+  
   // Активные пользователи
   const [activeUsers, setActiveUsers] = useState([]);
   const [remoteCursors, setRemoteCursors] = useState({});
@@ -118,15 +121,22 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
     if (!currentSheet) return;
     
     try {
-      const data = await api.getCells(currentSheet.id);
-      // Обрабатываем случай, если API возвращает объект с пагинацией
-      const cellsList = Array.isArray(data) ? data : (data.results || []);
+      // Номер берем до загрузки ячеек, чтобы после переподключения догрузить все, что изменилось позже
+      const { sequence } = await api.getChanges(spreadsheet.id);
+      // Загружаем только ячейки, которые помещаются в сетку
+      const cellsList = await api.getCellWindow(currentSheet.id, {
+        startRow: 1,
+        endRow: ROWS,
+        startColumn: 1,
+        endColumn: COLS,
+      });
       const cellsMap = {};
       cellsList.forEach(cell => {
         const key = `${cell.row}_${cell.column}`;
         cellsMap[key] = cell;
       });
       setCells(cellsMap);
+      sequenceRef.current = sequence;
       
       // Сохраняем начальное состояние в историю
       saveToHistory(cellsMap);
@@ -134,7 +144,38 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
       console.error('Ошибка загрузки ячеек:', error);
       setCells({});
     }
-  }, [currentSheet, saveToHistory]);
+  }, [spreadsheet, currentSheet, saveToHistory]);
+
+  const syncChanges = useCallback(async () => {
+    // Догружаем только ячейки, измененные с последней синхронизации
+    if (!spreadsheet || !currentSheet || sequenceRef.current === null) return;
+    
+    try {
+      const changes = await api.getChanges(spreadsheet.id, sequenceRef.current);
+      if (changes.reload_sheets.includes(currentSheet.id)) {
+        // В листе сдвигались строки или колонки - перечитываем его целиком
+        await loadCells();
+        return;
+      }
+      setCells(prev => {
+        const newCells = { ...prev };
+        changes.cells.forEach(cell => {
+          if (cell.sheet_id === currentSheet.id && cell.row <= ROWS && cell.column <= COLS) {
+            newCells[`${cell.row}_${cell.column}`] = cell;
+          }
+        });
+        changes.deleted.forEach(cell => {
+          if (cell.sheet_id === currentSheet.id) {
+            delete newCells[`${cell.row}_${cell.column}`];
+          }
+        });
+        return newCells;
+      });
+      sequenceRef.current = changes.sequence;
+    } catch (error) {
+      console.error('Ошибка синхронизации изменений:', error);
+    }
+  }, [spreadsheet, currentSheet, loadCells]);
 
   useEffect(() => {
     if (spreadsheet) {
@@ -164,35 +205,104 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
     wsService.connect(spreadsheet.id, token);
 
     // Обработчики событий WebSocket
-    const handleCellUpdate = (data) => {
-      // Игнорируем собственные обновления
-      const currentUser = JSON.parse(localStorage.getItem('current_user') || '{}');
-      if (data.user_id && data.user_id === currentUser.id) return;
+    // После (пере)подключения догружаем изменения, пропущенные без соединения
+    const handleConnected = () => {
+      syncChanges();
+    };
 
-      // Проверяем, что обновление относится к текущему листу
-      if (data.sheet_id && currentSheet && data.sheet_id !== currentSheet.id) {
-        return;
+    const handleCellsUpdate = (data) => {
+      // Записанные ячейки (в том числе свои: значения формул вычислены сервером)
+      // приходят вместе с пересчитанными зависимыми - применяем ячейки текущего
+      // листа за одно обновление состояния
+      const updates = data.cells.filter(cell => cell.sheet_id === currentSheet.id);
+      if (updates.length === 0) return;
+
+      setCells(prev => {
+        const newCells = { ...prev };
+        updates.forEach(cell => {
+          newCells[`${cell.row}_${cell.column}`] = {
+            ...prev[`${cell.row}_${cell.column}`],
+            row: cell.row,
+            column: cell.column,
+            value: cell.value || '',
+            formula: cell.formula || '',
+            style: cell.style || {},
+          };
+        });
+        return newCells;
+      });
+    };
+
+    const handleRangeUpdate = (data) => {
+      // Записанный блок значений (в том числе свой: значения формул вычислены сервером)
+      if (data.sheet_id !== currentSheet.id) return;
+      setCells(prev => {
+        const newCells = { ...prev };
+        data.values.forEach((line, i) => {
+          line.forEach((value, j) => {
+            const row = data.start_row + i;
+            const column = data.start_column + j;
+            if (value === null || row > ROWS || column > COLS) return;
+            const key = `${row}_${column}`;
+            newCells[key] = {
+              ...prev[key],
+              row,
+              column,
+              value,
+              formula: data.formulas ? data.formulas[i][j] : '',
+            };
+          });
+        });
+        return newCells;
+      });
+    };
+
+    const reloadArea = async (startRow, startColumn, endRow, endColumn) => {
+      // Правка не записана сервером - возвращаем ячейкам сохраненное состояние
+      try {
+        const saved = await api.getCellWindow(currentSheet.id, { startRow, endRow, startColumn, endColumn });
+        setCells(prev => {
+          const newCells = { ...prev };
+          for (let row = startRow; row <= Math.min(endRow, ROWS); row++) {
+            for (let column = startColumn; column <= Math.min(endColumn, COLS); column++) {
+              delete newCells[`${row}_${column}`];
+            }
+          }
+          saved.forEach(cell => {
+            newCells[`${cell.row}_${cell.column}`] = cell;
+          });
+          return newCells;
+        });
+      } catch (error) {
+        console.error('Ошибка загрузки ячеек:', error);
       }
+    };
 
-      const key = `${data.row}_${data.column}`;
-      setCells(prev => ({
-        ...prev,
-        [key]: {
-          row: data.row,
-          column: data.column,
-          value: data.value || '',
-          formula: data.formula || '',
-          style: data.style || {},
-        }
-      }));
-      
-      // Если изменилось значение (не формула), перезагружаем все ячейки,
-      // чтобы обновить зависимые формулы
-      if (!data.formula && data.value) {
-        // Небольшая задержка, чтобы дать серверу время пересчитать зависимости
-        setTimeout(() => {
-          loadCells();
-        }, 200);
+    const handleCellRejected = (data) => {
+      console.error('Ячейка не записана:', data.error);
+      if (data.sheet_id === currentSheet.id && Number.isInteger(data.row) && Number.isInteger(data.column)) {
+        reloadArea(data.row, data.column, data.row, data.column);
+      }
+    };
+
+    const handleRangeRejected = (data) => {
+      console.error('Блок не записан:', data.error);
+      if (data.sheet_id === currentSheet.id) {
+        reloadArea(data.start_row, data.start_column, data.end_row, data.end_column);
+      }
+    };
+
+    const handleStructureChanged = (data) => {
+      // Вставка или удаление строк/колонок сдвигает ячейки - перечитываем лист
+      if (data.sheet_id === currentSheet.id) {
+        loadCells();
+      }
+    };
+
+    const handleRangeUpdated = (data) => {
+      // Копирование диапазона меняет много ячеек сразу - догружаем изменения одним запросом
+      if (data.sheet_id === currentSheet.id) {
+        syncChanges();
       }
     };
 
@@ -227,19 +337,31 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
       }));
     };
 
-    wsService.on('cell_update', handleCellUpdate);
+    wsService.on('connected', handleConnected);
+    wsService.on('cells_update', handleCellsUpdate);
+    wsService.on('sheet_structure_changed', handleStructureChanged);
+    wsService.on('range_updated', handleRangeUpdated);
+    wsService.on('range_update', handleRangeUpdate);
+    wsService.on('range_rejected', handleRangeRejected);
+    wsService.on('cell_rejected', handleCellRejected);
     wsService.on('user_joined', handleUserJoined);
     wsService.on('user_left', handleUserLeft);
     wsService.on('cursor_update', handleCursorUpdate);
 
     return () => {
-      wsService.off('cell_update', handleCellUpdate);
+      wsService.off('connected', handleConnected);
+      wsService.off('cells_update', handleCellsUpdate);
+      wsService.off('sheet_structure_changed', handleStructureChanged);
+      wsService.off('range_updated', handleRangeUpdated);
+      wsService.off('range_update', handleRangeUpdate);
+      wsService.off('range_rejected', handleRangeRejected);
+      wsService.off('cell_rejected', handleCellRejected);
       wsService.off('user_joined', handleUserJoined);
       wsService.off('user_left', handleUserLeft);
       wsService.off('cursor_update', handleCursorUpdate);
       wsService.disconnect();
     };
-  }, [spreadsheet, currentSheet, loadCells]);
+  }, [spreadsheet, currentSheet, loadCells, syncChanges]);
 
   const handleCellChange = async (row, column, value, formula = '', style = null) => {
     if (!currentSheet) return;
@@ -249,8 +371,11 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
       saveToHistory(cells);
     }
 
-    // Отправляем обновление через WebSocket
-    wsService.send({
+    const key = `${row}_${column}`;
+
+    // Правка отправляется через WebSocket; записанная ячейка (со значением
+    // формулы) и пересчитанные зависимые придут в cells_update, отказ - в cell_rejected
+    const sent = wsService.send({
       type: 'cell_update',
       sheet_id: currentSheet.id,
       row,
@@ -260,7 +385,23 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
       style: style || {},
     });
 
-    const key = `${row}_${column}`;
+    if (sent) {
+      setCells(prev => ({
+        ...prev,
+        [key]: {
+          ...prev[key],
+          row,
+          column,
+          value: formula ? (prev[key] || {}).value || '' : value,
+          formula,
+          style: style !== null ? style : (prev[key] || {}).style || {},
+        },
+      }));
+      return;
+    }
+
+    // Без соединения сохраняем через API; зависимые формулы догрузятся
+    // из журнала изменений после переподключения
     const updateData = {};
     
     // Если и value, и formula пустые, явно очищаем оба
@@ -279,27 +420,33 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
 
     try {
       const updatedCell = await api.updateCell(currentSheet.id, row, column, updateData);
-      setCells(prev => {
-        const newCells = {
-          ...prev,
-          [key]: updatedCell,
-        };
-        return newCells;
-      });
-      
-      // Если изменилось значение (не формула), перезагружаем все ячейки,
-      // чтобы обновить зависимые формулы
-      if (!formula && style === null) {
-        // Небольшая задержка, чтобы дать серверу время пересчитать зависимости
-        setTimeout(() => {
-          loadCells();
-        }, 100);
-      }
+      setCells(prev => ({
+        ...prev,
+        [key]: updatedCell,
+      }));
     } catch (error) {
       console.error('Ошибка обновления ячейки:', error);
     }
   };
 
+  const handleRangeChange = (startRow, startColumn, values) => {
+    if (!currentSheet) return;
+
+    if (historyRef.current.index === historyIndex) {
+      saveToHistory(cells);
+    }
+
+    // Блок (вставка, очистка выделения) отправляется одним сообщением,
+    // сервер рассылает записанные значения всем, включая нас
+    wsService.send({
+      type: 'range_update',
+      sheet_id: currentSheet.id,
+      start_row: startRow,
+      start_column: startColumn,
+      values,
+    });
+  };
+
   const handleAddSheet = async () => {
     try {
       const newSheet = await api.addSheet(spreadsheet.id, `Лист${sheets.length + 1}`);
@@ -417,6 +564,7 @@ function SpreadsheetEditor({ spreadsheet, onUpdate, onShareClick }) {
           <Grid
             cells={cells}
             onCellChange={handleCellChange}
+            onRangeChange={handleRangeChange}
             onUndo={undo}
             onRedo={redo}
             canUndo={historyIndex > 0}
@@ -92,9 +92,17 @@ const apiService = {
     return response.data;
   },
 
+  async getChanges(spreadsheetId, since = null) {
+    // Без since сервер возвращает только текущий номер изменения
+    const params = since === null ? {} : { since };
+    const response = await api.get(`/spreadsheets/${spreadsheetId}/changes/`, { params });
+    return response.data;
+  },
+
   // Sheets
   async getSheets(spreadsheetId) {
-    const response = await api.get(`/sheets/?spreadsheet_id=${spreadsheetId}`);
+    // Листы без ячеек: ячейки загружаются отдельно по видимой области
+    const response = await api.get(`/sheets/meta/?spreadsheet_id=${spreadsheetId}`);
     return response.data;
   },
 
@@ -118,6 +126,35 @@ const apiService = {
     return response.data;
   },
 
+  async getCellRange(sheetId, range, after = null, limit = 1000) {
+    const params = {
+      sheet_id: sheetId,
+      start_row: range.startRow,
+      end_row: range.endRow,
+      start_column: range.startColumn,
+      end_column: range.endColumn,
+      limit,
+    };
+    if (after) {
+      params.after_row = after.row;
+      params.after_column = after.column;
+    }
+    const response = await api.get('/cells/range/', { params });
+    return response.data;
+  },
+
+  async getCellWindow(sheetId, range) {
+    // Загружаем все страницы диапазона по ключу (row, column)
+    const cells = [];
+    let after = null;
+    do {
+      const page = await this.getCellRange(sheetId, range, after);
+      cells.push(...page.cells);
+      after = page.next;
+    } while (after);
+    return cells;
+  },
+
   async updateCell(sheetId, row, column, data) {
     const response = await api.post('/cells/', {
       sheet_id: sheetId,
@@ -27,6 +27,10 @@ class WebSocketService {
 
     this.ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      if (data.type === 'rate_limited') {
+        // Сервер отбросил часть сообщений, отправленных слишком часто
+        console.warn(data.error);
+      }
       this.emit(data.type, data);
     };
 
@@ -53,9 +57,12 @@ class WebSocketService {
   }
 
   send(data) {
+    // Возвращает false, если соединения нет и сообщение не отправлено
     if (this.ws && this.ws.readyState === WebSocket.OPEN) {
       this.ws.send(JSON.stringify(data));
+      return true;
     }
+    return false;
   }
 
   on(event, callback) {
@@ -0,0 +1,169 @@
+import math
+import threading
+import numpy as np
+from .formula_engine import format_result
+from .formula_parser import compile_formula, Call, Area, FormulaSyntaxError
+
+
+# Функции, результат которых можно обновлять по разнице значений
+INCREMENTAL_FUNCTIONS = ('SUM', 'COUNT', 'AVERAGE')
+
+# При большем числе изменений в диапазоне дешевле пересчитать его целиком
+MAX_DELTA_CHANGES = 64
+
+# После стольких инкрементальных обновлений состояние пересчитывается заново,
+# чтобы не накапливать погрешность округления
+MAX_DELTA_UPDATES = 1000
+
+# Маркер неизвестного предыдущего значения ячейки
+UNKNOWN = object()
+
+
+class AggregateState:
+    """Текущая сумма и количество чисел в диапазоне формулы вида =SUM(A1:A100000)"""
+
+    __slots__ = ('formula', 'sheet_id', 'bounds', 'function', 'total', 'count', 'value', 'updates')
+
+    def __init__(self, formula, sheet_id, bounds, function, total, count):
+        self.formula = formula
+        self.sheet_id = sheet_id
+        self.bounds = bounds
+        self.function = function
+        self.total = total
+        self.count = count
+        self.value = self.result()
+        self.updates = 0
+
+    def result(self):
+        if self.function == 'COUNT':
+            value = self.count
+        elif self.function == 'AVERAGE':
+            value = self.total / self.count if self.count else 0
+        else:
+            value = self.total if self.count else 0
+        return format_result(value)
+
+    def covers(self, sheet_id, row, column):
+        start_row, start_column, end_row, end_column = self.bounds
+        return (
+            sheet_id == self.sheet_id
+            and start_row <= row <= end_row
+            and start_column <= column <= end_column
+        )
+
+    def apply(self, old_value, new_value):
+        """Учитывает изменение одной ячейки диапазона; False - нужен полный пересчет"""
+        if old_value is UNKNOWN:
+            return False
+        for value, sign in ((old_value, -1), (new_value, 1)):
+            if isinstance(value, float):
+                if not math.isfinite(value):
+                    return False
+                self.total += sign * value
+                self.count += sign
+        self.updates += 1
+        return self.updates <= MAX_DELTA_UPDATES
+
+
+# cell_id -> AggregateState; состояние живет в памяти процесса
+_states = {}
+_states_lock = threading.Lock()
+
+
+def aggregate_shape(formula, compiled=None):
+    """
+    Возвращает (функция, Area), если формула - одна агрегатная функция над одним диапазоном.
+    compiled - уже скомпилированная формула (чтобы не разбирать ее повторно).
+    """
+    if compiled is None:
+        try:
+            compiled = compile_formula(formula.strip())
+        except FormulaSyntaxError:
+            return None
+    tree = compiled.tree
+    if (
+        isinstance(tree, Call)
+        and tree.name in INCREMENTAL_FUNCTIONS
+        and len(tree.args) == 1
+        and isinstance(tree.args[0], Area)
+    ):
+        return tree.name, tree.args[0]
+    return None
+
+
+def evaluate_aggregate(engine, cell, changes, compiled=None):
+    """
+    Вычисляет формулу ячейки вида =SUM(диапазон) с учетом сохраненного состояния.
+
+    Args:
+        engine: FormulaEngine с предзагруженными значениями
+        cell: ячейка с формулой (cell.value - последнее сохраненное значение)
+        changes: {(sheet_id, row, column): (старое значение, новое значение)} -
+            изменения ячеек с момента прошлого вычисления
+        compiled: уже скомпилированная формула ячейки (необязательно)
+
+    Если состояние есть и действительно, результат обновляется по разнице
+    значений измененных ячеек диапазона. Иначе диапазон суммируется целиком и
+    состояние создается заново. Возвращает None, если формула не подходит или
+    ее нужно вычислить обычным образом (например, чтобы получить текст ошибки).
+    """
+    shape = aggregate_shape(cell.formula, compiled)
+    if shape is None:
+        with _states_lock:
+            _states.pop(cell.id, None)
+        return None
+    function, area = shape
+
+    with _states_lock:
+        state = _states.get(cell.id)
+        if state is not None and _apply_changes(state, cell, changes):
+            return state.value
+        _states.pop(cell.id, None)
+
+    sheet = cell.sheet if area.sheet is None else engine.get_sheet_by_name(area.sheet)
+    if sheet is None:
+        return None
+    bounds = (area.start_row, area.start_column, area.end_row, area.end_column)
+    values = engine.read_range(sheet, *bounds).numeric()
+
+    total = float(np.add.accumulate(values)[-1]) if values.size else 0.0
+    state = AggregateState(cell.formula, sheet.id, bounds, function, total, int(values.size))
+    with _states_lock:
+        _states[cell.id] = state
+    return state.value
+
+
+def _apply_changes(state, cell, changes):
+    """Применяет изменения к состоянию; False, если состояние недействительно"""
+    if state.formula != cell.formula or state.value != cell.value:
+        return False
+
+    relevant = [
+        change for coordinate, change in changes.items()
+        if state.covers(*coordinate)
+    ]
+    if len(relevant) > MAX_DELTA_CHANGES:
+        return False
+    for old_value, new_value in relevant:
+        if not state.apply(old_value, new_value):
+            return False
+    state.value = state.result()
+    return True
+
+
+def forget_aggregate_states(cell_ids=None):
+    """Удаляет состояния агрегатов (всех или указанных ячеек)"""
+    with _states_lock:
+        if cell_ids is None:
+            _states.clear()
+        else:
+            for cell_id in cell_ids:
+                _states.pop(cell_id, None)
+
+
+def forget_sheet_aggregate_states(sheet_ids):
+    """Удаляет состояния агрегатов над диапазонами листов sheet_ids"""
+    sheet_ids = set(sheet_ids)
+    with _states_lock:
+        for cell_id in [cell_id for cell_id, state in _states.items() if state.sheet_id in sheet_ids]:
+            del _states[cell_id]
@@ -5,3 +5,7 @@ class SheetsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sheets'
 
+
+    def ready(self):
+        # Обработчики сигналов, поддерживающие таблицы в памяти (resident.py)
+        from . import resident  # noqa: F401
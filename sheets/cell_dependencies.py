@@ -1,91 +1,336 @@
-import re
-from .models import Cell
+import threading
+from collections import OrderedDict
+from django.db import transaction
+from .models import Cell, CellDependency, Sheet, awaits_commit
+from .formula_parser import compile_formula, FormulaSyntaxError
+from .interval_index import RectangleIndex
+
+
+# Индексы диапазонов в памяти процесса: sheet_id -> RectangleIndex прямоугольников,
+# которые читают формулы. Ключ прямоугольника - (sheet_id ячейки-формулы, cell_id).
+# Загружаются из CellDependency при первом обращении и дальше обновляются
+# инкрементально в update_cell_dependencies. Изменения в обход процесса
+# (команда import_csv) сбрасывают индексы таблицы в changes.check_caches.
+# Индексы листов выгружаются, когда таблица уходит из памяти (resident.release),
+# и сверх MAX_INDEXED_SHEETS - давно не использованные.
+_sheet_indexes = OrderedDict()
+_index_lock = threading.RLock()
+
+# Ключ -> id листов с загруженными индексами, в которых у ключа есть прямоугольники
+_key_sheets = {}
+
+# Сколько индексов листов держится в памяти процесса
+MAX_INDEXED_SHEETS = 256
+
+# Изменения индексов текущей транзакции потока (как записи в resident.py):
+# в общие индексы они переносятся после фиксации, до нее их видит только поток
+_local = threading.local()
+
+
+class _Pending:
+    """
+    Незафиксированные изменения индексов потока: ключи, чьи прямоугольники
+    удалены, добавленные прямоугольники по листам и листы, индекс которых
+    целиком построен внутри транзакции (общий индекс для них не читается,
+    а после фиксации сбрасывается).
+    """
+
+    __slots__ = ('removed', 'added', 'replaced', 'flush')
+
+    def __init__(self):
+        self.removed = set()
+        self.added = {}
+        self.replaced = set()
+        # Перенос в общие индексы, зарегистрированный в transaction.on_commit
+        self.flush = None
+
+    def __bool__(self):
+        return bool(self.removed or self.added or self.replaced)
+
+
+def _pending():
+    """
+    Незафиксированные изменения потока. Изменения, перенос которых больше не
+    ждет фиксации (транзакция откачена), сбрасываются.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None or (pending.flush is not None and not awaits_commit(pending.flush)):
+        pending = _local.pending = _Pending()
+    return pending
+
+
+def _pending_for_change():
+    """Изменения потока, перенос которых в общие индексы ждет фиксации транзакции"""
+    pending = _pending()
+    if pending.flush is None:
+        pending.flush = lambda: _apply_pending(pending)
+        transaction.on_commit(pending.flush)
+    return pending
+
+
+def _apply_pending(pending):
+    """Переносит зафиксированные изменения потока в общие индексы"""
+    if getattr(_local, 'pending', None) is pending:
+        _local.pending = None
+    with _index_lock:
+        for key in pending.removed:
+            for sheet_id in _key_sheets.pop(key, ()):
+                _sheet_indexes[sheet_id].remove(key)
+        for sheet_id, added in pending.added.items():
+            index = _sheet_indexes.get(sheet_id)
+            if index is None or sheet_id in pending.replaced:
+                continue
+            for key, rect in added.items():
+                index.add(key, *rect)
+                _key_sheets.setdefault(key, set()).add(sheet_id)
+        for sheet_id in pending.replaced:
+            _drop_index(sheet_id)
+
+
+def _store_index(sheet_id, index):
+    """Делает индекс листа общим; давно не использованные индексы сверх лимита выгружаются"""
+    _sheet_indexes[sheet_id] = index
+    for key in index.keys():
+        _key_sheets.setdefault(key, set()).add(sheet_id)
+    while len(_sheet_indexes) > MAX_INDEXED_SHEETS:
+        _drop_index(next(iter(_sheet_indexes)))
+
+
+def _drop_index(sheet_id):
+    index = _sheet_indexes.pop(sheet_id, None)
+    if index is None:
+        return
+    for key in index.keys():
+        sheet_ids = _key_sheets.get(key)
+        if sheet_ids is not None:
+            sheet_ids.discard(sheet_id)
+            if not sheet_ids:
+                del _key_sheets[key]
 
 
 def find_dependent_cells(sheet, row, column):
     """
-    Находит все ячейки с формулами, которые ссылаются на указанную ячейку.
+    Находит все ячейки с формулами, которые ссылаются на указанную ячейку,
+    в том числе формулы на других листах таблицы (Лист1!A1).
     Возвращает список ячеек, которые нужно пересчитать.
+
+    Поиск идет по индексу зависимостей, а не перебором формул листа.
+    """
+    cell_ids = find_dependent_cell_ids(sheet.id, row, column)
+    return list(Cell.objects.filter(id__in=cell_ids).select_related('sheet'))
+
+
+def find_dependent_cell_ids(sheet_id, row, column):
+    """Возвращает id ячеек (с любого листа), формулы которых ссылаются на ячейку листа sheet_id"""
+    pending = _pending()
+    keys = set()
+    if sheet_id not in pending.replaced:
+        with _index_lock:
+            index = _get_sheet_index(sheet_id, pending)
+            if index is not None:
+                keys = index.find(row, column)
+        if pending.removed:
+            keys -= pending.removed
+    added = pending.added.get(sheet_id)
+    if added is None and sheet_id in pending.replaced:
+        added = _thread_index(pending, sheet_id)
+    if added is not None:
+        keys |= added.find(row, column)
+    return {cell_id for cell_sheet_id, cell_id in keys}
+
+
+def _thread_index(pending, sheet_id):
+    """
+    Индекс незафиксированных прямоугольников потока на листе; для листа,
+    перестроенного в транзакции, - все его прямоугольники из БД
+    """
+    added = pending.added.get(sheet_id)
+    if added is None:
+        if sheet_id in pending.replaced:
+            added = _load_sheet_index(sheet_id)
+        else:
+            added = RectangleIndex()
+        pending.added[sheet_id] = added
+    return added
+
+
+def _get_sheet_index(sheet_id, pending):
     """
-    # Получаем ссылку на ячейку (например, A1, B2)
-    cell_ref = _get_cell_reference(row, column)
-    
-    # Находим все ячейки с формулами на этом листе
-    cells_with_formulas = Cell.objects.filter(
-        sheet=sheet,
-        formula__isnull=False
-    ).exclude(formula='')
-    
-    dependent_cells = []
-    
-    for cell in cells_with_formulas:
-        if _cell_depends_on(cell.formula, cell_ref, row, column):
-            dependent_cells.append(cell)
-    
-    return dependent_cells
-
-
-def _get_cell_reference(row, column):
-    """Преобразует координаты в ссылку на ячейку (A1, B2, etc.)"""
-    col_str = ''
-    col = column
-    while col > 0:
-        col -= 1
-        col_str = chr(65 + (col % 26)) + col_str
-        col = col // 26
-    return f"{col_str}{row}"
-
-
-def _cell_depends_on(formula, cell_ref, target_row, target_column):
-    """
-    Проверяет, зависит ли формула от указанной ячейки.
-    Учитывает прямые ссылки (A1) и ссылки в диапазонах (A1:A5).
+    Индекс прямоугольников листа; при первом обращении строится из CellDependency.
+    Если у потока есть незафиксированные изменения, построенный индекс уже
+    содержит их и становится индексом листа только для этой транзакции (None).
+    """
+    index = _sheet_indexes.get(sheet_id)
+    if index is None:
+        index = _load_sheet_index(sheet_id)
+        if pending:
+            pending.added[sheet_id] = index
+            pending.replaced.add(sheet_id)
+            return None
+        _store_index(sheet_id, index)
+    else:
+        _sheet_indexes.move_to_end(sheet_id)
+    return index
+
+
+def _load_sheet_index(sheet_id):
+    index = RectangleIndex()
+    rows = CellDependency.objects.filter(sheet_id=sheet_id).values_list(
+        'cell_id', 'cell__sheet_id', 'start_row', 'start_column', 'end_row', 'end_column'
+    )
+    for cell_id, cell_sheet_id, *rect in rows.iterator():
+        index.add((cell_sheet_id, cell_id), *rect)
+    return index
+
+
+def preload_dependency_index(sheet_ids):
+    """Заранее загружает индексы листов (для таблиц с активными сессиями)"""
+    pending = _pending()
+    with _index_lock:
+        for sheet_id in sheet_ids:
+            if sheet_id not in pending.replaced:
+                _get_sheet_index(sheet_id, pending)
+
+
+def reset_dependency_index(sheet_id=None):
+    """Сбрасывает индексы в памяти (все или одного листа); они перестроятся из БД"""
+    with _index_lock:
+        if sheet_id is None:
+            _sheet_indexes.clear()
+            _key_sheets.clear()
+        else:
+            _drop_index(sheet_id)
+
+
+def formula_dependency_rects(formula, sheet, sheets_by_name=None):
+    """
+    Возвращает прямоугольники (sheet_id, row1, col1, row2, col2), от которых зависит формула.
+    Ссылки на несуществующие листы и формулы с синтаксическими ошибками пропускаются.
     """
     if not formula or not formula.startswith('='):
-        return False
-    
-    formula = formula[1:].strip().upper()
-    cell_ref_upper = cell_ref.upper()
-    
-    # Проверяем прямые ссылки на ячейку
-    # Паттерн для ссылок на ячейки: A1, B2, AA123, etc.
-    pattern = r'[A-Z]+[0-9]+'
-    matches = re.findall(pattern, formula, re.IGNORECASE)
-    
-    for match in matches:
-        if match.upper() == cell_ref_upper:
-            return True
-    
-    # Проверяем ссылки в диапазонах (A1:A5)
-    range_pattern = r'([A-Z]+[0-9]+):([A-Z]+[0-9]+)'
-    range_matches = re.findall(range_pattern, formula, re.IGNORECASE)
-    
-    for start_ref, end_ref in range_matches:
-        start_row, start_col = _parse_cell_ref(start_ref)
-        end_row, end_col = _parse_cell_ref(end_ref)
-        
-        # Проверяем, попадает ли целевая ячейка в диапазон
-        if (start_row <= target_row <= end_row and 
-            start_col <= target_column <= end_col):
-            return True
-    
-    return False
-
-
-def _parse_cell_ref(ref):
-    """Парсит ссылку на ячейку (A1) в координаты (row, column)"""
-    ref = ref.upper()
-    match = re.match(r'([A-Z]+)([0-9]+)', ref)
-    if not match:
-        return None, None
-    
-    col_str = match.group(1)
-    row = int(match.group(2))
-    
-    # Преобразование колонки (A=1, B=2, ..., Z=26, AA=27, etc.)
-    column = 0
-    for char in col_str:
-        column = column * 26 + (ord(char) - ord('A') + 1)
-    
-    return row, column
+        return []
+
+    try:
+        compiled = compile_formula(formula.strip())
+    except FormulaSyntaxError:
+        return []
+
+    rects = set()
+    for sheet_name, *rect in compiled.rects():
+        if sheet_name is None:
+            sheet_id = sheet.id
+        else:
+            if sheets_by_name is None:
+                sheets_by_name = dict(
+                    Sheet.objects.filter(spreadsheet_id=sheet.spreadsheet_id).values_list('name', 'id')
+                )
+            sheet_id = sheets_by_name.get(sheet_name)
+            if sheet_id is None:
+                continue
+        rects.add((sheet_id, *rect))
+    return sorted(rects)
+
+
+def rebuild_dependencies(spreadsheet):
+    """
+    Перестраивает индекс зависимостей всех формул таблицы.
+    Нужен после создания или переименования листа: ссылки Лист2!A1 могли
+    начать или перестать указывать на существующий лист.
+    Возвращает ячейки с формулами, ссылающимися на другие листы.
+    """
+    sheets_by_name = dict(Sheet.objects.filter(spreadsheet=spreadsheet).values_list('name', 'id'))
+    formula_cells = list(
+        Cell.objects.filter(sheet__spreadsheet=spreadsheet).exclude(formula='').select_related('sheet')
+    )
+
+    dependencies = []
+    cross_sheet_cells = []
+    for cell in formula_cells:
+        rects = formula_dependency_rects(cell.formula, cell.sheet, sheets_by_name)
+        for sheet_id, start_row, start_column, end_row, end_column in rects:
+            dependencies.append(CellDependency(
+                cell=cell,
+                sheet_id=sheet_id,
+                start_row=start_row,
+                start_column=start_column,
+                end_row=end_row,
+                end_column=end_column,
+            ))
+        if '!' in cell.formula:
+            cross_sheet_cells.append(cell)
+
+    CellDependency.objects.filter(cell__sheet__spreadsheet=spreadsheet).delete()
+    CellDependency.objects.bulk_create(dependencies, batch_size=1000)
+    # До фиксации индексы листов таблицы строятся для потока заново из БД
+    pending = _pending_for_change()
+    for sheet_id in sheets_by_name.values():
+        pending.added.pop(sheet_id, None)
+        pending.replaced.add(sheet_id)
+    return cross_sheet_cells
+
+
+def update_cell_dependencies(cell):
+    """Перестраивает записи индекса зависимостей ячейки после сохранения ее формулы"""
+    update_cells_dependencies([cell])
+
+
+def update_cells_dependencies(cells):
+    """
+    Перестраивает записи индекса зависимостей нескольких ячеек (одним
+    удалением и одним bulk_create) после сохранения их формул.
+    """
+    cells = list(cells)
+    if not cells:
+        return
+
+    sheets_by_name = {}
+    dependencies = []
+    rects_by_key = {}
+    for cell in cells:
+        rects = []
+        if cell.formula:
+            spreadsheet_id = cell.sheet.spreadsheet_id
+            if '!' in cell.formula and spreadsheet_id not in sheets_by_name:
+                sheets_by_name[spreadsheet_id] = dict(
+                    Sheet.objects.filter(spreadsheet_id=spreadsheet_id).values_list('name', 'id')
+                )
+            rects = formula_dependency_rects(cell.formula, cell.sheet, sheets_by_name.get(spreadsheet_id))
+        rects_by_key[(cell.sheet_id, cell.id)] = rects
+        for sheet_id, start_row, start_column, end_row, end_column in rects:
+            dependencies.append(CellDependency(
+                cell=cell,
+                sheet_id=sheet_id,
+                start_row=start_row,
+                start_column=start_column,
+                end_row=end_row,
+                end_column=end_column,
+            ))
+
+    # Индексы затронутых листов загружаются до записи: после нее БД содержит
+    # незафиксированные зависимости, и загруженный индекс годился бы только потоку
+    preload_dependency_index(
+        {cell.sheet_id for cell in cells} | {dependency.sheet_id for dependency in dependencies}
+    )
+    CellDependency.objects.filter(cell_id__in=[cell.id for cell in cells]).delete()
+    CellDependency.objects.bulk_create(dependencies, batch_size=1000)
+
+    _record_rects(rects_by_key)
+
+
+def forget_cell_dependencies(cell_keys):
+    """
+    Убирает из индексов в памяти прямоугольники удаленных ячеек
+    (ключи (sheet_id, cell_id)); записи CellDependency удаляются каскадно.
+    """
+    _record_rects({key: [] for key in cell_keys})
+
 
+def _record_rects(rects_by_key):
+    """Заменяет прямоугольники ключей; в общие индексы замена попадет после фиксации"""
+    pending = _pending_for_change()
+    for key, rects in rects_by_key.items():
+        pending.removed.add(key)
+        for added in pending.added.values():
+            added.remove(key)
+        for sheet_id, *rect in rects:
+            _thread_index(pending, sheet_id).add(key, *rect)
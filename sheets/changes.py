@@ -0,0 +1,116 @@
+import threading
+from django.db import models
+from .models import Spreadsheet, Sheet, Cell, CellChange, transaction_sequences
+from .cell_dependencies import reset_dependency_index
+from .aggregates import forget_sheet_aggregate_states
+from . import resident
+
+
+# Номер изменения таблицы, с которым сверены кэши процесса: индекс
+# зависимостей, таблица в памяти и состояния агрегатов. Собственные изменения
+# процесса продвигают номер (advance_checked_sequences); если номер в БД
+# ушел дальше, таблицу меняли в обход процесса (команда import_csv, другой
+# процесс сервера) - кэши сбрасываются в check_caches
+_checked_sequences = {}
+_checked_lock = threading.Lock()
+
+
+def current_sequence(spreadsheet_id):
+    """Номер последнего изменения ячеек таблицы"""
+    return Spreadsheet.objects.filter(id=spreadsheet_id).values_list('sequence', flat=True).first() or 0
+
+
+def changes_since(spreadsheet_id, since):
+    """
+    Ячейки таблицы, измененные после изменения с номером since: текущее
+    содержимое существующих ячеек (cells), координаты удаленных (deleted) и
+    листы, в которых сдвигались строки или колонки (reload_sheets) - их
+    ячейки нужно перечитать целиком.
+    Объем ответа пропорционален числу измененных ячеек, а не размеру листов.
+
+    Номер читается до выборки журнала: изменения, зафиксированные позже,
+    могут попасть в ответ, но будут запрошены повторно, а не потеряны.
+    """
+    sequence = current_sequence(spreadsheet_id)
+    cells = Cell.objects.filter(
+        sheet_id=models.OuterRef('sheet_id'),
+        row=models.OuterRef('row'),
+        column=models.OuterRef('column'),
+    )
+    changes = CellChange.objects.filter(
+        spreadsheet_id=spreadsheet_id,
+        sequence__gt=since,
+    ).order_by('sequence').annotate(
+        cell_id=models.Subquery(cells.values('id')),
+        value=models.Subquery(cells.values('value')),
+        formula=models.Subquery(cells.values('formula')),
+        style=models.Subquery(cells.values('style'), output_field=models.JSONField()),
+    ).values_list('sheet_id', 'row', 'column', 'cell_id', 'value', 'formula', 'style')
+
+    updated = []
+    deleted = []
+    reload_sheets = []
+    for sheet_id, row, column, cell_id, value, formula, style in changes.iterator(chunk_size=2000):
+        if row == 0 and column == 0:
+            reload_sheets.append(sheet_id)
+        elif cell_id is None:
+            deleted.append({'sheet_id': sheet_id, 'row': row, 'column': column})
+        else:
+            updated.append({
+                'id': cell_id,
+                'sheet_id': sheet_id,
+                'row': row,
+                'column': column,
+                'value': value,
+                'formula': formula,
+                'style': style or {},
+            })
+    return {'sequence': sequence, 'cells': updated, 'deleted': deleted, 'reload_sheets': reload_sheets}
+
+
+def check_caches(sheet_ids):
+    """
+    Сверяет кэши процесса для таблиц листов sheet_ids с номером их последнего
+    изменения (один запрос). Если таблицу меняли в обход процесса, ее индекс
+    зависимостей, состояния агрегатов и копия в памяти сбрасываются и
+    перестроятся из БД.
+    """
+    sheets = Sheet.objects.filter(spreadsheet__sheets__id__in=set(sheet_ids)).values_list(
+        'id', 'spreadsheet_id', 'spreadsheet__sequence'
+    ).distinct()
+    # Номер, выданный текущей транзакции, кэши учтут после ее фиксации:
+    # сверяем их с предыдущим
+    own = transaction_sequences()
+    spreadsheets = {}
+    for sheet_id, spreadsheet_id, sequence in sheets:
+        if own.get(spreadsheet_id) == sequence:
+            sequence -= 1
+        spreadsheets.setdefault((spreadsheet_id, sequence), []).append(sheet_id)
+
+    for (spreadsheet_id, sequence), spreadsheet_sheet_ids in spreadsheets.items():
+        with _checked_lock:
+            if _checked_sequences.get(spreadsheet_id) == sequence:
+                continue
+            _checked_sequences[spreadsheet_id] = sequence
+        for sheet_id in spreadsheet_sheet_ids:
+            reset_dependency_index(sheet_id)
+        forget_sheet_aggregate_states(spreadsheet_sheet_ids)
+        resident.reload(spreadsheet_id)
+
+
+def advance_checked_sequences(sequences):
+    """
+    Учитывает изменения, записанные этим процессом: {spreadsheet_id: номер}.
+    Номер продвигается, только если он следует за сверенным, иначе между
+    ними были чужие изменения и следующая check_caches сбросит кэши.
+    """
+    with _checked_lock:
+        for spreadsheet_id, sequence in sequences.items():
+            if _checked_sequences.get(spreadsheet_id) == sequence - 1:
+                _checked_sequences[spreadsheet_id] = sequence
+
+
+def note_loaded_sequence(spreadsheet_id, sequence):
+    """Таблица загружена в память по состоянию на номер sequence (если кэши еще не сверялись)"""
+    with _checked_lock:
+        _checked_sequences.setdefault(spreadsheet_id, sequence)
@@ -1,14 +1,133 @@
+import asyncio
 import json
+import time
+from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from .models import Spreadsheet, Cell, Sheet
+from .models import Spreadsheet
+from .edits import range_cell_updates, cell_update
+from . import resident
+
+
+def group_name(spreadsheet_id):
+    """Группа channel layer с подключениями к таблице"""
+    return f'spreadsheet_{spreadsheet_id}'
+
+
+# Тип сообщения клиенту для групповых событий, у которых он отличается
+CLIENT_MESSAGE_TYPES = {
+    'cells_updated': 'cells_update',
+    'range_values_updated': 'range_update',
+}
+
+
+def encode_event(event):
+    """
+    Групповое событие с заранее сериализованным сообщением клиенту.
+
+    JSON строится один раз у отправителя, обработчики каждого подключения
+    только пересылают готовый текст; user_id остается в событии, чтобы
+    исключать автора без повторного кодирования.
+    """
+    message = dict(event, type=CLIENT_MESSAGE_TYPES.get(event['type'], event['type']))
+    return {
+        'type': event['type'],
+        'user_id': event['user_id'],
+        'text': json.dumps(message, ensure_ascii=False, separators=(',', ':')),
+    }
+
+
+def broadcast(spreadsheet_id, event):
+    """Рассылает событие подключенным к таблице из синхронного кода (например, из API)"""
+    async_to_sync(get_channel_layer().group_send)(group_name(spreadsheet_id), encode_event(event))
+
+
+def cell_payload(cell):
+    """Содержимое ячейки для рассылки клиентам"""
+    return {
+        'sheet_id': cell.sheet_id,
+        'row': cell.row,
+        'column': cell.column,
+        'value': cell.value,
+        'formula': cell.formula,
+        'style': cell.style or {},
+    }
+
+
+def cell_rejected(sheet_id, row, column, error):
+    """Сообщение автору правки: ячейка не записана, клиенту нужно перечитать ее"""
+    return {'type': 'cell_rejected', 'sheet_id': sheet_id, 'row': row, 'column': column, 'error': error}
+
+
+def range_area(data):
+    """
+    Блок из сообщения range_update: (sheet_id, start_row, start_column, values);
+    ValueError, если координаты не целые (values не проверяется)
+    """
+    try:
+        return int(data.get('sheet_id')), int(data.get('start_row')), int(data.get('start_column')), data.get('values')
+    except (TypeError, ValueError):
+        raise ValueError('sheet_id, start_row и start_column должны быть целыми числами')
+
+
+def range_rejected(error, area=None):
+    """
+    Сообщение автору: блок range_update не записан. area = (sheet_id,
+    start_row, start_column, values) - границы блока для перечитывания
+    (если values - список строк).
+    """
+    message = {'type': 'range_rejected', 'error': error}
+    if area is not None and isinstance(area[3], list) and all(isinstance(line, list) for line in area[3]):
+        sheet_id, start_row, start_column, values = area
+        message.update(
+            sheet_id=sheet_id,
+            start_row=start_row,
+            start_column=start_column,
+            end_row=start_row + max(len(values), 1) - 1,
+            end_column=start_column + max((len(line) for line in values), default=1) - 1,
+        )
+    return message
+
+
+class MessageRateLimiter:
+    """
+    Ограничение частоты входящих сообщений подключения (маркерная корзина):
+    в среднем rate сообщений в секунду, подряд - не больше burst.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
 
 
 class SpreadsheetConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.spreadsheet_id = self.scope['url_route']['kwargs']['spreadsheet_id']
-        self.room_group_name = f'spreadsheet_{self.spreadsheet_id}'
+        self.room_group_name = group_name(self.spreadsheet_id)
+        self.resident_acquired = False
+        self.rate_limiter = MessageRateLimiter(
+            getattr(settings, 'SPREADSHEET_MESSAGE_RATE', 50),
+            getattr(settings, 'SPREADSHEET_MESSAGE_BURST', 200),
+        )
+        self.rate_limited = False
+        self.cursor_interval = getattr(settings, 'SPREADSHEET_CURSOR_INTERVAL', 0.1)
+        self.cursor_position = None
+        self.cursor_sent_at = 0
+        self.cursor_task = None
         
         # Получаем пользователя из токена или сессии
         query_string = self.scope.get('query_string', b'').decode()
@@ -46,9 +165,12 @@ class SpreadsheetConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        # Пока к таблице подключены пользователи, она держится в памяти процесса
+        await database_sync_to_async(resident.acquire)(self.spreadsheet_id)
+        self.resident_acquired = True
+
         # Отправляем информацию о новом пользователе
-        await self.channel_layer.group_send(
-            self.room_group_name,
+        await self.group_send(
             {
                 'type': 'user_joined',
                 'user_id': self.user.id,
@@ -57,16 +179,24 @@ class SpreadsheetConsumer(AsyncWebsocketConsumer):
         )
 
     async def disconnect(self, close_code):
+        # Отложенная рассылка курсора больше не нужна
+        if getattr(self, 'cursor_task', None):
+            self.cursor_task.cancel()
+            self.cursor_task = None
+
         # Покидаем группу
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
+        if getattr(self, 'resident_acquired', False):
+            await database_sync_to_async(resident.release)(self.spreadsheet_id)
+            self.resident_acquired = False
+
         # Отправляем информацию об уходе пользователя
         if not isinstance(self.user, AnonymousUser):
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await self.group_send(
                 {
                     'type': 'user_left',
                     'user_id': self.user.id,
@@ -78,72 +208,118 @@ class SpreadsheetConsumer(AsyncWebsocketConsumer):
         data = json.loads(text_data)
         message_type = data.get('type')
 
+        if not self.rate_limiter.allow():
+            await self.reject_over_limit(message_type, data)
+            return
+        self.rate_limited = False
+
         if message_type == 'cell_update':
             # Обрабатываем обновление ячейки
             await self.handle_cell_update(data)
+        elif message_type == 'range_update':
+            # Блок значений (вставка из буфера) - одной записью
+            await self.handle_range_update(data)
         elif message_type == 'cursor_move':
             # Обрабатываем перемещение курсора
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'cursor_update',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'row': data.get('row'),
-                    'column': data.get('column'),
-                }
-            )
+            await self.handle_cursor_move(data)
 
-    async def handle_cell_update(self, data):
-        """Обрабатывает обновление ячейки и рассылает другим пользователям"""
-        sheet_id = data.get('sheet_id')
-        row = data.get('row')
-        column = data.get('column')
-        value = data.get('value', '')
-        formula = data.get('formula', '')
-        style = data.get('style', {})
-
-        # Сохраняем изменения в БД и получаем обновленную ячейку с вычисленным значением
-        cell = await self.save_cell_update(sheet_id, row, column, value, formula, style)
-        
-        if not cell:
+    async def reject_over_limit(self, message_type, data):
+        """
+        Сообщение сверх лимита частоты. Правки не записываются, автор получает
+        отказ с их координатами (чтобы перечитать ячейки); прочие сообщения
+        (перемещения курсора) отбрасываются с одним уведомлением rate_limited
+        """
+        error = 'Слишком много сообщений, правка не записана'
+        if message_type == 'cell_update':
+            await self.send_json(cell_rejected(data.get('sheet_id'), data.get('row'), data.get('column'), error))
+        elif message_type == 'range_update':
+            try:
+                area = range_area(data)
+            except ValueError:
+                area = None
+            await self.send_json(range_rejected(error, area))
+        elif not self.rate_limited:
+            self.rate_limited = True
+            await self.send_json({
+                'type': 'rate_limited',
+                'error': 'Слишком много сообщений, часть из них отброшена',
+            })
+
+    async def handle_cursor_move(self, data):
+        """
+        Рассылает положение курсора не чаще раза в cursor_interval секунд.
+        Промежуточные положения отбрасываются: после паузы рассылается последнее.
+        """
+        self.cursor_position = (data.get('row'), data.get('column'))
+        if self.cursor_task:
             return
+        delay = self.cursor_sent_at + self.cursor_interval - time.monotonic()
+        if delay <= 0:
+            await self.send_cursor()
+        else:
+            self.cursor_task = asyncio.create_task(self.send_cursor_later(delay))
 
-        # Пересчитываем зависимые ячейки
-        dependent_cells = await self.recalculate_dependent_cells(sheet_id, row, column)
+    async def send_cursor_later(self, delay):
+        await asyncio.sleep(delay)
+        self.cursor_task = None
+        await self.send_cursor()
 
-        # Рассылаем обновление измененной ячейки всем пользователям в группе
-        await self.channel_layer.group_send(
-            self.room_group_name,
+    async def send_cursor(self):
+        row, column = self.cursor_position
+        self.cursor_sent_at = time.monotonic()
+        await self.group_send(
             {
-                'type': 'cell_updated',
+                'type': 'cursor_update',
                 'user_id': self.user.id,
                 'username': self.user.username,
-                'sheet_id': sheet_id,
                 'row': row,
                 'column': column,
-                'value': cell.value,  # Используем вычисленное значение
-                'formula': cell.formula,
-                'style': cell.style or {},
             }
         )
-        
-        # Рассылаем обновления зависимых ячеек
-        for dep_cell in dependent_cells:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'cell_updated',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'sheet_id': sheet_id,
-                    'row': dep_cell.row,
-                    'column': dep_cell.column,
-                    'value': dep_cell.value,
-                    'formula': dep_cell.formula,
-                    'style': dep_cell.style or {},
-                }
+
+    async def handle_cell_update(self, data):
+        """
+        Ставит правку ячейки в очередь писателя таблицы (см. writer.SpreadsheetWriter):
+        он записывает правки пачками и рассылает их вместе с пересчитанными ячейками.
+        Неверная правка в очередь не попадает, автор получает cell_rejected
+        """
+        from .writer import submit_cell_updates
+        try:
+            update = cell_update(
+                data.get('sheet_id'), data.get('row'), data.get('column'),
+                data.get('value', ''), data.get('formula', ''), data.get('style'),
             )
+            self.check_sheet(update['sheet_id'])
+        except ValueError as e:
+            await self.send_json(cell_rejected(data.get('sheet_id'), data.get('row'), data.get('column'), str(e)))
+            return
+        submit_cell_updates(self.spreadsheet_id, self.user, self.channel_name, [update])
+
+    async def handle_range_update(self, data):
+        """
+        Ставит в очередь писателя запись прямоугольного блока values, начиная с
+        ячейки (start_row, start_column); блок записывается одной транзакцией и
+        рассылается всем (включая автора) одним сообщением range_update
+        """
+        from .writer import submit_cell_updates
+        try:
+            area = range_area(data)
+            updates = range_cell_updates(*area)
+            self.check_sheet(area[0])
+        except ValueError as e:
+            await self.send_json(range_rejected(str(e)))
+            return
+        submit_cell_updates(self.spreadsheet_id, self.user, self.channel_name, updates, area)
+
+    def check_sheet(self, sheet_id):
+        """ValueError, если листа нет в таблице (по таблице в памяти процесса)"""
+        spreadsheet = resident.get_resident(int(self.spreadsheet_id))
+        if spreadsheet is not None and sheet_id not in spreadsheet.sheets:
+            raise ValueError('Лист не найден в таблице')
+
+    async def send_json(self, message):
+        """Отправляет сообщение этому клиенту"""
+        await self.send(text_data=json.dumps(message, ensure_ascii=False))
 
     @database_sync_to_async
     def get_user(self, user_id):
@@ -163,113 +339,45 @@ class SpreadsheetConsumer(AsyncWebsocketConsumer):
         except Spreadsheet.DoesNotExist:
             return False
 
-    @database_sync_to_async
-    def save_cell_update(self, sheet_id, row, column, value, formula, style):
-        """Сохраняет обновление ячейки в БД"""
-        try:
-            sheet = Sheet.objects.get(id=sheet_id)
-            cell, created = Cell.objects.get_or_create(
-                sheet=sheet,
-                row=row,
-                column=column,
-                defaults={'value': '', 'formula': '', 'style': {}}
-            )
-            
-            if formula:
-                cell.formula = formula
-                cell.value = ''  # Значение будет вычислено формулой
-            else:
-                cell.value = value
-                cell.formula = ''
-            
-            if style:
-                cell.style = style
-            
-            cell.save()
-            
-            # Если есть формула, вычисляем значение
-            if cell.formula:
-                from .formula_engine import FormulaEngine
-                engine = FormulaEngine(sheet)
-                try:
-                    cell.value = engine.evaluate(cell.formula)
-                    cell.save()
-                except Exception as e:
-                    cell.value = f'#ОШИБКА: {str(e)}'
-                    cell.save()
-            
-            return cell
-        except Exception as e:
-            print(f"Error saving cell update: {e}")
-            return None
-    
-    @database_sync_to_async
-    def recalculate_dependent_cells(self, sheet_id, row, column):
-        """Пересчитывает зависимые ячейки после изменения значения"""
-        try:
-            sheet = Sheet.objects.get(id=sheet_id)
-            from .cell_dependencies import find_dependent_cells
-            from .formula_engine import FormulaEngine
-            
-            dependent_cells = find_dependent_cells(sheet, row, column)
-            engine = FormulaEngine(sheet)
-            
-            for cell in dependent_cells:
-                try:
-                    cell.value = engine.evaluate(cell.formula)
-                    cell.save()
-                except Exception as e:
-                    cell.value = f'#ОШИБКА: {str(e)}'
-                    cell.save()
-            
-            return dependent_cells
-        except Exception as e:
-            print(f"Error recalculating dependent cells: {e}")
-            return []
-
-    # Обработчики сообщений для группы
-
-    async def cell_updated(self, event):
-        """Отправляет обновление ячейки клиенту"""
-        # Не отправляем обновление тому, кто его сделал
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'cell_update',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'sheet_id': event['sheet_id'],
-                'row': event['row'],
-                'column': event['column'],
-                'value': event['value'],
-                'formula': event['formula'],
-                'style': event['style'],
-            }))
+    async def group_send(self, event):
+        """Рассылает событие всем подключенным к таблице"""
+        await self.channel_layer.group_send(self.room_group_name, encode_event(event))
+
+    # Обработчики сообщений для группы: текст уже сериализован отправителем (см. encode_event)
+
+    async def cells_updated(self, event):
+        """
+        Отправляет клиенту измененные ячейки и пересчитанные зависимые одним
+        сообщением (всем, включая автора: значения формул вычислены сервером)
+        """
+        await self.send(text_data=event['text'])
 
     async def user_joined(self, event):
         """Отправляет информацию о присоединении пользователя"""
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'user_joined',
-                'user_id': event['user_id'],
-                'username': event['username'],
-            }))
+            await self.send(text_data=event['text'])
 
     async def user_left(self, event):
         """Отправляет информацию об уходе пользователя"""
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'user_id': event['user_id'],
-            'username': event['username'],
-        }))
+        await self.send(text_data=event['text'])
 
     async def cursor_update(self, event):
         """Отправляет обновление курсора другого пользователя"""
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_update',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'row': event['row'],
-                'column': event['column'],
-            }))
+            await self.send(text_data=event['text'])
+
+    async def sheet_structure_changed(self, event):
+        """Отправляет сообщение о вставке или удалении строк/колонок (всем, включая автора)"""
+        await self.send(text_data=event['text'])
+
+    async def range_updated(self, event):
+        """Отправляет сообщение о массовом изменении диапазона (всем, включая автора)"""
+        await self.send(text_data=event['text'])
+
+    async def edit_rejected(self, event):
+        """Отправляет автору правки сообщение писателя о том, что она не записана"""
+        await self.send(text_data=event['text'])
 
+    async def range_values_updated(self, event):
+        """Отправляет записанный блок значений (всем, включая автора: значения формул вычислены сервером)"""
+        await self.send(text_data=event['text'])
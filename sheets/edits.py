@@ -0,0 +1,165 @@
+from django.db import transaction
+from .models import Cell
+from .formula_engine import cell_to_value
+from .formula_parser import MAX_ROW, MAX_COLUMN
+from .cell_dependencies import update_cells_dependencies
+from .recalculation import recalculate_cells
+from .aggregates import UNKNOWN
+from . import resident
+
+
+# Наибольшее число ячеек в одном блоке range_cell_updates
+RANGE_MAX_CELLS = 100000
+
+
+def cell_text(value):
+    """Текст ячейки из значения запроса: None - пустая строка, число - его запись"""
+    if value is None:
+        return ''
+    if not isinstance(value, (str, int, float)):
+        raise ValueError('Значение ячейки должно быть строкой или числом')
+    return str(value)
+
+
+def cell_update(sheet_id, row, column, value='', formula='', style=None):
+    """
+    Обновление одной ячейки для apply_cell_updates из полей сообщения
+    cell_update; ValueError, если они заданы неверно. Непустая формула
+    очищает значение, иначе записывается значение.
+    """
+    try:
+        update = {'sheet_id': int(sheet_id), 'row': int(row), 'column': int(column)}
+    except (TypeError, ValueError):
+        raise ValueError('sheet_id, row и column должны быть целыми числами')
+    if not (1 <= update['row'] <= MAX_ROW and 1 <= update['column'] <= MAX_COLUMN):
+        raise ValueError('Ячейка за границами листа')
+    if style is not None and not isinstance(style, dict):
+        raise ValueError('style должен быть объектом')
+    # Числа из JSON записываются как текст ячейки
+    value = cell_text(value)
+    formula = cell_text(formula)
+    if formula:
+        update['formula'] = formula
+        update['value'] = ''
+    else:
+        update['value'] = value
+    if style:
+        update['style'] = style
+    return update
+
+
+def range_cell_updates(sheet_id, start_row, start_column, values):
+    """
+    Обновления ячеек прямоугольного блока для apply_cell_updates.
+
+    values - список строк блока, начиная с ячейки (start_row, start_column);
+    текст, начинающийся с '=', - формула, None - ячейка не меняется.
+    """
+    if start_row < 1 or start_column < 1:
+        raise ValueError('start_row и start_column должны быть положительными')
+    if not isinstance(values, list) or not all(isinstance(line, list) for line in values):
+        raise ValueError('values должен быть списком строк')
+    if sum(len(line) for line in values) > RANGE_MAX_CELLS:
+        raise ValueError(f'Блок больше {RANGE_MAX_CELLS} ячеек')
+    width = max((len(line) for line in values), default=0)
+    if start_row + len(values) - 1 > MAX_ROW or start_column + width - 1 > MAX_COLUMN:
+        raise ValueError('Блок выходит за границы листа')
+
+    updates = []
+    for row, line in enumerate(values, start_row):
+        for column, item in enumerate(line, start_column):
+            if item is None:
+                continue
+            text = cell_text(item)
+            if text.startswith('='):
+                updates.append({'sheet_id': sheet_id, 'row': row, 'column': column, 'value': '', 'formula': text})
+            else:
+                updates.append({'sheet_id': sheet_id, 'row': row, 'column': column, 'value': text})
+    return updates
+
+
+def apply_cell_updates(sheets, updates):
+    """
+    Применяет обновления ячеек одной транзакцией и одним пересчетом.
+
+    sheets: {sheet_id: Sheet}; updates: словари с sheet_id, row, column и
+    необязательными value, formula, style, применяются по порядку (value
+    очищает формулу). Существующие ячейки читаются одним запросом на лист,
+    записываются массово; формулы пакета и все зависящие от измененных
+    ячеек вычисляются вместе.
+    Возвращает (ячейки пакета {(sheet_id, row, column): Cell} с вычисленными
+    значениями, список пересчитанных ячеек в порядке вычисления).
+    """
+    coordinates = {
+        (int(update['sheet_id']), int(update['row']), int(update['column']))
+        for update in updates
+    }
+
+    with transaction.atomic():
+        cells = {}
+        for sheet_id, sheet in sheets.items():
+            points = {(row, column) for cell_sheet_id, row, column in coordinates if cell_sheet_id == sheet_id}
+            if not points:
+                continue
+            queryset = Cell.objects.filter(
+                sheet=sheet,
+                row__in={row for row, column in points},
+                column__in={column for row, column in points},
+            )
+            for cell in queryset:
+                if (cell.row, cell.column) in points:
+                    cells[(sheet_id, cell.row, cell.column)] = cell
+
+        created = []
+        previous = {}
+        for sheet_id, row, column in coordinates - cells.keys():
+            cell = Cell(sheet=sheets[sheet_id], row=row, column=column, value='', formula='', style={})
+            cells[(sheet_id, row, column)] = cell
+            created.append(cell)
+        for coordinate, cell in cells.items():
+            previous[coordinate] = (cell.value, cell.formula)
+
+        # Применяем обновления по порядку; формулы вычисляются ниже одним пересчетом
+        touched = set()
+        for update in updates:
+            coordinate = (int(update['sheet_id']), int(update['row']), int(update['column']))
+            cell = cells[coordinate]
+            if 'value' in update:
+                cell.value = update['value']
+                cell.formula = ''
+            if 'formula' in update:
+                cell.formula = update['formula']
+            if 'style' in update:
+                cell.style = update['style']
+            if 'value' in update or 'formula' in update:
+                touched.add(coordinate)
+
+        created_ids = {id(cell) for cell in created}
+        existing = [cell for cell in cells.values() if id(cell) not in created_ids]
+        Cell.objects.bulk_create(created, batch_size=1000)
+        Cell.objects.bulk_write(existing, ['value', 'formula', 'style'])
+        resident.update_cells(cells.values())
+
+        update_cells_dependencies(
+            cell for coordinate, cell in cells.items()
+            if cell.formula != previous[coordinate][1]
+        )
+
+        # Один пересчет: формулы пакета и все зависящие от измененных ячеек.
+        # Старое значение известно и для ячеек, ставших формулами (в базе у них
+        # уже пустое значение); новое значение формулы получит пересчет
+        changes = {
+            coordinate: (
+                cell_to_value(previous[coordinate][0]),
+                UNKNOWN if cells[coordinate].formula else cell_to_value(cells[coordinate].value),
+            )
+            for coordinate in touched
+        }
+        recalculated = recalculate_cells(touched, include_changed=True, changes=changes)
+
+    for cell in recalculated:
+        batch_cell = cells.get((cell.sheet_id, cell.row, cell.column))
+        if batch_cell is not None:
+            batch_cell.value = cell.value
+
+    return cells, recalculated
@@ -0,0 +1,119 @@
+import csv
+import json
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from .models import Cell
+
+
+# Сколько ячеек читается из БД за раз и сколько строк собирается в один кусок ответа
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class _Echo:
+    """Псевдофайл для csv.writer: writerow возвращает готовую строку"""
+
+    def write(self, value):
+        return value
+
+
+def _content(value, formula, values_only):
+    """Содержимое ячейки для выгрузки: формула (если есть) или значение"""
+    if formula and not values_only:
+        return formula
+    return value
+
+
+def _sheet_cells(sheet, *fields):
+    """Ячейки листа в порядке (row, column), читаемые из БД пачками"""
+    return Cell.objects.filter(sheet=sheet).order_by('row', 'column').values_list(
+        *fields
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def sheet_csv(sheet, values_only=False):
+    """
+    Лист в виде CSV-таблицы (строка CSV - строка листа, начиная с A1).
+    Генератор кусков текста; в памяти держится не больше EXPORT_CHUNK_SIZE строк.
+    """
+    writer = csv.writer(_Echo())
+    lines = []
+    current_row = 1
+    fields = []
+    for row, column, value, formula in _sheet_cells(sheet, 'row', 'column', 'value', 'formula'):
+        while current_row < row:
+            lines.append(writer.writerow(fields))
+            fields = []
+            current_row += 1
+            if len(lines) >= EXPORT_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+        fields.extend([''] * (column - 1 - len(fields)))
+        fields.append(_content(value, formula, values_only))
+    if fields:
+        lines.append(writer.writerow(fields))
+    if lines:
+        yield ''.join(lines)
+
+
+def spreadsheet_csv(spreadsheet, values_only=False):
+    """Все листы таблицы в CSV по ячейке на строку: sheet, row, column, content"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['sheet', 'row', 'column', 'content'])
+    for sheet in spreadsheet.sheets.all():
+        lines = []
+        for row, column, value, formula in _sheet_cells(sheet, 'row', 'column', 'value', 'formula'):
+            lines.append(writer.writerow([sheet.name, row, column, _content(value, formula, values_only)]))
+            if len(lines) >= EXPORT_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+
+def cells_ndjson(sheets):
+    """Ячейки листов в формате JSON Lines (объект ячейки на строку)"""
+    for sheet in sheets:
+        lines = []
+        cells = _sheet_cells(sheet, 'row', 'column', 'value', 'formula', 'style')
+        for row, column, value, formula, style in cells:
+            lines.append(json.dumps({
+                'sheet': sheet.name,
+                'sheet_id': sheet.id,
+                'row': row,
+                'column': column,
+                'value': value,
+                'formula': formula,
+                'style': style,
+            }, ensure_ascii=False))
+            lines.append('\n')
+            if len(lines) >= 2 * EXPORT_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+
+async def _iterate_async(chunks):
+    """Асинхронная обертка над генератором: под ASGI куски отдаются по мере чтения из БД"""
+    get_next = sync_to_async(next)
+    while True:
+        chunk = await get_next(chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def streaming_response(request, chunks, export_format, filename):
+    """StreamingHttpResponse для выгрузки (под ASGI - с асинхронным итератором)"""
+    if isinstance(request, ASGIRequest):
+        chunks = _iterate_async(chunks)
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = content_disposition_header(True, f'{filename}.{export_format}')
+    return response
@@ -0,0 +1,93 @@
+from django.db import transaction
+from django.utils import timezone
+from .models import Cell
+from .formula_parser import offset_references
+from .recalculation import recalculate_area
+
+
+# Наибольшая площадь приемника одного копирования
+COPY_MAX_CELLS = 1000000
+
+# Размер пачки записи ячеек
+COPY_CHUNK_SIZE = 5000
+
+# Поля, которые перезаписываются у уже существующих ячеек приемника
+COPY_UPDATE_FIELDS = ['value', 'formula', 'style', *Cell.TYPED_FIELDS, 'updated_at']
+
+
+def copy_range(source_sheet, source, sheet, destination):
+    """
+    Копирует прямоугольник source = (row1, col1, row2, col2) листа
+    source_sheet в прямоугольник destination листа sheet. Если приемник
+    больше источника, содержимое источника повторяется (заполнение вниз и
+    вправо). Относительные ссылки формул сдвигаются на смещение копии,
+    пустые ячейки источника очищают соответствующие ячейки приемника.
+
+    Ячейки записываются массово в одной транзакции, формулы приемника
+    вычисляются вместе одним пересчетом (см. recalculate_area).
+    Возвращает {'cells': записано, 'cleared': очищено, 'recalculated': пересчитано}.
+    """
+    source_row, source_column, source_end_row, source_end_column = source
+    height = source_end_row - source_row + 1
+    width = source_end_column - source_column + 1
+    start_row, start_column, end_row, end_column = destination
+    if (end_row - start_row + 1) * (end_column - start_column + 1) > COPY_MAX_CELLS:
+        raise ValueError(f'Диапазон копирования больше {COPY_MAX_CELLS} ячеек')
+
+    pattern = {
+        (row - source_row, column - source_column): (value, formula, style)
+        for row, column, value, formula, style in Cell.objects.filter(
+            sheet=source_sheet,
+            row__range=(source_row, source_end_row),
+            column__range=(source_column, source_end_column),
+        ).values_list('row', 'column', 'value', 'formula', 'style')
+    }
+
+    with transaction.atomic():
+        existing = {
+            (row, column): cell_id
+            for cell_id, row, column in Cell.objects.filter(
+                sheet=sheet,
+                row__range=(start_row, end_row),
+                column__range=(start_column, end_column),
+            ).values_list('id', 'row', 'column')
+        }
+
+        now = timezone.now()
+        cells = []
+        cleared = []
+        for row in range(start_row, end_row + 1):
+            row_offset = (row - start_row) % height
+            for column in range(start_column, end_column + 1):
+                column_offset = (column - start_column) % width
+                content = pattern.get((row_offset, column_offset))
+                if content is None:
+                    if (row, column) in existing:
+                        cleared.append(existing[(row, column)])
+                    continue
+                value, formula, style = content
+                if formula:
+                    formula = offset_references(
+                        formula,
+                        row - source_row - row_offset,
+                        column - source_column - column_offset,
+                    )
+                    value = ''
+                cells.append(Cell(
+                    sheet=sheet, row=row, column=column,
+                    value=value, formula=formula, style=style, updated_at=now,
+                ))
+
+        Cell.objects.bulk_create(
+            cells,
+            batch_size=COPY_CHUNK_SIZE,
+            update_conflicts=True,
+            unique_fields=['sheet', 'row', 'column'],
+            update_fields=COPY_UPDATE_FIELDS,
+        )
+        for index in range(0, len(cleared), COPY_CHUNK_SIZE):
+            Cell.objects.filter(id__in=cleared[index:index + COPY_CHUNK_SIZE]).delete()
+
+        recalculated = recalculate_area(sheet, destination)
+
+    return {'cells': len(cells), 'cleared': len(cleared), 'recalculated': len(recalculated)}
@@ -1,14 +1,237 @@
-import re
-from .models import Cell, Sheet
+import math
+import numpy as np
+from django.db import models
+from .models import Cell, Sheet, ValueKind, classify_value
+from .formula_parser import compile_formula, FormulaSyntaxError, MAX_ROW, MAX_COLUMN
+
+
+# Прямоугольник, покрывающий весь лист
+FULL_SHEET = (1, 1, MAX_ROW, MAX_COLUMN)
+
+# Если прямоугольников на листе больше, загружаем их общий охватывающий прямоугольник
+PREFETCH_MAX_RECTS = 100
+
+
+class CellError(str):
+    """Значение ячейки с ошибкой ("#ОШИБКА: ..."), отличается от текста по типу"""
+    
+    __slots__ = ()
+
+
+def typed_to_value(kind, number, value):
+    """Значение для вычислений (float или строка) по типизированным полям ячейки"""
+    if kind == ValueKind.NUMBER:
+        # NaN в части СУБД хранится как NULL
+        return number if number is not None else math.nan
+    if kind == ValueKind.EMPTY:
+        return ''
+    if kind == ValueKind.ERROR:
+        return CellError(value)
+    return value
+
+
+def cell_to_value(value):
+    """Преобразует сохраненное значение ячейки в значение для вычислений (float или строка)"""
+    kind, number, _ = classify_value(value)
+    return typed_to_value(kind, number, value)
+
+
+def format_result(result):
+    """Форматирует результат формулы для сохранения в Cell.value"""
+    # Убираем лишние нули после запятой для целых чисел
+    if isinstance(result, float) and result.is_integer():
+        return str(int(result))
+    return str(result) if result is not None else ''
+
+
+class RangeValues:
+    """Значения непустых ячеек диапазона: массив float64 и маска числовых значений"""
+    
+    __slots__ = ('numbers', 'valid')
+    
+    def __init__(self, numbers, valid):
+        self.numbers = numbers
+        self.valid = valid
+    
+    def __len__(self):
+        return len(self.numbers)
+    
+    def numeric(self):
+        """Только числовые значения диапазона"""
+        if self.valid.all():
+            return self.numbers
+        return self.numbers[self.valid]
+
+
+def _empty_read():
+    return (
+        np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.float64), np.empty(0, dtype=bool),
+    )
+
+
+def _cell_keys(rows, columns):
+    """Один целочисленный ключ на ячейку (номера строк и колонок меньше 2**31)"""
+    return (rows << 31) | columns
+
+
+class SheetValues:
+    """
+    Значения непустых ячеек листа по колонкам: числа (column -> {row: float})
+    отдельно от текста и ошибок (column -> {row: строка}). Прямоугольник
+    читается по заполненным колонкам, массивы строк и чисел колонки
+    заполняются прямо из ее словаря (см. read).
+    """
+
+    __slots__ = ('numbers', 'texts', 'size')
+
+    def __init__(self):
+        self.numbers = {}
+        self.texts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        row, column = key
+        return row in self.numbers.get(column, ()) or row in self.texts.get(column, ())
+
+    def get(self, row, column, default=''):
+        cells = self.numbers.get(column)
+        if cells is not None and row in cells:
+            return cells[row]
+        cells = self.texts.get(column)
+        if cells is not None and row in cells:
+            return cells[row]
+        return default
+
+    def put(self, row, column, value):
+        """Записывает значение для вычислений (float или строка); пустое значение удаляет ячейку"""
+        self.discard(row, column)
+        if isinstance(value, float):
+            self.numbers.setdefault(column, {})[row] = value
+        elif value:
+            self.texts.setdefault(column, {})[row] = value
+        else:
+            return
+        self.size += 1
+
+    def discard(self, row, column):
+        for columns in (self.numbers, self.texts):
+            cells = columns.get(column)
+            if cells is not None and cells.pop(row, None) is not None:
+                self.size -= 1
+                if not cells:
+                    del columns[column]
+                return
+
+    def read(self, start_row, start_col, end_row, end_col):
+        """
+        Непустые ячейки прямоугольника (в порядке хранения): массивы номеров
+        строк, номеров колонок, чисел (NaN у текста) и маски числовых значений
+        """
+        parts = []
+        for columns, numeric in ((self.numbers, True), (self.texts, False)):
+            if end_col - start_col < len(columns):
+                selected = [column for column in range(start_col, end_col + 1) if column in columns]
+            else:
+                selected = [column for column in columns if start_col <= column <= end_col]
+            for column in selected:
+                cells = columns[column]
+                if (end_row - start_row + 1) * 4 < len(cells):
+                    # Узкий диапазон в длинной колонке: ищем его строки
+                    found = [row for row in range(start_row, end_row + 1) if row in cells]
+                    rows = np.array(found, dtype=np.int64)
+                    numbers = np.array([cells[row] for row in found] if numeric else (), dtype=np.float64)
+                else:
+                    rows = np.fromiter(cells.keys(), dtype=np.int64, count=len(cells))
+                    inside = (rows >= start_row) & (rows <= end_row)
+                    numbers = np.fromiter(cells.values(), dtype=np.float64, count=len(cells)) if numeric else None
+                    if not inside.all():
+                        rows = rows[inside]
+                        numbers = numbers[inside] if numeric else None
+                if not numeric:
+                    numbers = np.full(len(rows), np.nan)
+                parts.append((
+                    rows,
+                    np.full(len(rows), column, dtype=np.int64),
+                    numbers,
+                    np.full(len(rows), numeric, dtype=bool),
+                ))
+        if not parts:
+            return _empty_read()
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+class OverlayValues:
+    """
+    Значения листа для движка: общие (shared - SheetValues листа в памяти
+    процесса или загруженные движком из БД) и поверх них значения,
+    вычисленные движком (local). До фиксации транзакции вычисленное не
+    должно попадать в общие значения; cleared - очищенные движком ячейки.
+    """
+
+    __slots__ = ('shared', 'local', 'cleared')
+
+    def __init__(self, shared=None, local=None, cleared=None):
+        self.shared = SheetValues() if shared is None else shared
+        self.local = SheetValues() if local is None else local
+        self.cleared = set() if cleared is None else cleared
+
+    def __contains__(self, key):
+        return key in self.cleared or key in self.local or key in self.shared
+
+    def get(self, row, column, default=''):
+        if (row, column) in self.cleared:
+            return default
+        value = self.local.get(row, column, None)
+        if value is not None:
+            return value
+        return self.shared.get(row, column, default)
+
+    def put(self, row, column, value):
+        self.local.put(row, column, value)
+        if isinstance(value, float) or value:
+            self.cleared.discard((row, column))
+        else:
+            self.cleared.add((row, column))
+
+    def read(self, start_row, start_col, end_row, end_col):
+        """То же, что SheetValues.read, с учетом значений движка"""
+        rows, columns, numbers, valid = self.shared.read(start_row, start_col, end_row, end_col)
+        local = self.local.read(start_row, start_col, end_row, end_col)
+        cleared = [
+            (row, column) for row, column in self.cleared
+            if start_row <= row <= end_row and start_col <= column <= end_col
+        ]
+        if len(rows) and (len(local[0]) or cleared):
+            overridden = _cell_keys(local[0], local[1])
+            if cleared:
+                cleared = np.array(cleared, dtype=np.int64)
+                overridden = np.concatenate([overridden, _cell_keys(cleared[:, 0], cleared[:, 1])])
+            kept = ~np.isin(_cell_keys(rows, columns), overridden)
+            rows, columns, numbers, valid = rows[kept], columns[kept], numbers[kept], valid[kept]
+        if not len(local[0]):
+            return rows, columns, numbers, valid
+        return tuple(np.concatenate(arrays) for arrays in zip((rows, columns, numbers, valid), local))
 
 
 class FormulaEngine:
-    """Движок для вычисления формул"""
+    """Движок для вычисления формул
+    
+    Значения ячеек загружаются в self.cache пачками: перед вычислением формулы
+    все ее ссылки и диапазоны читаются одним запросом на каждый затронутый лист.
+    """
     
     def __init__(self, sheet):
         self.sheet = sheet
         self.spreadsheet = sheet.spreadsheet
+        # sheet_id -> OverlayValues значений ячеек листа
         self.cache = {}
+        # sheet_id -> список загруженных прямоугольников (row1, col1, row2, col2)
+        self._loaded = {}
+        self._sheets_by_name = None
     
     def get_cell_value(self, row, column, sheet=None):
         """Получить значение ячейки по координатам
@@ -19,332 +242,239 @@ class FormulaEngine:
             sheet: лист, из которого получать значение (по умолчанию self.sheet)
         """
         target_sheet = sheet or self.sheet
-        cache_key = f"{target_sheet.id}_{row}_{column}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
+        sheet_cache = self.cache.get(target_sheet.id)
+        if sheet_cache is not None and (row, column) in sheet_cache:
+            return sheet_cache.get(row, column)
         
-        try:
-            cell = Cell.objects.get(sheet=target_sheet, row=row, column=column)
-            value = cell.value
-            
-            # Если ячейка содержит формулу, возвращаем вычисленное значение
-            if cell.formula and value:
-                # Пытаемся преобразовать вычисленное значение в число
-                try:
-                    if not value.startswith('#ОШИБКА'):
-                        return float(value)
-                except (ValueError, AttributeError):
-                    pass
-            
-            # Пытаемся преобразовать в число
-            try:
-                if value and not value.startswith('=') and not value.startswith('#ОШИБКА'):
-                    return float(value)
-            except (ValueError, AttributeError):
-                pass
-            
-            return value or ''
-        except Cell.DoesNotExist:
-            return ''
+        self._load_rects(target_sheet, [(row, column, row, column)])
+        return self._sheet_cache(target_sheet.id).get(row, column)
+    
+    def _sheet_cache(self, sheet_id):
+        sheet_cache = self.cache.get(sheet_id)
+        if sheet_cache is None:
+            sheet_cache = self.cache[sheet_id] = OverlayValues()
+        return sheet_cache
+    
+    def remember_cell(self, cell):
+        """Обновляет кэш движка после сохранения ячейки"""
+        self.remember_value(cell.sheet_id, cell.row, cell.column, typed_to_value(cell.kind, cell.number, cell.value))
+    
+    def remember_value(self, sheet_id, row, column, value):
+        """Запоминает значение ячейки для вычислений (float или строка), записанное в этой транзакции"""
+        self._sheet_cache(sheet_id).put(row, column, value)
     
     def get_sheet_by_name(self, sheet_name):
         """Получить лист по имени в рамках текущей таблицы"""
-        try:
-            return Sheet.objects.get(spreadsheet=self.spreadsheet, name=sheet_name)
-        except Sheet.DoesNotExist:
-            return None
+        if self._sheets_by_name is None:
+            from .resident import get_resident
+            resident = get_resident(self.spreadsheet.id)
+            if resident is not None:
+                return resident.sheets_by_name.get(sheet_name)
+            self._sheets_by_name = {
+                sheet.name: sheet
+                for sheet in Sheet.objects.filter(spreadsheet=self.spreadsheet)
+            }
+        return self._sheets_by_name.get(sheet_name)
     
-    def evaluate(self, formula):
-        """Вычислить формулу"""
-        if not formula or not formula.startswith('='):
-            return formula
+    def prefetch(self, *compiled_formulas, sheet=None):
+        """Загружает все ячейки, на которые ссылаются формулы, одним запросом на лист
         
-        formula = formula[1:].strip()  # Убираем '='
+        Args:
+            compiled_formulas: скомпилированные формулы (compile_formula)
+            sheet: лист, относительно которого разрешаются ссылки без имени листа
+        """
+        base_sheet = sheet or self.sheet
+        rects_by_sheet = {}
+        for compiled in compiled_formulas:
+            for sheet_name, *rect in compiled.rects():
+                sheet = base_sheet if sheet_name is None else self.get_sheet_by_name(sheet_name)
+                if sheet:
+                    rects_by_sheet.setdefault(sheet, []).append(tuple(rect))
         
-        # Обработка функций с диапазонами (SUM(A1:A5), etc.)
-        formula = self._process_ranges(formula)
+        for sheet, rects in rects_by_sheet.items():
+            self._load_rects(sheet, rects)
+    
+    def _is_loaded(self, sheet_id, start_row, start_col, end_row, end_col):
+        """Проверяет, что прямоугольник целиком входит в один из загруженных"""
+        for r1, c1, r2, c2 in self._loaded.get(sheet_id, ()):
+            if r1 <= start_row and end_row <= r2 and c1 <= start_col and end_col <= c2:
+                return True
+        return False
+    
+    def _load_rects(self, sheet, rects):
+        """Загружает незагруженные прямоугольники листа одним запросом"""
+        if self._loaded.get(sheet.id) == [FULL_SHEET]:
+            return
         
-        # Обработка ссылок на ячейки (A1, B2, etc.)
-        formula = self._replace_cell_references(formula)
+        # Таблица с активными сессиями уже целиком в памяти процесса
+        from .resident import get_resident_sheet
+        resident_sheet = get_resident_sheet(sheet)
+        if resident_sheet is not None:
+            # Общие значения не меняются: значения этого прохода остаются у движка
+            sheet_cache = self._sheet_cache(sheet.id)
+            self.cache[sheet.id] = OverlayValues(resident_sheet.values, sheet_cache.local, sheet_cache.cleared)
+            self._loaded[sheet.id] = [FULL_SHEET]
+            return
         
-        # Обработка процентов (20% -> 0.2, 100 * 20% -> 100 * 0.2)
-        formula = self._process_percentages(formula)
+        rects = [rect for rect in set(rects) if not self._is_loaded(sheet.id, *rect)]
+        if not rects:
+            return
         
-        # Базовые математические операции
-        try:
-            # Безопасное вычисление
-            result = eval(formula, {"__builtins__": {}}, {
-                'SUM': self._sum,
-                'AVERAGE': self._average,
-                'MAX': self._max,
-                'MIN': self._min,
-                'COUNT': self._count,
-            })
-            # Форматируем результат: убираем лишние нули после запятой для целых чисел
-            if isinstance(result, float) and result.is_integer():
-                return str(int(result))
-            return str(result) if result is not None else ''
-        except ZeroDivisionError:
-            raise Exception("Деление на ноль")
-        except SyntaxError as e:
-            raise Exception(f"Синтаксическая ошибка в формуле: {str(e)}")
-        except Exception as e:
-            error_msg = str(e)
-            # Упрощаем сообщения об ошибках
-            if "invalid syntax" in error_msg.lower():
-                raise Exception("Неверный синтаксис формулы")
-            raise Exception(f"Ошибка вычисления: {error_msg}")
-    
-    def _process_ranges(self, formula):
-        """Обрабатывает диапазоны ячеек (A1:A5) в функциях, включая ссылки на другие листы (Sheet1!A1:A5)"""
-        def get_range_values(start_ref, end_ref, sheet=None):
-            """Получить значения из диапазона"""
-            start_row, start_col = self._parse_cell_ref(start_ref)
-            end_row, end_col = self._parse_cell_ref(end_ref)
-            
-            values = []
-            for row in range(start_row, end_row + 1):
-                for col in range(start_col, end_col + 1):
-                    value = self.get_cell_value(row, col, sheet=sheet)
-                    try:
-                        values.append(float(value))
-                    except (ValueError, TypeError):
-                        if value:
-                            values.append(value)
-            return values
+        if len(rects) > PREFETCH_MAX_RECTS:
+            rects = [(
+                min(rect[0] for rect in rects), min(rect[1] for rect in rects),
+                max(rect[2] for rect in rects), max(rect[3] for rect in rects),
+            )]
         
-        def parse_range(range_str):
-            """Парсит диапазон вида SheetName!A1:A5 или A1:A5"""
-            # Проверяем, есть ли ссылка на лист (поддерживаем кириллицу в именах листов)
-            sheet_match = re.match(r'([А-Яа-яA-Za-z0-9_]+)!([A-Z]+[0-9]+):([A-Z]+[0-9]+)', range_str, re.IGNORECASE)
-            if sheet_match:
-                sheet_name = sheet_match.group(1).strip()
-                start_ref = sheet_match.group(2)
-                end_ref = sheet_match.group(3)
-                sheet = self.get_sheet_by_name(sheet_name)
-                if not sheet:
-                    raise ValueError(f"Лист '{sheet_name}' не найден")
-                return start_ref, end_ref, sheet
-            else:
-                # Обычный диапазон без ссылки на лист
-                range_match = re.match(r'([A-Z]+[0-9]+):([A-Z]+[0-9]+)', range_str, re.IGNORECASE)
-                if range_match:
-                    return range_match.group(1), range_match.group(2), None
-                return None, None, None
+        condition = models.Q()
+        for r1, c1, r2, c2 in rects:
+            condition |= models.Q(row__range=(r1, r2), column__range=(c1, c2))
         
-        def replace_function(match):
-            func_str = match.group(0)
-            # Извлекаем имя функции
-            func_match = re.match(r'([A-Z]+)\((.+)\)', func_str, re.IGNORECASE)
-            if not func_match:
-                return func_str
-            
-            func_name = func_match.group(1).upper()
-            args_str = func_match.group(2)
-            
-            # Разбиваем аргументы по запятым, учитывая вложенные скобки
-            args = []
-            current_arg = ''
-            paren_depth = 0
-            
-            for char in args_str:
-                if char == '(':
-                    paren_depth += 1
-                    current_arg += char
-                elif char == ')':
-                    paren_depth -= 1
-                    current_arg += char
-                elif char == ',' and paren_depth == 0:
-                    args.append(current_arg.strip())
-                    current_arg = ''
-                else:
-                    current_arg += char
-            
-            if current_arg:
-                args.append(current_arg.strip())
-            
-            # Обрабатываем каждый аргумент
-            all_values = []
-            for arg in args:
-                arg = arg.strip()
-                # Проверяем, является ли аргумент диапазоном
-                if ':' in arg and re.search(r'[A-Z]+[0-9]+:[A-Z]+[0-9]+', arg, re.IGNORECASE):
-                    start_ref, end_ref, sheet = parse_range(arg)
-                    if start_ref and end_ref:
-                        range_values = get_range_values(start_ref, end_ref, sheet=sheet)
-                        all_values.extend(range_values)
-                else:
-                    # Это не диапазон, будет обработан позже в _replace_cell_references
-                    # Пока просто пропускаем
-                    pass
-            
-            # Вызываем соответствующую функцию
-            if func_name == 'SUM':
-                return str(self._sum(*all_values))
-            elif func_name == 'AVERAGE':
-                return str(self._average(*all_values))
-            elif func_name == 'MAX':
-                return str(self._max(*all_values))
-            elif func_name == 'MIN':
-                return str(self._min(*all_values))
-            elif func_name == 'COUNT':
-                return str(self._count(*all_values))
-            
-            return func_str
+        cells = Cell.objects.filter(condition, sheet=sheet).values_list(
+            'row', 'column', 'kind', 'number', 'value'
+        )
+        loaded = self._sheet_cache(sheet.id).shared
+        for row, column, kind, number, value in cells:
+            loaded.put(row, column, typed_to_value(kind, number, value))
         
-        # Паттерн для функций: SUM(...), AVERAGE(...), etc.
-        # Обрабатываем функции, которые могут содержать диапазоны
-        pattern = r'(SUM|AVERAGE|MAX|MIN|COUNT)\([^)]+\)'
-        return re.sub(pattern, replace_function, formula, flags=re.IGNORECASE)
+        self._loaded.setdefault(sheet.id, []).extend(rects)
     
-    def _replace_cell_references(self, formula):
-        """Заменяет ссылки на ячейки (A1, B2, Sheet1!A1) на их значения"""
-        def replace_ref(match):
-            ref_with_sheet = match.group(0)
-            
-            # Проверяем, есть ли ссылка на лист (SheetName!A1)
-            sheet_match = re.match(r'([^!]+)!([A-Z]+[0-9]+)', ref_with_sheet, re.IGNORECASE)
-            if sheet_match:
-                sheet_name = sheet_match.group(1).strip()
-                cell_ref = sheet_match.group(2)
-                sheet = self.get_sheet_by_name(sheet_name)
-                if not sheet:
-                    raise ValueError(f"Лист '{sheet_name}' не найден")
-            else:
-                cell_ref = ref_with_sheet
-                sheet = None
-            
-            row, column = self._parse_cell_ref(cell_ref)
-            target_sheet = sheet or self.sheet
-            
+    def evaluate(self, formula, sheet=None, compiled=None):
+        """Вычислить формулу
+        
+        Args:
+            formula: текст формулы
+            sheet: лист ячейки с формулой (по умолчанию self.sheet); ссылки без
+                имени листа читаются с него
+            compiled: уже скомпилированная формула (чтобы не разбирать ее повторно)
+        """
+        if not formula or not formula.startswith('='):
+            return formula
+        
+        if sheet is not None and sheet.id != self.sheet.id:
+            previous_sheet, self.sheet = self.sheet, sheet
             try:
-                cell = Cell.objects.get(sheet=target_sheet, row=row, column=column)
-                # Если ячейка содержит ошибку, выбрасываем исключение
-                if cell.value and cell.value.startswith('#ОШИБКА'):
-                    raise ValueError(f"Ячейка {ref_with_sheet} содержит ошибку")
-            except Cell.DoesNotExist:
-                pass
-            
-            value = self.get_cell_value(row, column, sheet=target_sheet)
-            
-            # Если значение пустое, возвращаем 0
-            if not value or value == '':
-                return '0'
-            
-            # Если значение содержит ошибку, выбрасываем исключение
-            if isinstance(value, str) and value.startswith('#ОШИБКА'):
-                raise ValueError(f"Ячейка {ref_with_sheet} содержит ошибку")
-            
-            # Пытаемся преобразовать в число
+                return self.evaluate(formula, compiled=compiled)
+            finally:
+                self.sheet = previous_sheet
+        
+        # Разбор формулы выполняется один раз, дальше берется из LRU-кэша
+        if compiled is None:
             try:
-                # Если это уже число (float), возвращаем строковое представление
-                if isinstance(value, (int, float)):
-                    return str(value)
-                # Пытаемся преобразовать строку в число
-                return str(float(value))
-            except (ValueError, TypeError):
-                # Если не число, возвращаем 0 для математических операций
-                return '0'
+                compiled = compile_formula(formula.strip())
+            except FormulaSyntaxError as e:
+                raise Exception(f"Синтаксическая ошибка в формуле: {str(e)}")
         
-        # Паттерн для ссылок на ячейки:
-        # 1. Ссылки на другие листы: SheetName!A1, Sheet1!B2, Лист2!A1, etc.
-        # 2. Обычные ссылки: A1, AA123, etc.
-        # Исключаем ссылки внутри функций с диапазонами (уже обработанных)
-        # Сначала обрабатываем ссылки с листами, потом обычные
-        # Паттерн для ссылок с листами: имя листа (может содержать кириллицу, латиницу, цифры, подчеркивания)![A-Z]+[0-9]+
-        # Имя листа может содержать буквы (включая кириллицу), цифры, подчеркивания, но не пробелы и операторы
-        pattern_with_sheet = r'([А-Яа-яA-Za-z0-9_]+)![A-Z]+[0-9]+(?![0-9:])'
-        formula = re.sub(pattern_with_sheet, replace_ref, formula, flags=re.IGNORECASE)
+        self.prefetch(compiled)
         
-        # Паттерн для обычных ссылок на ячейки (A1, AA123, etc.)
-        # Исключаем ссылки внутри функций с диапазонами
-        pattern = r'(?<!:)(?<!!)[A-Z]+[0-9]+(?![0-9:])'
-        formula = re.sub(pattern, replace_ref, formula, flags=re.IGNORECASE)
+        try:
+            result = compiled.evaluate(self)
+        except ZeroDivisionError:
+            raise Exception("Деление на ноль")
+        except ValueError:
+            # Ошибки ссылок (лист не найден, ячейка с ошибкой) передаем как есть
+            raise
+        except Exception as e:
+            raise Exception(f"Ошибка вычисления: {str(e)}")
         
-        return formula
+        return format_result(result)
     
-    def _process_percentages(self, formula):
-        """Обрабатывает проценты в формуле (20% -> 0.2, 100 * 20% -> 100 * 0.2)"""
-        def replace_percent(match):
-            """Заменяет число% на число/100"""
-            number_str = match.group(1)
-            try:
-                number = float(number_str)
-                return f"({number} / 100)"
-            except ValueError:
-                return match.group(0)  # Если не число, возвращаем как есть
-        
-        # Паттерн для процентов: число% (может быть с десятичной точкой, может быть отрицательным)
-        # Примеры: 20%, 15.5%, -10%, 0.5%
-        # Исключаем случаи, когда % уже обработан или является частью другого выражения
-        pattern = r'([-+]?\d+\.?\d*)\s*%'
-        return re.sub(pattern, replace_percent, formula)
+    def _resolve_sheet(self, sheet_name):
+        """Возвращает лист по имени из ссылки (None - текущий лист)"""
+        if sheet_name is None:
+            return self.sheet
+        sheet = self.get_sheet_by_name(sheet_name)
+        if not sheet:
+            raise ValueError(f"Лист '{sheet_name}' не найден")
+        return sheet
     
-    def _parse_cell_ref(self, ref):
-        """Парсит ссылку на ячейку (A1) в координаты (row, column)"""
-        ref = ref.upper()
-        match = re.match(r'([A-Z]+)([0-9]+)', ref)
-        if not match:
-            raise ValueError(f"Неверная ссылка на ячейку: {ref}")
+    def get_reference_value(self, sheet_name, row, column, ref_text):
+        """Значение ссылки на ячейку (A1, Sheet1!A1) в арифметическом выражении"""
+        value = self.get_cell_value(row, column, sheet=self._resolve_sheet(sheet_name))
         
-        col_str = match.group(1)
-        row = int(match.group(2))
+        # Если значение пустое, используем 0
+        if not value or value == '':
+            return 0.0
         
-        # Преобразование колонки (A=1, B=2, ..., Z=26, AA=27, etc.)
-        column = 0
-        for char in col_str:
-            column = column * 26 + (ord(char) - ord('A') + 1)
+        if isinstance(value, float):
+            return value
         
-        return row, column
+        # Если значение содержит ошибку, выбрасываем исключение
+        if isinstance(value, CellError):
+            raise ValueError(f"Ячейка {ref_text} содержит ошибку")
+        
+        # Если не число, используем 0 для математических операций
+        return 0.0
+    
+    def get_range_values(self, sheet_name, start_row, start_col, end_row, end_col):
+        """Получить значения из диапазона (A1:A5, Sheet1!A1:A5) в колоночном виде"""
+        return self.read_range(self._resolve_sheet(sheet_name), start_row, start_col, end_row, end_col)
+    
+    def read_range(self, sheet, start_row, start_col, end_row, end_col):
+        """Значения непустых ячеек прямоугольника листа sheet (RangeValues)"""
+        self._load_rects(sheet, [(start_row, start_col, end_row, end_col)])
+        
+        sheet_cache = self.cache.get(sheet.id)
+        if sheet_cache is None:
+            return RangeValues(np.empty(0, dtype=np.float64), np.empty(0, dtype=bool))
+        
+        # Перебираются только заполненные ячейки прямоугольника; порядок -
+        # по строкам, как при сложении в цикле
+        rows, columns, numbers, valid = sheet_cache.read(start_row, start_col, end_row, end_col)
+        if len(rows) > 1:
+            order = np.lexsort((columns, rows))
+            numbers = numbers[order]
+            valid = valid[order]
+        return RangeValues(numbers, valid)
+    
+    def _numeric_values(self, args):
+        """Собирает числовые значения аргументов функции в один массив (в порядке аргументов)"""
+        parts = []
+        scalars = []
+        for arg in args:
+            if isinstance(arg, RangeValues):
+                if scalars:
+                    parts.append(np.array(scalars, dtype=np.float64))
+                    scalars = []
+                parts.append(arg.numeric())
+            else:
+                try:
+                    scalars.append(float(arg))
+                except (ValueError, TypeError):
+                    pass
+        if scalars:
+            parts.append(np.array(scalars, dtype=np.float64))
+        if not parts:
+            return np.empty(0, dtype=np.float64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
     
     def _sum(self, *args):
         """Функция SUM"""
-        total = 0
-        for arg in args:
-            try:
-                total += float(arg)
-            except (ValueError, TypeError):
-                pass
-        return total
+        values = self._numeric_values(args)
+        if not values.size:
+            return 0
+        # Последовательное накопление дает тот же результат, что и сложение в цикле
+        return float(np.add.accumulate(values)[-1])
     
     def _average(self, *args):
         """Функция AVERAGE"""
-        values = []
-        for arg in args:
-            try:
-                values.append(float(arg))
-            except (ValueError, TypeError):
-                pass
-        return sum(values) / len(values) if values else 0
+        values = self._numeric_values(args)
+        if not values.size:
+            return 0
+        return float(np.add.accumulate(values)[-1]) / values.size
     
     def _max(self, *args):
         """Функция MAX"""
-        values = []
-        for arg in args:
-            try:
-                values.append(float(arg))
-            except (ValueError, TypeError):
-                pass
-        return max(values) if values else 0
+        values = self._numeric_values(args)
+        return float(values.max()) if values.size else 0
     
     def _min(self, *args):
         """Функция MIN"""
-        values = []
-        for arg in args:
-            try:
-                values.append(float(arg))
-            except (ValueError, TypeError):
-                pass
-        return min(values) if values else 0
+        values = self._numeric_values(args)
+        return float(values.min()) if values.size else 0
     
     def _count(self, *args):
         """Функция COUNT"""
-        count = 0
-        for arg in args:
-            try:
-                float(arg)
-                count += 1
-            except (ValueError, TypeError):
-                pass
-        return count
-
+        return int(self._numeric_values(args).size)
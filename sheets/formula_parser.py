@@ -0,0 +1,591 @@
+import re
+import operator
+from collections import namedtuple
+from functools import lru_cache
+
+
+# Максимальное число скомпилированных формул, которые держим в памяти
+FORMULA_CACHE_SIZE = 4096
+
+# Границы листа для ссылок на целые колонки (A:A) и строки (1:1)
+MAX_ROW = 2 ** 31 - 1
+MAX_COLUMN = 2 ** 31 - 1
+
+# Ссылка на удаленные ячейки (подставляется при удалении строк и колонок)
+INVALID_REFERENCE = '#ССЫЛКА!'
+
+# Имя листа в ссылке вида Лист2!A1 (кириллица, латиница, цифры, подчеркивания)
+SHEET_NAME_PATTERN = r'[А-Яа-яЁёA-Za-z0-9_]+'
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<invalid_ref>\#ССЫЛКА!)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<columns>(?:(?P<columns_sheet>''' + SHEET_NAME_PATTERN + r''')!)?
+        \$?(?P<first_col>[A-Za-z]+):\$?(?P<last_col>[A-Za-z]+)(?![\w(])
+    )
+  | (?P<rows>(?:(?P<rows_sheet>''' + SHEET_NAME_PATTERN + r''')!)?
+        \$?(?P<first_row>[0-9]+):\$?(?P<last_row>[0-9]+)(?![\w.(])
+    )
+  | (?P<ref>(?:(?P<sheet>''' + SHEET_NAME_PATTERN + r''')!)?
+        (?P<col_abs>\$?)(?P<col>[A-Za-z]+)(?P<row_abs>\$?)(?P<row>[0-9]+)(?![\w(])
+    )
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)
+  | (?P<op>\*\*|//|<=|>=|<>|==|!=|[-+*/^%(),:<>=])
+''', re.VERBOSE)
+
+
+class FormulaSyntaxError(ValueError):
+    """Ошибка разбора формулы"""
+
+
+Token = namedtuple('Token', ['kind', 'text', 'value'])
+
+# Узлы дерева формулы
+Number = namedtuple('Number', ['value'])
+String = namedtuple('String', ['value'])
+Ref = namedtuple('Ref', ['sheet', 'row', 'column', 'text'])
+Area = namedtuple('Area', ['sheet', 'start_row', 'start_column', 'end_row', 'end_column', 'text'])
+Call = namedtuple('Call', ['name', 'args'])
+BinOp = namedtuple('BinOp', ['op', 'left', 'right'])
+UnaryOp = namedtuple('UnaryOp', ['op', 'operand'])
+Percent = namedtuple('Percent', ['operand'])
+InvalidRef = namedtuple('InvalidRef', ['text'])
+
+
+# Поддерживаемые функции: имя в формуле -> метод FormulaEngine
+FUNCTIONS = {
+    'SUM': '_sum',
+    'AVERAGE': '_average',
+    'MAX': '_max',
+    'MIN': '_min',
+    'COUNT': '_count',
+}
+
+_BINARY_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '^': operator.pow,
+    '=': operator.eq,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+# Написания операторов в стиле Python -> обозначения в дереве формулы
+_OPERATOR_ALIASES = {'**': '^', '==': '=', '!=': '<>'}
+
+
+def column_to_index(col_str):
+    """Преобразование колонки (A=1, B=2, ..., Z=26, AA=27, etc.)"""
+    column = 0
+    for char in col_str.upper():
+        column = column * 26 + (ord(char) - ord('A') + 1)
+    return column
+
+
+def column_to_letters(column):
+    """Преобразует номер колонки в буквы (1=A, 27=AA, etc.)"""
+    col_str = ''
+    col = column
+    while col > 0:
+        col -= 1
+        col_str = chr(65 + (col % 26)) + col_str
+        col = col // 26
+    return col_str
+
+
+def tokenize(text):
+    """Разбивает текст формулы (без '=') на лексемы"""
+    tokens = []
+    pos = 0
+    length = len(text)
+    while pos < length:
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            raise FormulaSyntaxError(f"Неожиданный символ '{text[pos]}'")
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'ws':
+            continue
+        token_text = match.group(0)
+        if kind == 'ref':
+            value = (
+                match.group('sheet'),
+                int(match.group('row')),
+                column_to_index(match.group('col')),
+            )
+        elif kind == 'columns':
+            # Целые колонки A:C -> строки 1..MAX_ROW
+            first, last = column_to_index(match.group('first_col')), column_to_index(match.group('last_col'))
+            value = (match.group('columns_sheet'), 1, min(first, last), MAX_ROW, max(first, last))
+            kind = 'area'
+        elif kind == 'rows':
+            # Целые строки 1:3 -> колонки 1..MAX_COLUMN
+            first, last = int(match.group('first_row')), int(match.group('last_row'))
+            value = (match.group('rows_sheet'), min(first, last), 1, max(first, last), MAX_COLUMN)
+            kind = 'area'
+        elif kind == 'number':
+            value = float(token_text)
+        elif kind == 'string':
+            value = token_text[1:-1].replace('""', '"')
+        elif kind == 'name':
+            value = token_text.upper()
+        else:
+            value = _OPERATOR_ALIASES.get(token_text, token_text)
+        tokens.append(Token(kind, token_text, value))
+    return tokens
+
+
+class _Parser:
+    """Рекурсивный разбор списка лексем в дерево формулы"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.refs = []
+        self.areas = []
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise FormulaSyntaxError("Неожиданный конец формулы")
+        self.pos += 1
+        return token
+
+    def accept_op(self, *ops):
+        token = self.peek()
+        if token is not None and token.kind == 'op' and token.value in ops:
+            self.pos += 1
+            return token
+        return None
+
+    def expect_op(self, op):
+        if not self.accept_op(op):
+            token = self.peek()
+            found = token.text if token else 'конец формулы'
+            raise FormulaSyntaxError(f"Ожидалось '{op}', найдено '{found}'")
+
+    def parse(self):
+        node = self.comparison()
+        token = self.peek()
+        if token is not None:
+            raise FormulaSyntaxError(f"Лишний фрагмент '{token.text}'")
+        return node
+
+    def comparison(self):
+        # Сравнения - самый низкий приоритет: A1+1>B1 = (A1+1)>B1
+        node = self.expression()
+        while True:
+            token = self.accept_op('=', '<>', '<', '>', '<=', '>=')
+            if not token:
+                return node
+            node = BinOp(token.value, node, self.expression())
+
+    def expression(self):
+        node = self.term()
+        while True:
+            token = self.accept_op('+', '-')
+            if not token:
+                return node
+            node = BinOp(token.value, node, self.term())
+
+    def term(self):
+        node = self.factor()
+        while True:
+            token = self.accept_op('*', '/', '//')
+            if not token:
+                return node
+            node = BinOp(token.value, node, self.factor())
+
+    def factor(self):
+        token = self.accept_op('+', '-')
+        if token:
+            return UnaryOp(token.value, self.factor())
+        return self.power()
+
+    def power(self):
+        node = self.postfix()
+        if self.accept_op('^'):
+            # Возведение в степень правоассоциативно: 2^3^2 = 2^(3^2)
+            return BinOp('^', node, self.factor())
+        return node
+
+    def postfix(self):
+        node = self.primary()
+        while self.accept_op('%'):
+            node = Percent(node)
+        return node
+
+    def primary(self):
+        token = self.next()
+        if token.kind == 'number':
+            return Number(token.value)
+        if token.kind == 'string':
+            return String(token.value)
+        if token.kind == 'ref':
+            return self.reference(token)
+        if token.kind == 'area':
+            area = Area(*token.value, token.text)
+            self.areas.append(area)
+            return area
+        if token.kind == 'name':
+            return self.call(token)
+        if token.kind == 'invalid_ref':
+            return InvalidRef(token.text)
+        if token.kind == 'op' and token.value == '(':
+            node = self.comparison()
+            self.expect_op(')')
+            return node
+        raise FormulaSyntaxError(f"Неожиданный фрагмент '{token.text}'")
+
+    def reference(self, token):
+        sheet, row, column = token.value
+        if not self.accept_op(':'):
+            ref = Ref(sheet, row, column, token.text)
+            self.refs.append(ref)
+            return ref
+        end = self.next()
+        if end.kind != 'ref' or end.value[0] is not None:
+            raise FormulaSyntaxError(f"Неверный диапазон после '{token.text}:'")
+        _, end_row, end_column = end.value
+        area = Area(
+            sheet,
+            min(row, end_row), min(column, end_column),
+            max(row, end_row), max(column, end_column),
+            f'{token.text}:{end.text}',
+        )
+        self.areas.append(area)
+        return area
+
+    def call(self, token):
+        name = token.value
+        if name not in FUNCTIONS:
+            raise FormulaSyntaxError(f"Неизвестная функция {token.text}")
+        self.expect_op('(')
+        args = []
+        if not self.accept_op(')'):
+            args.append(self.comparison())
+            while self.accept_op(','):
+                args.append(self.comparison())
+            self.expect_op(')')
+        return Call(name, tuple(args))
+
+
+def _compile_node(node):
+    """Превращает узел дерева в замыкание fn(engine) -> значение"""
+    if isinstance(node, (Number, String)):
+        value = node.value
+        return lambda engine: value
+
+    if isinstance(node, Ref):
+        sheet, row, column, text = node
+        return lambda engine: engine.get_reference_value(sheet, row, column, text)
+
+    if isinstance(node, InvalidRef):
+        def invalid_ref(engine):
+            raise ValueError("Недействительная ссылка")
+        return invalid_ref
+
+    if isinstance(node, Area):
+        raise FormulaSyntaxError(f"Диапазон {node.text} допустим только как аргумент функции")
+
+    if isinstance(node, Call):
+        method_name = FUNCTIONS[node.name]
+        arg_fns = [_compile_argument(arg) for arg in node.args]
+
+        def call(engine):
+            values = []
+            for arg_fn in arg_fns:
+                arg_fn(engine, values)
+            return getattr(engine, method_name)(*values)
+        return call
+
+    if isinstance(node, BinOp):
+        op = _BINARY_OPERATORS[node.op]
+        left = _compile_node(node.left)
+        right = _compile_node(node.right)
+        return lambda engine: op(left(engine), right(engine))
+
+    if isinstance(node, UnaryOp):
+        operand = _compile_node(node.operand)
+        if node.op == '-':
+            return lambda engine: -operand(engine)
+        return lambda engine: +operand(engine)
+
+    if isinstance(node, Percent):
+        operand = _compile_node(node.operand)
+        return lambda engine: operand(engine) / 100
+
+    raise FormulaSyntaxError("Неизвестный элемент формулы")
+
+
+def _compile_argument(node):
+    """Замыкание для аргумента функции: добавляет значение аргумента (или диапазон) в список"""
+    if isinstance(node, Area):
+        sheet = node.sheet
+        bounds = (node.start_row, node.start_column, node.end_row, node.end_column)
+
+        def area_values(engine, values):
+            values.append(engine.get_range_values(sheet, *bounds))
+        return area_values
+
+    if isinstance(node, Ref):
+        sheet, row, column = node.sheet, node.row, node.column
+
+        def ref_values(engine, values):
+            values.append(engine.get_range_values(sheet, row, column, row, column))
+        return ref_values
+
+    fn = _compile_node(node)
+    return lambda engine, values: values.append(fn(engine))
+
+
+class CompiledFormula:
+    """Разобранная формула: дерево, ссылки и готовое к вызову замыкание"""
+
+    __slots__ = ('text', 'tree', 'refs', 'areas', '_fn')
+
+    def __init__(self, text, tree, refs, areas):
+        self.text = text
+        self.tree = tree
+        self.refs = tuple(refs)
+        self.areas = tuple(areas)
+        self._fn = _compile_node(tree)
+
+    def evaluate(self, engine):
+        """Вычисляет формулу, получая значения ячеек через engine"""
+        return self._fn(engine)
+
+    def rects(self):
+        """Все ссылки и диапазоны формулы как (лист, row1, col1, row2, col2)"""
+        rects = [(ref.sheet, ref.row, ref.column, ref.row, ref.column) for ref in self.refs]
+        rects.extend(
+            (area.sheet, area.start_row, area.start_column, area.end_row, area.end_column)
+            for area in self.areas
+        )
+        return rects
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(formula):
+    """Компилирует текст формулы (с '=' или без) один раз и кэширует результат"""
+    text = formula[1:] if formula.startswith('=') else formula
+    tokens = tokenize(text)
+    if not tokens:
+        raise FormulaSyntaxError("Пустая формула")
+    parser = _Parser(tokens)
+    tree = parser.parse()
+    return CompiledFormula(formula, tree, parser.refs, parser.areas)
+
+
+# Угол ссылки при переписывании формул: у ссылок на целые колонки row = None,
+# на целые строки - column = None
+Corner = namedtuple('Corner', ['row', 'column', 'row_absolute', 'column_absolute'])
+
+
+def _is_absolute(match, group):
+    """Стоит ли '$' перед группой регулярного выражения"""
+    start = match.start(group)
+    return start > 0 and match.string[start - 1] == '$'
+
+
+def _corner_text(corner):
+    text = ''
+    if corner.column is not None:
+        text += ('$' if corner.column_absolute else '') + column_to_letters(corner.column)
+    if corner.row is not None:
+        text += ('$' if corner.row_absolute else '') + str(corner.row)
+    return text
+
+
+def _range_end(matches, index):
+    """Индекс второй ссылки диапазона A1:B2, начинающегося с лексемы index, или None"""
+    position = index + 1
+    separators = 0
+    while position < len(matches):
+        kind = matches[position].lastgroup
+        if kind == 'ws':
+            position += 1
+        elif kind == 'op' and matches[position].group(0) == ':' and not separators:
+            separators += 1
+            position += 1
+        elif kind == 'ref' and separators and matches[position].group('sheet') is None:
+            return position
+        else:
+            return None
+    return None
+
+
+# Ссылка в тексте формулы: имя листа, углы, исходный текст и признак диапазона
+ReferencePiece = namedtuple('ReferencePiece', ['sheet', 'start', 'end', 'text', 'is_range'])
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _reference_pieces(formula):
+    """
+    Текст формулы (без '='), разбитый на куски: строки вне ссылок и ссылки
+    ReferencePiece. None, если текст не разбирается на лексемы.
+    """
+    text = formula[1:]
+    matches = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            return None
+        matches.append(match)
+        pos = match.end()
+
+    pieces = []
+    index = 0
+    while index < len(matches):
+        match = matches[index]
+        kind = match.lastgroup
+        last = index
+        if kind == 'ref':
+            sheet = match.group('sheet')
+            start = Corner(int(match.group('row')), column_to_index(match.group('col')),
+                           bool(match.group('row_abs')), bool(match.group('col_abs')))
+            end = start
+            last = _range_end(matches, index)
+            if last is None:
+                last = index
+            else:
+                end_match = matches[last]
+                end = Corner(int(end_match.group('row')), column_to_index(end_match.group('col')),
+                             bool(end_match.group('row_abs')), bool(end_match.group('col_abs')))
+        elif kind == 'columns':
+            sheet = match.group('columns_sheet')
+            start = Corner(None, column_to_index(match.group('first_col')), False, _is_absolute(match, 'first_col'))
+            end = Corner(None, column_to_index(match.group('last_col')), False, _is_absolute(match, 'last_col'))
+        elif kind == 'rows':
+            sheet = match.group('rows_sheet')
+            start = Corner(int(match.group('first_row')), None, _is_absolute(match, 'first_row'), False)
+            end = Corner(int(match.group('last_row')), None, _is_absolute(match, 'last_row'), False)
+        else:
+            pieces.append(match.group(0))
+            index += 1
+            continue
+        original = text[match.start():matches[last].end()]
+        pieces.append(ReferencePiece(sheet, start, end, original, kind != 'ref' or last != index))
+        index = last + 1
+    return tuple(pieces)
+
+
+def rewrite_references(formula, rewrite):
+    """
+    Переписывает ссылки в тексте формулы на уровне лексем; остальной текст
+    формулы (пробелы, строки, числа) сохраняется как есть.
+
+    rewrite(sheet, start, end) получает имя листа ссылки (None - без листа)
+    и углы Corner (у ссылки на одну ячейку start == end) и возвращает новые
+    углы (start, end) или None, если ссылка стала недействительной.
+    Текст, который не разбирается на лексемы, возвращается без изменений.
+    """
+    if not formula.startswith('='):
+        return formula
+    pieces = _reference_pieces(formula)
+    if pieces is None:
+        return formula
+
+    parts = ['=']
+    for piece in pieces:
+        if isinstance(piece, str):
+            parts.append(piece)
+            continue
+        rewritten = rewrite(piece.sheet, piece.start, piece.end)
+        if rewritten is None:
+            parts.append(INVALID_REFERENCE)
+        elif rewritten == (piece.start, piece.end):
+            parts.append(piece.text)
+        else:
+            new_start, new_end = rewritten
+            reference = _corner_text(new_start)
+            if piece.is_range:
+                reference += ':' + _corner_text(new_end)
+            parts.append(f'{piece.sheet}!{reference}' if piece.sheet else reference)
+    return ''.join(parts)
+
+
+def _shift_span(start, end, at, count):
+    """
+    Новые границы отрезка номеров [start, end] после вставки (count > 0) или
+    удаления (count < 0) номеров начиная с at; None - отрезок удален целиком.
+    """
+    if count > 0:
+        return (start + count if start >= at else start), (end + count if end >= at else end)
+    removed_end = at - count - 1
+    if start >= at and end <= removed_end:
+        return None
+    if start > removed_end:
+        start += count
+    elif start >= at:
+        start = at
+    if end > removed_end:
+        end += count
+    elif end >= at:
+        end = at - 1
+    return start, end
+
+
+def shift_references(formula, axis, at, count, sheets):
+    """
+    Сдвигает ссылки формулы при вставке (count > 0) или удалении (count < 0)
+    строк (axis='row') или колонок (axis='column'), начиная с номера at.
+    sheets - имена листов в ссылках, которые указывают на измененный лист
+    (None - ссылки без имени листа, если формула находится на нем же).
+    Ссылки на удаленные ячейки заменяются на INVALID_REFERENCE.
+    """
+    def rewrite(sheet, start, end):
+        first, last = getattr(start, axis), getattr(end, axis)
+        if sheet not in sheets or first is None:
+            return start, end
+        span = _shift_span(min(first, last), max(first, last), at, count)
+        if span is None:
+            return None
+        if first > last:
+            span = span[::-1]
+        return start._replace(**{axis: span[0]}), end._replace(**{axis: span[1]})
+
+    return rewrite_references(formula, rewrite)
+
+
+def _offset_corner(corner, rows, columns):
+    """Угол ссылки, сдвинутый на rows/columns по относительным частям; None - за границей листа"""
+    row, column = corner.row, corner.column
+    if row is not None and not corner.row_absolute:
+        row += rows
+        if row < 1:
+            return None
+    if column is not None and not corner.column_absolute:
+        column += columns
+        if column < 1:
+            return None
+    return corner._replace(row=row, column=column)
+
+
+def offset_references(formula, rows, columns):
+    """
+    Сдвигает относительные части ссылок формулы на rows строк и columns
+    колонок, как при копировании формулы в другую ячейку; части с '$' не
+    меняются. Ссылки, ушедшие за границу листа, заменяются на INVALID_REFERENCE.
+    """
+    def rewrite(sheet, start, end):
+        start, end = _offset_corner(start, rows, columns), _offset_corner(end, rows, columns)
+        if start is None or end is None:
+            return None
+        return start, end
+
+    return rewrite_references(formula, rewrite)
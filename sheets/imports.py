@@ -0,0 +1,71 @@
+import csv
+from django.db import transaction
+from django.utils import timezone
+from .models import Cell
+from .recalculation import recalculate_area
+
+
+# Размер пачки bulk_create при импорте (одна транзакция на пачку)
+IMPORT_CHUNK_SIZE = 5000
+
+# Поля, которые перезаписываются у уже существующих ячеек
+IMPORT_UPDATE_FIELDS = ['value', 'formula', *Cell.TYPED_FIELDS, 'updated_at']
+
+
+def import_csv(sheet, lines, start_row=1, start_column=1, delimiter=',', chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Потоково импортирует CSV в лист, начиная с ячейки (start_row, start_column).
+
+    lines - итерируемый источник строк (открытый текстовый файл). Строки
+    читаются по одной, ячейки записываются пачками по chunk_size в отдельных
+    транзакциях, поэтому память не зависит от размера файла. Пустые поля
+    пропускаются, существующие ячейки перезаписываются (стиль сохраняется).
+    Поля, начинающиеся с '=', сохраняются как формулы и вычисляются один раз
+    после загрузки всех данных в порядке зависимостей.
+
+    Возвращает словарь со статистикой: rows, cells, formulas.
+    """
+    reader = csv.reader(lines, delimiter=delimiter)
+    chunk = []
+    rows = cells = formulas = 0
+    end_row = start_row - 1
+    end_column = start_column
+
+    for row_offset, fields in enumerate(reader):
+        row = start_row + row_offset
+        rows += 1
+        for column_offset, field in enumerate(fields):
+            if field == '':
+                continue
+            column = start_column + column_offset
+            if field.startswith('='):
+                chunk.append(Cell(sheet=sheet, row=row, column=column, value='', formula=field, style={}))
+                formulas += 1
+            else:
+                chunk.append(Cell(sheet=sheet, row=row, column=column, value=field, formula='', style={}))
+            end_row = row
+            end_column = max(end_column, column)
+        if len(chunk) >= chunk_size:
+            cells += _write_chunk(chunk)
+            chunk = []
+    if chunk:
+        cells += _write_chunk(chunk)
+
+    if cells:
+        recalculate_area(sheet, (start_row, start_column, end_row, end_column))
+    return {'rows': rows, 'cells': cells, 'formulas': formulas}
+
+
+def _write_chunk(chunk):
+    """Записывает пачку ячеек (новые вставляются, существующие обновляются)"""
+    now = timezone.now()
+    for cell in chunk:
+        cell.updated_at = now
+    with transaction.atomic():
+        Cell.objects.bulk_create(
+            chunk,
+            update_conflicts=True,
+            unique_fields=['sheet', 'row', 'column'],
+            update_fields=IMPORT_UPDATE_FIELDS,
+        )
+    return len(chunk)
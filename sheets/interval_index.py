@@ -0,0 +1,190 @@
+import random
+
+
+class _Node:
+    """Узел декартова дерева интервалов"""
+
+    __slots__ = ('key', 'start', 'end', 'value', 'priority', 'left', 'right', 'max_end')
+
+    def __init__(self, start, end, value):
+        self.key = (start, end, value)
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+    def update(self):
+        max_end = self.end
+        if self.left is not None and self.left.max_end > max_end:
+            max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > max_end:
+            max_end = self.right.max_end
+        self.max_end = max_end
+
+
+def _rotate_right(node):
+    left = node.left
+    node.left = left.right
+    left.right = node
+    node.update()
+    left.update()
+    return left
+
+
+def _rotate_left(node):
+    right = node.right
+    node.right = right.left
+    right.left = node
+    node.update()
+    right.update()
+    return right
+
+
+def _insert(node, new):
+    if node is None:
+        return new
+    if new.key < node.key:
+        node.left = _insert(node.left, new)
+        if node.left.priority > node.priority:
+            node = _rotate_right(node)
+    else:
+        node.right = _insert(node.right, new)
+        if node.right.priority > node.priority:
+            node = _rotate_left(node)
+    node.update()
+    return node
+
+
+def _delete(node, key):
+    if node is None:
+        return None, False
+    if key < node.key:
+        node.left, removed = _delete(node.left, key)
+    elif key > node.key:
+        node.right, removed = _delete(node.right, key)
+    else:
+        if node.left is None:
+            return node.right, True
+        if node.right is None:
+            return node.left, True
+        if node.left.priority > node.right.priority:
+            node = _rotate_right(node)
+            node.right, removed = _delete(node.right, key)
+        else:
+            node = _rotate_left(node)
+            node.left, removed = _delete(node.left, key)
+    node.update()
+    return node, removed
+
+
+class IntervalTree:
+    """
+    Дерево интервалов [start, end] со значениями (декартово дерево по start,
+    дополненное максимумом end в поддереве).
+
+    Вставка и удаление за O(log n), поиск всех интервалов, содержащих точку,
+    за O(log n + k). Значения должны быть сравнимы между собой.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, start, end, value):
+        self._root = _insert(self._root, _Node(start, end, value))
+        self._size += 1
+
+    def remove(self, start, end, value):
+        self._root, removed = _delete(self._root, (start, end, value))
+        if removed:
+            self._size -= 1
+        return removed
+
+    def stab(self, point):
+        """Значения всех интервалов, содержащих point"""
+        result = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.max_end < point:
+                continue
+            if node.left is not None:
+                stack.append(node.left)
+            if node.start <= point:
+                if point <= node.end:
+                    result.append(node.value)
+                if node.right is not None:
+                    stack.append(node.right)
+        return result
+
+
+class RectangleIndex:
+    """
+    Двумерный индекс прямоугольников (row1, col1, row2, col2) с ключами.
+
+    Внешнее дерево интервалов по колонкам хранит различные колоночные
+    отрезки, для каждого из них - дерево интервалов по строкам. Поиск
+    прямоугольников, покрывающих ячейку, стоит O(log n + m log n + k), где m -
+    число различных колоночных отрезков, содержащих колонку (для типичных
+    формул вида SUM(X1:X50000) это единицы).
+    """
+
+    def __init__(self):
+        self._columns = IntervalTree()
+        # (col1, col2) -> дерево интервалов строк с ключами
+        self._rows = {}
+        # ключ -> множество его прямоугольников
+        self._rects = {}
+
+    def __len__(self):
+        return sum(len(rects) for rects in self._rects.values())
+
+    def __contains__(self, key):
+        return key in self._rects
+
+    def add(self, key, start_row, start_column, end_row, end_column):
+        rect = (start_row, start_column, end_row, end_column)
+        rects = self._rects.setdefault(key, set())
+        if rect in rects:
+            return
+        rects.add(rect)
+
+        span = (start_column, end_column)
+        rows = self._rows.get(span)
+        if rows is None:
+            rows = self._rows[span] = IntervalTree()
+            self._columns.add(start_column, end_column, span)
+        rows.add(start_row, end_row, key)
+
+    def remove(self, key):
+        """Удаляет все прямоугольники ключа"""
+        for start_row, start_column, end_row, end_column in self._rects.pop(key, ()):
+            span = (start_column, end_column)
+            rows = self._rows[span]
+            rows.remove(start_row, end_row, key)
+            if not len(rows):
+                del self._rows[span]
+                self._columns.remove(start_column, end_column, span)
+
+    def keys(self):
+        """Ключи, у которых есть прямоугольники"""
+        return self._rects.keys()
+
+    def items(self):
+        """Пары (ключ, прямоугольник) всех прямоугольников индекса"""
+        for key, rects in self._rects.items():
+            for rect in rects:
+                yield key, rect
+
+    def find(self, row, column):
+        """Ключи прямоугольников, содержащих ячейку (row, column)"""
+        keys = set()
+        for span in self._columns.stab(column):
+            keys.update(self._rows[span].stab(row))
+        return keys
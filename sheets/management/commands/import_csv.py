@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from sheets.models import Sheet
+from sheets.imports import import_csv, IMPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Потоковый импорт CSV-файла в лист таблицы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheet_id', type=int, help='id листа')
+        parser.add_argument('path', help='путь к CSV-файлу')
+        parser.add_argument('--start-row', type=int, default=1, help='строка левого верхнего угла')
+        parser.add_argument('--start-column', type=int, default=1, help='колонка левого верхнего угла')
+        parser.add_argument('--delimiter', default=',', help='разделитель полей')
+        parser.add_argument('--encoding', default='utf-8-sig', help='кодировка файла')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='размер пачки записи')
+
+    def handle(self, *args, **options):
+        try:
+            sheet = Sheet.objects.get(id=options['sheet_id'])
+        except Sheet.DoesNotExist:
+            raise CommandError(f"Лист {options['sheet_id']} не найден")
+
+        with open(options['path'], encoding=options['encoding'], newline='') as lines:
+            result = import_csv(
+                sheet,
+                lines,
+                start_row=options['start_row'],
+                start_column=options['start_column'],
+                delimiter=options['delimiter'],
+                chunk_size=options['chunk_size'],
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано строк: {result['rows']}, ячеек: {result['cells']}, формул: {result['formulas']}"
+        ))
@@ -0,0 +1,128 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:38
+
+import re
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Разбор ссылок формулы в синтаксисе на момент миграции (копия из formula_parser,
+# чтобы повтор миграции не зависел от текущего кода приложения)
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<ref>(?:(?P<sheet>[А-Яа-яЁёA-Za-z0-9_]+)!)?
+        \$?(?P<col>[A-Za-z]+)\$?(?P<row>[0-9]+)(?![\w(])
+    )
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)
+  | (?P<op>\*\*|//|<=|>=|<>|==|!=|[-+*/^%(),:<>=])
+''', re.VERBOSE)
+
+_FUNCTIONS = {'SUM', 'AVERAGE', 'MAX', 'MIN', 'COUNT'}
+
+
+def _column_to_index(letters):
+    column = 0
+    for char in letters.upper():
+        column = column * 26 + (ord(char) - ord('A') + 1)
+    return column
+
+
+def _formula_rects(formula):
+    """
+    Прямоугольники (лист или None, row1, col1, row2, col2) ссылок формулы;
+    при ошибке разбора - пусто. Разбор проще полного: лишний прямоугольник
+    в индексе дает только лишний пересчет.
+    """
+    text = formula.strip()[1:]
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            return set()
+        pos = match.end()
+        if match.lastgroup == 'name' and match.group(0).upper() not in _FUNCTIONS:
+            return set()
+        if match.lastgroup == 'ref':
+            tokens.append(('ref', (match.group('sheet'), int(match.group('row')), _column_to_index(match.group('col')))))
+        elif match.lastgroup != 'ws':
+            tokens.append((match.lastgroup, match.group(0)))
+
+    rects = set()
+    index = 0
+    while index < len(tokens):
+        kind, value = tokens[index]
+        if kind == 'ref':
+            sheet, row, column = value
+            end_row, end_column = row, column
+            # Диапазон A1:B2 (у второй ссылки лист не указывается)
+            if index + 1 < len(tokens) and tokens[index + 1] == ('op', ':'):
+                if index + 2 >= len(tokens) or tokens[index + 2][0] != 'ref':
+                    return set()
+                _, end_row, end_column = tokens[index + 2][1]
+                index += 2
+            rects.add((
+                sheet,
+                min(row, end_row), min(column, end_column),
+                max(row, end_row), max(column, end_column),
+            ))
+        index += 1
+    return rects
+
+
+def build_dependencies(apps, schema_editor):
+    """Заполняет индекс зависимостей для уже существующих формул"""
+    Cell = apps.get_model('sheets', 'Cell')
+    Sheet = apps.get_model('sheets', 'Sheet')
+    CellDependency = apps.get_model('sheets', 'CellDependency')
+
+    sheets = {}
+    for sheet_id, spreadsheet_id, name in Sheet.objects.values_list('id', 'spreadsheet_id', 'name'):
+        sheets[sheet_id] = spreadsheet_id
+        sheets[(spreadsheet_id, name)] = sheet_id
+
+    dependencies = []
+    formula_cells = Cell.objects.exclude(formula='').values_list('id', 'sheet_id', 'formula')
+    for cell_id, sheet_id, formula in formula_cells.iterator():
+        if not formula.startswith('='):
+            continue
+        for sheet_name, start_row, start_column, end_row, end_column in _formula_rects(formula):
+            target_id = sheet_id if sheet_name is None else sheets.get((sheets[sheet_id], sheet_name))
+            if target_id is None:
+                continue
+            dependencies.append(CellDependency(
+                cell_id=cell_id,
+                sheet_id=target_id,
+                start_row=start_row,
+                start_column=start_column,
+                end_row=end_row,
+                end_column=end_column,
+            ))
+    CellDependency.objects.bulk_create(dependencies, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheets', '0002_spreadsheet_owner_spreadsheet_shared_with'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CellDependency',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_row', models.IntegerField()),
+                ('start_column', models.IntegerField()),
+                ('end_row', models.IntegerField()),
+                ('end_column', models.IntegerField()),
+                ('cell', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='sheets.cell')),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependents', to='sheets.sheet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sheet', 'start_row', 'start_column'], name='sheets_cell_sheet_i_53b7f8_idx')],
+            },
+        ),
+        migrations.RunPython(build_dependencies, migrations.RunPython.noop),
+    ]
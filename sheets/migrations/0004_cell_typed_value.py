@@ -0,0 +1,73 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:50
+
+from django.db import migrations, models
+
+
+# Классификация значения на момент миграции (копия из models, чтобы повтор
+# миграции не зависел от текущего кода приложения)
+ERROR_PREFIX = '#ОШИБКА'
+
+ERROR_CODES = (
+    ('Деление на ноль', 'div0'),
+    ('Циклическая ссылка', 'circular'),
+    ('Синтаксическая ошибка', 'syntax'),
+    ('Лист ', 'sheet'),
+    ('Ячейка ', 'ref'),
+)
+
+
+def classify_value(value):
+    """(тип, число, код ошибки) сохраненного значения ячейки"""
+    if not value:
+        return 'empty', None, ''
+    if value.startswith(ERROR_PREFIX):
+        message = value[len(ERROR_PREFIX):].lstrip(': ')
+        for prefix, code in ERROR_CODES:
+            if message.startswith(prefix):
+                return 'error', None, code
+        return 'error', None, 'eval'
+    try:
+        return 'number', float(value), ''
+    except ValueError:
+        return 'text', None, ''
+
+
+def fill_typed_values(apps, schema_editor):
+    """Заполняет типизированное значение для уже существующих ячеек"""
+    Cell = apps.get_model('sheets', 'Cell')
+
+    batch = []
+    for cell in Cell.objects.exclude(value='').only('id', 'value').iterator(chunk_size=2000):
+        cell.kind, cell.number, cell.error = classify_value(cell.value)
+        batch.append(cell)
+        if len(batch) >= 2000:
+            Cell.objects.bulk_update(batch, ['kind', 'number', 'error'])
+            batch = []
+    if batch:
+        Cell.objects.bulk_update(batch, ['kind', 'number', 'error'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheets', '0003_celldependency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cell',
+            name='error',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='kind',
+            field=models.CharField(choices=[('empty', 'Пусто'), ('number', 'Число'), ('text', 'Текст'), ('error', 'Ошибка')], default='empty', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='cell',
+            name='number',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_typed_values, migrations.RunPython.noop),
+    ]
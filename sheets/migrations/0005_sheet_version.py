@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheets', '0004_cell_typed_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheet',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
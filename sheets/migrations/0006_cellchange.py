@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheets', '0005_sheet_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spreadsheet',
+            name='sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='CellChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('row', models.IntegerField()),
+                ('column', models.IntegerField()),
+                ('sequence', models.PositiveBigIntegerField()),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cell_changes', to='sheets.sheet')),
+                ('spreadsheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cell_changes', to='sheets.spreadsheet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['spreadsheet', 'sequence'], name='sheets_cell_spreads_7105f6_idx')],
+                'unique_together': {('sheet', 'row', 'column')},
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+import threading
+from django.db import connections, models, transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -10,6 +11,8 @@ class Spreadsheet(models.Model):
     shared_with = models.ManyToManyField(User, related_name='shared_spreadsheets', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Порядковый номер последнего изменения ячеек таблицы (см. record_cell_changes)
+    sequence = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         ordering = ['-updated_at']
@@ -32,6 +35,8 @@ class Sheet(models.Model):
     spreadsheet = models.ForeignKey(Spreadsheet, on_delete=models.CASCADE, related_name='sheets')
     name = models.CharField(max_length=255, default='Лист1')
     order = models.IntegerField(default=0)
+    # Счетчик изменений ячеек листа (для ETag снимка, см. bump_sheet_versions)
+    version = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         ordering = ['order']
@@ -41,6 +46,266 @@ class Sheet(models.Model):
         return f"{self.spreadsheet.name} - {self.name}"
 
 
+def bump_sheet_versions(sheet_ids):
+    """Увеличивает счетчик изменений листов (одним UPDATE)"""
+    sheet_ids = set(sheet_ids)
+    if sheet_ids:
+        Sheet.objects.filter(id__in=sheet_ids).update(version=models.F('version') + 1)
+
+
+def awaits_commit(callback):
+    """
+    Ждет ли callback, зарегистрированный в transaction.on_commit, фиксации
+    текущей транзакции. После фиксации или отката (в том числе точки
+    сохранения, где он зарегистрирован) - False.
+    """
+    connection = transaction.get_connection()
+    return connection.in_atomic_block and any(entry[1] is callback for entry in connection.run_on_commit)
+
+
+# Номера изменений, выданные текущей транзакции потока (см. record_cell_changes)
+_transaction_changes = threading.local()
+
+
+class _TransactionChanges:
+    """Номера изменений транзакции: sheet_id -> (spreadsheet_id, номер) листов с увеличенной версией"""
+
+    __slots__ = ('sequences', 'committed')
+
+    def __init__(self):
+        self.sequences = {}
+        # Обработчик фиксации транзакции (см. _current_changes)
+        self.committed = None
+
+
+def _current_changes():
+    """Номера изменений текущей транзакции; после ее фиксации или отката начинаются заново"""
+    current = getattr(_transaction_changes, 'current', None)
+    if current is None or not awaits_commit(current.committed):
+        current = _transaction_changes.current = _TransactionChanges()
+        current.committed = lambda: _changes_committed(current)
+        transaction.on_commit(current.committed)
+    return current
+
+
+def transaction_sequences():
+    """Номера изменений, выданные незафиксированной транзакции потока: {spreadsheet_id: номер}"""
+    current = getattr(_transaction_changes, 'current', None)
+    if current is None or not awaits_commit(current.committed):
+        return {}
+    return dict(current.sequences.values())
+
+
+def _changes_committed(current):
+    if getattr(_transaction_changes, 'current', None) is current:
+        _transaction_changes.current = None
+    from .changes import advance_checked_sequences
+    advance_checked_sequences(dict(current.sequences.values()))
+
+
+def record_cell_changes(coordinates):
+    """
+    Фиксирует изменение ячеек, заданных кортежами (sheet_id, row, column),
+    в той же транзакции, что и сами изменения. Версии листов и номер
+    изменений таблицы увеличиваются один раз за транзакцию, при первой
+    записи ячеек листа; следующие записи транзакции попадают в журнал
+    CellChange с тем же номером. После фиксации номер отмечается как
+    учтенный кэшами процесса (см. changes.check_caches).
+    """
+    coordinates = set(coordinates)
+    if not coordinates:
+        return
+    with transaction.atomic(savepoint=False):
+        current = _current_changes()
+        sheet_ids = {sheet_id for sheet_id, row, column in coordinates} - current.sequences.keys()
+        if sheet_ids:
+            bump_sheet_versions(sheet_ids)
+            # Номер выдается под блокировкой строки таблицы до конца транзакции,
+            # поэтому изменения фиксируются в порядке их номеров
+            numbered = {spreadsheet_id for spreadsheet_id, sequence in current.sequences.values()}
+            Spreadsheet.objects.filter(sheets__id__in=sheet_ids).exclude(id__in=numbered).update(
+                sequence=models.F('sequence') + 1
+            )
+            sheets = Sheet.objects.filter(id__in=sheet_ids).values_list('id', 'spreadsheet_id', 'spreadsheet__sequence')
+            for sheet_id, spreadsheet_id, sequence in sheets:
+                current.sequences[sheet_id] = (spreadsheet_id, sequence)
+
+        sequences = current.sequences
+        CellChange.objects.bulk_create(
+            [
+                CellChange(
+                    spreadsheet_id=sequences[sheet_id][0],
+                    sheet_id=sheet_id,
+                    row=row,
+                    column=column,
+                    sequence=sequences[sheet_id][1],
+                )
+                for sheet_id, row, column in coordinates
+                if sheet_id in sequences
+            ],
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['sheet', 'row', 'column'],
+            update_fields=['sequence'],
+        )
+
+
+def _coordinates(cells):
+    return ((cell.sheet_id, cell.row, cell.column) for cell in cells)
+
+
+# Префикс значения ячейки с ошибкой вычисления
+ERROR_PREFIX = '#ОШИБКА'
+
+# Коды ошибок по началу текста сообщения (после "#ОШИБКА: ")
+ERROR_CODES = (
+    ('Деление на ноль', 'div0'),
+    ('Циклическая ссылка', 'circular'),
+    ('Синтаксическая ошибка', 'syntax'),
+    ('Лист ', 'sheet'),
+    ('Ячейка ', 'ref'),
+    ('Недействительная ссылка', 'ref'),
+)
+
+
+class ValueKind(models.TextChoices):
+    """Тип значения ячейки"""
+    EMPTY = 'empty', 'Пусто'
+    NUMBER = 'number', 'Число'
+    TEXT = 'text', 'Текст'
+    ERROR = 'error', 'Ошибка'
+
+
+def classify_value(value):
+    """Возвращает (тип, число, код ошибки) для сохраненного значения ячейки"""
+    value = '' if value is None else str(value)
+    if not value:
+        return ValueKind.EMPTY, None, ''
+    if value.startswith(ERROR_PREFIX):
+        message = value[len(ERROR_PREFIX):].lstrip(': ')
+        for prefix, code in ERROR_CODES:
+            if message.startswith(prefix):
+                return ValueKind.ERROR, None, code
+        return ValueKind.ERROR, None, 'eval'
+    try:
+        return ValueKind.NUMBER, float(value), ''
+    except ValueError:
+        return ValueKind.TEXT, None, ''
+
+
+class CellQuerySet(models.QuerySet):
+    """
+    Заполняет типизированное значение ячеек и при массовой записи, а также
+    фиксирует изменение затронутых ячеек в той же транзакции (см. record_cell_changes).
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for cell in objs:
+            cell.update_typed_value()
+        with transaction.atomic(using=self.db, savepoint=False):
+            result = super().bulk_create(objs, *args, **kwargs)
+            record_cell_changes(_coordinates(objs))
+        return result
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if 'value' in fields:
+            for cell in objs:
+                cell.update_typed_value()
+            fields = [*fields, *(field for field in Cell.TYPED_FIELDS if field not in fields)]
+        with transaction.atomic(using=self.db, savepoint=False):
+            result = super().bulk_update(objs, fields, *args, **kwargs)
+            record_cell_changes(_coordinates(objs))
+        return result
+
+    def update(self, **kwargs):
+        with transaction.atomic(using=self.db, savepoint=False):
+            coordinates = list(self.values_list('sheet_id', 'row', 'column'))
+            result = super().update(**kwargs)
+            record_cell_changes(coordinates)
+        return result
+
+    def delete(self):
+        with transaction.atomic(using=self.db, savepoint=False):
+            coordinates = list(self.values_list('sheet_id', 'row', 'column'))
+            result = super().delete()
+            record_cell_changes(coordinates)
+        return result
+
+    def shift(self, field, offset):
+        """
+        Сдвигает ячейки на offset по номеру строки (field='row') или колонки
+        (field='column') двумя UPDATE без нарушения уникальности
+        (sheet, row, column): сначала в отрицательные номера, затем обратно.
+        В журнале изменений листы отмечаются целиком (см. CellChange).
+        """
+        sheet_ids = set(self.values_list('sheet_id', flat=True).distinct())
+        if not sheet_ids:
+            return 0
+        with transaction.atomic():
+            count = super().update(**{field: -(models.F(field) + offset)})
+            moved = Cell.objects.filter(sheet_id__in=sheet_ids, **{f'{field}__lt': 0})
+            super(CellQuerySet, moved).update(**{field: -models.F(field)})
+            record_cell_changes((sheet_id, 0, 0) for sheet_id in sheet_ids)
+        return count
+
+    def bulk_write(self, objs, fields, batch_size=1000):
+        """
+        Записывает поля уже сохраненных ячеек (с id) одним
+        UPDATE ... FROM (VALUES ...) на пачку. На больших пачках это на порядок
+        быстрее bulk_update, который строит CASE WHEN на каждое поле каждой
+        ячейки. Строки только обновляются: ячейки, которых уже нет в БД,
+        пропускаются, а не создаются заново. updated_at обновляется всегда.
+        Возвращает число обновленных строк.
+        """
+        objs = [cell for cell in objs if cell.pk is not None]
+        if not objs:
+            return 0
+        fields = [*fields, *(field for field in ('updated_at',) if field not in fields)]
+        if 'value' in fields:
+            fields += [field for field in Cell.TYPED_FIELDS if field not in fields]
+        now = timezone.now()
+        for cell in objs:
+            cell.updated_at = now
+            if 'value' in fields:
+                cell.update_typed_value()
+
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        meta = self.model._meta
+        model_fields = [meta.get_field(field) for field in fields]
+        table = quote(meta.db_table)
+        # В VALUES столбцы безымянные: column1 - id, дальше поля по порядку
+        assignments = ', '.join(
+            f'{quote(field.column)} = v.column{position}'
+            for position, field in enumerate(model_fields, 2)
+        )
+        row = '(' + ', '.join(['%s'] * (len(model_fields) + 1)) + ')'
+        size = max(1, min(batch_size, connection.ops.bulk_batch_size([meta.pk, *model_fields], objs)))
+
+        count = 0
+        with transaction.atomic(using=self.db, savepoint=False), connection.cursor() as cursor:
+            for start in range(0, len(objs), size):
+                batch = objs[start:start + size]
+                params = []
+                for cell in batch:
+                    params.append(cell.pk)
+                    params.extend(
+                        field.get_db_prep_save(getattr(cell, field.attname), connection)
+                        for field in model_fields
+                    )
+                cursor.execute(
+                    f'UPDATE {table} SET {assignments} '
+                    f'FROM (VALUES {", ".join([row] * len(batch))}) AS v '
+                    f'WHERE {table}.{quote(meta.pk.column)} = v.column1',
+                    params,
+                )
+                count += cursor.rowcount
+            record_cell_changes(_coordinates(objs))
+        return count
+
+
 class Cell(models.Model):
     """Модель ячейки"""
     sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE, related_name='cells')
@@ -49,9 +314,18 @@ class Cell(models.Model):
     value = models.TextField(blank=True, default='')
     formula = models.TextField(blank=True, default='')
     style = models.JSONField(default=dict, blank=True)
+    # Типизированное значение, заполняется при записи из value (см. update_typed_value)
+    kind = models.CharField(max_length=8, choices=ValueKind.choices, default=ValueKind.EMPTY)
+    number = models.FloatField(null=True, blank=True)
+    error = models.CharField(max_length=16, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CellQuerySet.as_manager()
+
+    # Поля типизированного значения, записываются вместе с value
+    TYPED_FIELDS = ['kind', 'number', 'error']
+
     class Meta:
         unique_together = ['sheet', 'row', 'column']
         indexes = [
@@ -61,3 +335,66 @@ class Cell(models.Model):
     def __str__(self):
         return f"{self.sheet.name}[{self.row},{self.column}]"
 
+    def update_typed_value(self):
+        """Заполняет kind, number и error по value (числа из JSON приводятся к строке)"""
+        if not isinstance(self.value, str):
+            self.value = '' if self.value is None else str(self.value)
+        self.kind, self.number, self.error = classify_value(self.value)
+
+    def save(self, *args, **kwargs):
+        self.update_typed_value()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'value' in update_fields:
+            kwargs['update_fields'] = {*update_fields, *self.TYPED_FIELDS}
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            record_cell_changes([(self.sheet_id, self.row, self.column)])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            result = super().delete(*args, **kwargs)
+            record_cell_changes([(self.sheet_id, self.row, self.column)])
+        return result
+
+
+class CellChange(models.Model):
+    """
+    Журнал изменений ячеек: для каждой когда-либо измененной ячейки хранится
+    номер последнего изменения таблицы, в котором она участвовала. Журнал
+    сжат по ячейкам, поэтому не растет быстрее числа затронутых ячеек.
+    Удаленная ячейка остается в журнале (ее нет среди Cell). Запись с
+    row = column = 0 означает, что сдвинулись строки или колонки листа и
+    лист нужно перечитать целиком.
+    """
+    spreadsheet = models.ForeignKey(Spreadsheet, on_delete=models.CASCADE, related_name='cell_changes')
+    sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE, related_name='cell_changes')
+    row = models.IntegerField()
+    column = models.IntegerField()
+    sequence = models.PositiveBigIntegerField()
+
+    class Meta:
+        unique_together = ['sheet', 'row', 'column']
+        indexes = [
+            models.Index(fields=['spreadsheet', 'sequence']),
+        ]
+
+    def __str__(self):
+        return f"{self.sheet.name}[{self.row},{self.column}] #{self.sequence}"
+
+
+class CellDependency(models.Model):
+    """Запись индекса зависимостей: формула ячейки cell ссылается на прямоугольник листа sheet"""
+    cell = models.ForeignKey(Cell, on_delete=models.CASCADE, related_name='dependencies')
+    sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE, related_name='dependents')
+    start_row = models.IntegerField()
+    start_column = models.IntegerField()
+    end_row = models.IntegerField()
+    end_column = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sheet', 'start_row', 'start_column']),
+        ]
+
+    def __str__(self):
+        return f"{self.cell} -> {self.sheet.name}[{self.start_row},{self.start_column}:{self.end_row},{self.end_column}]"
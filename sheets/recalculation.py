@@ -0,0 +1,353 @@
+from django.db import transaction
+from .models import Cell, CellDependency, Sheet
+from .formula_engine import FormulaEngine, cell_to_value
+from .aggregates import aggregate_shape, evaluate_aggregate, forget_aggregate_states, UNKNOWN
+from .formula_parser import compile_formula, FormulaSyntaxError
+from .cell_dependencies import find_dependent_cell_ids, update_cells_dependencies
+from .changes import check_caches
+from . import resident
+
+
+CIRCULAR_REFERENCE_ERROR = '#ОШИБКА: Циклическая ссылка'
+
+# Сколько ячеек с формулами обрабатывается за раз в recalculate_area
+AREA_CHUNK_SIZE = 5000
+
+
+def recalculate_dependent_cells(sheet, coordinates, changes=None):
+    """
+    Пересчитывает все формулы, транзитивно зависящие от измененных ячеек
+    (row, column) листа sheet, в том числе формулы на других листах таблицы.
+
+    changes: {(row, column): (старое значение, новое значение)} измененных
+    ячеек (значения в виде cell_to_value); по ним агрегаты SUM/COUNT/AVERAGE
+    над большими диапазонами обновляются без полного пересчета.
+    Возвращает список пересчитанных ячеек в порядке вычисления.
+    """
+    return recalculate_cells(
+        [(sheet.id, row, column) for row, column in coordinates],
+        changes={
+            (sheet.id, row, column): change
+            for (row, column), change in (changes or {}).items()
+        },
+    )
+
+
+def recalculate_cells(coordinates, include_changed=False, changes=None):
+    """
+    Пересчитывает формулы, транзитивно зависящие от ячеек (sheet_id, row, column).
+
+    Каждая формула вычисляется один раз в топологическом порядке, ячейки из
+    циклов получают CIRCULAR_REFERENCE_ERROR, результаты записываются одной
+    массовой записью (Cell.objects.bulk_write). При include_changed=True
+    формулы в самих переданных ячейках тоже пересчитываются. changes - старые и новые значения измененных ячеек
+    по координатам (sheet_id, row, column); для ячеек без известного старого
+    значения агрегаты над их диапазонами пересчитываются полностью.
+    Возвращает список пересчитанных ячеек в порядке вычисления.
+    """
+    coordinates = set(coordinates)
+    # Индекс зависимостей, агрегаты и таблица в памяти могли устареть, если
+    # таблицу меняли в обход процесса
+    check_caches({sheet_id for sheet_id, row, column in coordinates})
+    cells, successors = _collect_dirty_cells(coordinates, include_changed)
+    if not cells:
+        return []
+
+    changes = dict(changes or {})
+    for coordinate in coordinates:
+        changes.setdefault(coordinate, (UNKNOWN, UNKNOWN))
+
+    # Каждая формула разбирается один раз за пересчет (при массовом заполнении
+    # формул больше, чем помещается в кэш compile_formula).
+    # Диапазоны формул вида =SUM(A1:A100000) не загружаем заранее: при наличии
+    # состояния агрегата они обновляются по разнице значений
+    sheets = {}
+    compiled_cells = {}
+    compiled_by_sheet = {}
+    for cell in cells.values():
+        sheets[cell.sheet_id] = cell.sheet
+        try:
+            compiled = compile_formula(cell.formula.strip())
+        except FormulaSyntaxError:
+            continue
+        compiled_cells[cell.id] = compiled
+        if aggregate_shape(cell.formula, compiled):
+            continue
+        compiled_by_sheet.setdefault(cell.sheet_id, []).append(compiled)
+
+    # Значения ячеек, записанных в этой транзакции, известны заранее: в памяти
+    # процесса они появятся только после ее фиксации
+    engine = FormulaEngine(next(iter(sheets.values())))
+    for (sheet_id, row, column), (old_value, new_value) in changes.items():
+        if new_value is not UNKNOWN:
+            engine.remember_value(sheet_id, row, column, new_value)
+    for sheet_id, compiled in compiled_by_sheet.items():
+        engine.prefetch(*compiled, sheet=sheets[sheet_id])
+
+    ordered = []
+    changed = []
+    for cell_id, circular in _topological_order(cells, successors):
+        cell = cells[cell_id]
+        coordinate = (cell.sheet_id, cell.row, cell.column)
+        old_value = cell.value
+        # Для ячеек пакета cell.value уже перезаписан: старое значение берем из changes
+        previous = changes[coordinate][0] if coordinate in changes else cell_to_value(cell.value)
+        if circular:
+            cell.value = CIRCULAR_REFERENCE_ERROR
+        else:
+            compiled = compiled_cells.get(cell_id)
+            value = evaluate_aggregate(engine, cell, changes, compiled)
+            if value is None:
+                try:
+                    value = engine.evaluate(cell.formula, sheet=cell.sheet, compiled=compiled)
+                except Exception as e:
+                    value = f'#ОШИБКА: {str(e)}'
+            cell.value = value
+        cell.update_typed_value()
+        engine.remember_cell(cell)
+        ordered.append(cell)
+        if cell.value != old_value:
+            changed.append(cell)
+        if cell.value != old_value or coordinate in changes:
+            changes[coordinate] = (previous, cell_to_value(cell.value))
+
+    if changed:
+        Cell.objects.bulk_write(changed, ['value'])
+        resident.update_cells(changed)
+
+    return ordered
+
+
+def recalculate_area(sheet, bounds):
+    """
+    Пересчет после массовой записи прямоугольника (row1, col1, row2, col2)
+    листа в обход обычного сохранения ячеек (импорт CSV, копирование диапазона).
+
+    Перестраивает зависимости формул области и вычисляет их, а также формулы,
+    читающие эту область, один раз в порядке зависимостей.
+    Возвращает список пересчитанных ячеек.
+    """
+    start_row, start_column, end_row, end_column = bounds
+    written = Cell.objects.filter(
+        sheet=sheet,
+        row__range=(start_row, end_row),
+        column__range=(start_column, end_column),
+    )
+
+    # Индекс зависимостей: формулы области и ячейки, в которых формулы были затерты
+    seeds = set()
+    chunk = []
+    for cell in written.exclude(formula='').iterator(chunk_size=AREA_CHUNK_SIZE):
+        cell.sheet = sheet
+        chunk.append(cell)
+        seeds.add((sheet.id, cell.row, cell.column))
+        if len(chunk) >= AREA_CHUNK_SIZE:
+            update_cells_dependencies(chunk)
+            chunk = []
+    update_cells_dependencies(chunk)
+    stale = CellDependency.objects.filter(
+        cell__sheet=sheet,
+        cell__row__range=(start_row, end_row),
+        cell__column__range=(start_column, end_column),
+        cell__formula='',
+    )
+    update_cells_dependencies(
+        cell for cell in Cell.objects.filter(id__in=stale.values('cell_id')).select_related('sheet')
+    )
+
+    # Формулы, читающие область (их агрегаты считаем заново)
+    readers = CellDependency.objects.filter(
+        sheet=sheet,
+        start_row__lte=end_row,
+        end_row__gte=start_row,
+        start_column__lte=end_column,
+        end_column__gte=start_column,
+    ).values_list('cell_id', 'cell__sheet_id', 'cell__row', 'cell__column')
+    reader_ids = set()
+    for cell_id, sheet_id, row, column in readers.iterator():
+        reader_ids.add(cell_id)
+        seeds.add((sheet_id, row, column))
+    forget_aggregate_states(reader_ids)
+
+    resident.reload(sheet.spreadsheet_id)
+    with transaction.atomic():
+        return recalculate_cells(seeds, include_changed=True)
+
+
+def _collect_dirty_cells(coordinates, include_changed):
+    """
+    Обход индекса зависимостей в ширину от измененных координат.
+
+    Возвращает словарь id -> Cell всех зависимых формул и граф
+    successors: id ячейки-источника -> id зависящих от нее формул.
+    """
+    cells = {}
+    dependents_of = {}
+    frontier = set(coordinates)
+    new_cells = []
+
+    if include_changed:
+        new_cells = _formula_cells_at(coordinates)
+
+    while True:
+        for cell in new_cells:
+            cells[cell.id] = cell
+            coordinate = (cell.sheet_id, cell.row, cell.column)
+            if coordinate not in dependents_of:
+                frontier.add(coordinate)
+        if not frontier:
+            break
+
+        new_ids = set()
+        for coordinate in frontier:
+            dependent_ids = find_dependent_cell_ids(*coordinate)
+            dependents_of[coordinate] = dependent_ids
+            new_ids.update(dependent_ids)
+        new_ids.difference_update(cells)
+
+        frontier = set()
+        new_cells, missing_ids = resident.find_cells(new_ids)
+        if missing_ids:
+            new_cells.extend(
+                Cell.objects.filter(id__in=missing_ids).exclude(formula='').select_related('sheet')
+            )
+
+    # Измененная ячейка тоже может оказаться в грязном множестве (цикл через нее)
+    successors = {}
+    for cell in cells.values():
+        dependent_ids = dependents_of.get((cell.sheet_id, cell.row, cell.column), ())
+        successors[cell.id] = {dependent_id for dependent_id in dependent_ids if dependent_id in cells}
+
+    return cells, successors
+
+
+def _formula_cells_at(coordinates):
+    """Ячейки с формулами в указанных координатах (sheet_id, row, column)"""
+    by_sheet = {}
+    for sheet_id, row, column in coordinates:
+        by_sheet.setdefault(sheet_id, set()).add((row, column))
+
+    # Лист загружается один раз и общий для всех его ячеек (без select_related на каждую)
+    sheets = Sheet.objects.in_bulk(by_sheet)
+    cells = []
+    for sheet_id, points in by_sheet.items():
+        rows = {row for row, column in points}
+        columns = {column for row, column in points}
+        queryset = Cell.objects.filter(
+            sheet_id=sheet_id,
+            row__range=(min(rows), max(rows)),
+            column__range=(min(columns), max(columns)),
+        ).exclude(formula='')
+        for cell in queryset:
+            if (cell.row, cell.column) in points:
+                cell.sheet = sheets[sheet_id]
+                cells.append(cell)
+    return cells
+
+
+def _topological_order(cells, successors):
+    """
+    Порядок вычисления (алгоритм Кана). Когда обход упирается в цикл, ячейки
+    циклических компонент сильной связности помечаются как циклические, а
+    зависящие от них формулы вычисляются дальше в обычном порядке.
+
+    Возвращает список пар (id ячейки, циклическая ли она).
+    """
+    in_degree = dict.fromkeys(cells, 0)
+    for source_id, dependents in successors.items():
+        for dependent_id in dependents:
+            in_degree[dependent_id] += 1
+
+    ready = [cell_id for cell_id, degree in in_degree.items() if degree == 0]
+    order = []
+    done = set()
+
+    def release(cell_id):
+        done.add(cell_id)
+        for dependent_id in successors.get(cell_id, ()):
+            in_degree[dependent_id] -= 1
+            if in_degree[dependent_id] == 0 and dependent_id not in done:
+                ready.append(dependent_id)
+
+    while len(done) < len(cells):
+        while ready:
+            cell_id = ready.pop()
+            if cell_id in done:
+                continue
+            order.append((cell_id, False))
+            release(cell_id)
+
+        if len(done) == len(cells):
+            break
+
+        remaining = [cell_id for cell_id in cells if cell_id not in done]
+        circular = _cyclic_cells(remaining, successors)
+        if not circular:
+            break
+        for cell_id in circular:
+            order.append((cell_id, True))
+            done.add(cell_id)
+        for cell_id in circular:
+            for dependent_id in successors.get(cell_id, ()):
+                in_degree[dependent_id] -= 1
+                if in_degree[dependent_id] <= 0 and dependent_id not in done:
+                    ready.append(dependent_id)
+
+    return order
+
+
+def _cyclic_cells(nodes, successors):
+    """Ячейки, входящие в циклы (итеративный алгоритм Тарьяна по подграфу nodes)"""
+    node_set = set(nodes)
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    circular = []
+    counter = 0
+
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(successors.get(root, ())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if child not in node_set:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors.get(child, ()))))
+                    advanced = True
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if advanced:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in successors.get(node, ()):
+                    circular.extend(component)
+
+    return circular
@@ -0,0 +1,333 @@
+import threading
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Cell, Sheet
+from .formula_engine import SheetValues, typed_to_value
+
+
+class ResidentSheet:
+    """Лист в памяти: значения всех ячеек и ячейки с формулами"""
+
+    __slots__ = ('sheet', 'values', 'formula_cells')
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        # Значения для вычислений (float или строка) по колонкам
+        self.values = SheetValues()
+        # cell_id -> (row, column, formula, value)
+        self.formula_cells = {}
+
+    def put(self, cell_id, row, column, value, formula, kind, number):
+        self.values.put(row, column, typed_to_value(kind, number, value))
+        if formula:
+            self.formula_cells[cell_id] = (row, column, formula, value)
+        else:
+            self.formula_cells.pop(cell_id, None)
+
+    def discard(self, cell_id, row, column):
+        self.values.discard(row, column)
+        self.formula_cells.pop(cell_id, None)
+
+
+class ResidentSpreadsheet:
+    """
+    Таблица в памяти процесса, пока к ней подключены пользователи по websocket.
+    Вычисления и поиск зависимых формул обслуживаются из памяти, запись
+    по-прежнему идет в БД; в память записанное переносится после фиксации
+    транзакции.
+    """
+
+    __slots__ = ('id', 'sheets', 'sheets_by_name', 'members')
+
+    def __init__(self, spreadsheet_id):
+        self.id = spreadsheet_id
+        self.sheets = {}
+        self.sheets_by_name = {}
+        self.members = 0
+
+    def read(self):
+        """
+        Читает все листы и ячейки таблицы (по одному запросу на листы и
+        ячейки) без блокировки. Возвращает (номер изменений, листы).
+        """
+        from .cell_dependencies import preload_dependency_index
+        from .changes import current_sequence
+
+        # Номер читается до ячеек: изменение между ними только вызовет лишнее перечитывание
+        sequence = current_sequence(self.id)
+        sheets = {sheet.id: ResidentSheet(sheet) for sheet in Sheet.objects.filter(spreadsheet_id=self.id)}
+        cells = Cell.objects.filter(sheet__spreadsheet_id=self.id).values_list(
+            'id', 'sheet_id', 'row', 'column', 'value', 'formula', 'kind', 'number'
+        )
+        for cell_id, sheet_id, *fields in cells.iterator(chunk_size=5000):
+            sheets[sheet_id].put(cell_id, *fields)
+        preload_dependency_index(sheets)
+        return sequence, sheets
+
+    def install(self, sequence, sheets, journal):
+        """
+        Подменяет листы прочитанными (под _lock) и повторяет записи в память,
+        сделанные за время чтения: прочитанное могло их не застать
+        """
+        from .changes import note_loaded_sequence
+
+        for entry in journal:
+            _apply(sheets, *entry)
+        self.sheets = sheets
+        self.sheets_by_name = {resident.sheet.name: resident.sheet for resident in sheets.values()}
+        note_loaded_sequence(self.id, sequence)
+
+    def get_cells(self, cell_ids):
+        """
+        Ячейки с формулами по id в виде экземпляров Cell (без запроса к БД).
+        Возвращает (ячейки, id, которых нет в памяти).
+        """
+        found = []
+        missing = set(cell_ids)
+        for resident in self.sheets.values():
+            for cell_id in missing.intersection(resident.formula_cells):
+                row, column, formula, value = resident.formula_cells[cell_id]
+                cell = Cell(id=cell_id, sheet_id=resident.sheet.id, row=row, column=column,
+                            formula=formula, value=value)
+                cell.sheet = resident.sheet
+                found.append(cell)
+        missing.difference_update(cell.id for cell in found)
+        return found, missing
+
+
+_spreadsheets = {}
+_lock = threading.RLock()
+
+# spreadsheet_id -> threading.Event первой загрузки таблицы в память
+_loading = {}
+# Журналы идущих чтений таблиц: записи в память за время чтения
+# (('put', cell_id, sheet_id, поля) или ('discard', cell_id, sheet_id, row, column))
+_journals = []
+
+# Записи текущей транзакции потока, еще не перенесенные в память
+_local = threading.local()
+
+
+class _Pending:
+    """Незафиксированные изменения потока: id записанных ячеек и таблицы, ждущие перечитывания"""
+
+    __slots__ = ('cell_ids', 'spreadsheet_ids')
+
+    def __init__(self):
+        self.cell_ids = set()
+        self.spreadsheet_ids = set()
+
+
+def _pending():
+    """
+    Незафиксированные изменения потока. Вне транзакции в них могут остаться
+    только следы откаченных транзакций - они сбрасываются.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = _Pending()
+    elif (pending.cell_ids or pending.spreadsheet_ids) and not transaction.get_connection().in_atomic_block:
+        pending.cell_ids.clear()
+        pending.spreadsheet_ids.clear()
+    return pending
+
+
+def _load(resident):
+    """
+    Читает таблицу из БД вне _lock (вычисления по другим таблицам не ждут
+    чтения) и подменяет ее листы под _lock. Возвращает False, если таблицу
+    успели выгрузить.
+    """
+    journal = []
+    with _lock:
+        _journals.append(journal)
+    try:
+        sequence, sheets = resident.read()
+        with _lock:
+            if resident.members and _spreadsheets.get(resident.id) is not resident:
+                return False
+            resident.install(sequence, sheets, journal)
+            return True
+    finally:
+        with _lock:
+            _journals.remove(journal)
+
+
+def acquire(spreadsheet_id):
+    """Регистрирует участника сессии; при первом подключении загружает таблицу в память"""
+    spreadsheet_id = int(spreadsheet_id)
+    while True:
+        with _lock:
+            resident = _spreadsheets.get(spreadsheet_id)
+            if resident is not None:
+                resident.members += 1
+                return resident
+            loaded = _loading.get(spreadsheet_id)
+            if loaded is None:
+                loaded = _loading[spreadsheet_id] = threading.Event()
+                break
+        # Таблицу загружает другой поток: ждем его и берем загруженную
+        loaded.wait()
+
+    try:
+        resident = ResidentSpreadsheet(spreadsheet_id)
+        _load(resident)
+        with _lock:
+            resident.members += 1
+            _spreadsheets[spreadsheet_id] = resident
+        return resident
+    finally:
+        with _lock:
+            del _loading[spreadsheet_id]
+        loaded.set()
+
+
+def release(spreadsheet_id):
+    """
+    Снимает участника сессии; после последнего отключения таблица и индексы
+    зависимостей ее листов выгружаются
+    """
+    from .cell_dependencies import reset_dependency_index
+
+    spreadsheet_id = int(spreadsheet_id)
+    with _lock:
+        resident = _spreadsheets.get(spreadsheet_id)
+        if resident is None:
+            return
+        resident.members -= 1
+        if resident.members <= 0:
+            del _spreadsheets[spreadsheet_id]
+            for sheet_id in resident.sheets:
+                reset_dependency_index(sheet_id)
+
+
+def get_resident(spreadsheet_id):
+    """
+    Таблица в памяти или None, если у нее нет активных websocket-сессий
+    или ее перечитывание ждет фиксации транзакции потока
+    """
+    if not _spreadsheets or spreadsheet_id in _pending().spreadsheet_ids:
+        return None
+    return _spreadsheets.get(spreadsheet_id)
+
+
+def get_resident_sheet(sheet):
+    """Лист в памяти или None"""
+    resident = get_resident(sheet.spreadsheet_id)
+    if resident is None:
+        return None
+    return resident.sheets.get(sheet.id)
+
+
+def update_cells(cells):
+    """
+    Переносит в память значения ячеек, записанных в БД массово
+    (bulk_create/bulk_update), после фиксации транзакции
+    """
+    entries = [
+        (cell.id, cell.sheet_id, cell.row, cell.column, cell.value, cell.formula, cell.kind, cell.number)
+        for cell in cells
+    ]
+    if entries:
+        _pending().cell_ids.update(entry[0] for entry in entries)
+        transaction.on_commit(lambda: _put_cells(entries))
+
+
+def _apply(sheets, action, cell_id, sheet_id, *fields):
+    """Переносит запись ('put' или 'discard') в лист из sheets, если он там есть"""
+    resident_sheet = sheets.get(sheet_id)
+    if resident_sheet is None:
+        return False
+    if action == 'put':
+        resident_sheet.put(cell_id, *fields)
+    else:
+        resident_sheet.discard(cell_id, *fields)
+    return True
+
+
+def _write(records):
+    """Переносит записи в таблицы в памяти и в журналы идущих чтений"""
+    if not _spreadsheets and not _journals:
+        return
+    with _lock:
+        for journal in _journals:
+            journal.extend(records)
+        for record in records:
+            for resident in _spreadsheets.values():
+                if _apply(resident.sheets, *record):
+                    break
+
+
+def _put_cells(entries):
+    _pending().cell_ids.difference_update(entry[0] for entry in entries)
+    _write([('put', *entry) for entry in entries])
+
+
+def discard_cell(cell_id, sheet_id, row, column):
+    """
+    Убирает удаленную ячейку из памяти после фиксации транзакции (id
+    передается отдельно: после delete() он уже None)
+    """
+    _pending().cell_ids.add(cell_id)
+    transaction.on_commit(lambda: _discard_cell(cell_id, sheet_id, row, column))
+
+
+def _discard_cell(cell_id, sheet_id, row, column):
+    _pending().cell_ids.discard(cell_id)
+    _write([('discard', cell_id, sheet_id, row, column)])
+
+
+def find_cells(cell_ids):
+    """
+    Ячейки с формулами по id из таблиц в памяти. Ячейки, записанные в
+    незафиксированной транзакции потока, в памяти не ищутся.
+    Возвращает (ячейки, id, которых в памяти нет).
+    """
+    missing = set(cell_ids)
+    if not _spreadsheets or not missing:
+        return [], missing
+    pending = _pending()
+    written = missing & pending.cell_ids
+    missing -= written
+    found = []
+    with _lock:
+        for resident in _spreadsheets.values():
+            if not missing:
+                break
+            if resident.id in pending.spreadsheet_ids:
+                continue
+            cells, missing = resident.get_cells(missing)
+            found.extend(cells)
+    return found, missing | written
+
+
+def reload(spreadsheet_id):
+    """
+    Перечитывает таблицу из БД, если она в памяти (после массовых изменений).
+    Перечитывание выполняется после фиксации транзакции, до нее таблица
+    в этом потоке читается из БД.
+    """
+    if spreadsheet_id not in _spreadsheets:
+        return
+    _pending().spreadsheet_ids.add(spreadsheet_id)
+    transaction.on_commit(lambda: _reload(spreadsheet_id))
+
+
+def _reload(spreadsheet_id):
+    _pending().spreadsheet_ids.discard(spreadsheet_id)
+    resident = _spreadsheets.get(spreadsheet_id)
+    if resident is not None:
+        # До подмены вычисления идут по прежним листам
+        _load(resident)
+
+
+@receiver(post_save, sender=Cell)
+def _cell_saved(sender, instance, **kwargs):
+    update_cells([instance])
+
+
+@receiver(post_save, sender=Sheet)
+@receiver(post_delete, sender=Sheet)
+def _sheet_changed(sender, instance, **kwargs):
+    reload(instance.spreadsheet_id)
@@ -16,6 +16,24 @@ class SheetSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'order', 'cells']
 
 
+class SheetSummarySerializer(serializers.ModelSerializer):
+    """Лист без ячеек"""
+
+    class Meta:
+        model = Sheet
+        fields = ['id', 'name', 'order']
+
+
+class SheetMetaSerializer(SheetSummarySerializer):
+    """Лист без ячеек: размеры и число заполненных ячеек"""
+    cell_count = serializers.IntegerField(read_only=True)
+    max_row = serializers.IntegerField(read_only=True)
+    max_column = serializers.IntegerField(read_only=True)
+
+    class Meta(SheetSummarySerializer.Meta):
+        fields = SheetSummarySerializer.Meta.fields + ['cell_count', 'max_row', 'max_column']
+
+
 class SpreadsheetSerializer(serializers.ModelSerializer):
     sheets = SheetSerializer(many=True, read_only=True)
     owner_username = serializers.CharField(source='owner.username', read_only=True)
@@ -29,6 +47,11 @@ class SpreadsheetSerializer(serializers.ModelSerializer):
         return [user.username for user in obj.shared_with.all()]
 
 
+class SpreadsheetSummarySerializer(SpreadsheetSerializer):
+    """Таблица для списков: листы без ячеек (см. SpreadsheetViewSet.get_queryset)"""
+    sheets = SheetSummarySerializer(many=True, read_only=True)
+
+
 class CellUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cell
@@ -0,0 +1,84 @@
+import gzip
+import json
+from .models import Cell
+
+
+# Формат снимка; меняется при несовместимых изменениях структуры
+SNAPSHOT_FORMAT = 1
+
+
+def build_snapshot(sheet, version):
+    """
+    Компактный снимок листа в колоночном виде.
+
+    Вместо объекта на ячейку - параллельные массивы rows, columns, values,
+    formulas и styles. Строки значений и формул хранятся один раз в таблице
+    strings (в массивах - индексы, strings[0] - пустая строка), стили - в
+    таблице style_table (style_table[0] - пустой стиль).
+    """
+    strings = ['']
+    string_index = {'': 0}
+    style_table = [{}]
+    style_index = {'{}': 0}
+
+    rows = []
+    columns = []
+    values = []
+    formulas = []
+    styles = []
+
+    cells = Cell.objects.filter(sheet=sheet).order_by('row', 'column').values_list(
+        'row', 'column', 'value', 'formula', 'style'
+    )
+    for row, column, value, formula, style in cells.iterator(chunk_size=5000):
+        rows.append(row)
+        columns.append(column)
+
+        index = string_index.get(value)
+        if index is None:
+            index = string_index[value] = len(strings)
+            strings.append(value)
+        values.append(index)
+
+        index = string_index.get(formula)
+        if index is None:
+            index = string_index[formula] = len(strings)
+            strings.append(formula)
+        formulas.append(index)
+
+        if style:
+            key = json.dumps(style, sort_keys=True)
+            index = style_index.get(key)
+            if index is None:
+                index = style_index[key] = len(style_table)
+                style_table.append(style)
+            styles.append(index)
+        else:
+            styles.append(0)
+
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'sheet_id': sheet.id,
+        'version': version,
+        'rows': rows,
+        'columns': columns,
+        'values': values,
+        'formulas': formulas,
+        'styles': styles,
+        'strings': strings,
+        'style_table': style_table,
+    }
+
+
+def snapshot_etag(sheet_id, version, compressed):
+    """Сильный ETag снимка: лист, версия его ячеек и вариант кодирования"""
+    encoding = '-gzip' if compressed else ''
+    return f'"sheet-{sheet_id}-v{version}-f{SNAPSHOT_FORMAT}{encoding}"'
+
+
+def encode_snapshot(snapshot, compress):
+    """JSON снимка в байтах, при compress=True - сжатый gzip"""
+    content = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if compress:
+        return gzip.compress(content, compresslevel=5)
+    return content
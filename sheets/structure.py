@@ -0,0 +1,59 @@
+from django.db import transaction
+from .models import Cell, CellDependency
+from .formula_parser import shift_references
+from .cell_dependencies import update_cells_dependencies
+from .aggregates import forget_aggregate_states
+from .recalculation import recalculate_cells
+from . import resident
+
+
+# Направления сдвига: строки или колонки
+STRUCTURE_AXES = ('row', 'column')
+
+
+def shift_cells(sheet, axis, at, count):
+    """
+    Вставляет (count > 0) или удаляет (count < 0) строки (axis='row') или
+    колонки (axis='column') листа, начиная с номера at.
+
+    Ячейки сдвигаются множественными UPDATE (см. CellQuerySet.shift), ссылки
+    формул таблицы на сдвинутую область переписываются одним проходом по
+    индексу зависимостей, затем выполняется один пересчет.
+    Возвращает {'formulas': число переписанных формул, 'recalculated': число пересчитанных}.
+    """
+    if axis not in STRUCTURE_AXES:
+        raise ValueError(f"Неизвестное направление '{axis}'")
+
+    with transaction.atomic():
+        # Формулы, читающие область листа от at и дальше (их ссылки могут сдвинуться)
+        reader_ids = set(
+            CellDependency.objects.filter(sheet=sheet, **{f'end_{axis}__gte': at}).values_list('cell_id', flat=True)
+        )
+
+        if count < 0:
+            Cell.objects.filter(sheet=sheet, **{f'{axis}__range': (at, at - count - 1)}).delete()
+            Cell.objects.filter(sheet=sheet, **{f'{axis}__gte': at - count}).shift(axis, count)
+        else:
+            Cell.objects.filter(sheet=sheet, **{f'{axis}__gte': at}).shift(axis, count)
+
+        readers = list(Cell.objects.filter(id__in=reader_ids).select_related('sheet'))
+        rewritten = []
+        for cell in readers:
+            # Ссылки без имени листа указывают на сдвинутый лист, только если формула на нем же
+            sheets = {sheet.name, None} if cell.sheet_id == sheet.id else {sheet.name}
+            formula = shift_references(cell.formula, axis, at, count, sheets)
+            if formula != cell.formula:
+                cell.formula = formula
+                rewritten.append(cell)
+        Cell.objects.bulk_write(rewritten, ['formula'])
+        update_cells_dependencies(rewritten)
+
+        # Состояния агрегатов относятся к прежнему содержимому диапазонов
+        forget_aggregate_states(reader_ids)
+        resident.reload(sheet.spreadsheet_id)
+        recalculated = recalculate_cells(
+            [(cell.sheet_id, cell.row, cell.column) for cell in readers],
+            include_changed=True,
+        )
+
+    return {'formulas': len(rewritten), 'recalculated': len(recalculated)}
@@ -0,0 +1,215 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase
+
+from . import cell_dependencies, changes, resident
+from .aggregates import forget_aggregate_states
+from .cell_dependencies import reset_dependency_index
+from .edits import apply_cell_updates
+from .formula_engine import FormulaEngine
+from .formula_parser import (
+    INVALID_REFERENCE, FormulaSyntaxError, compile_formula, rewrite_references, shift_references,
+)
+from .models import Cell, CellChange, Sheet, Spreadsheet
+from .recalculation import CIRCULAR_REFERENCE_ERROR
+
+
+class SheetTestCase(TransactionTestCase):
+    """
+    Таблица с одним листом. Индекс зависимостей, агрегаты и номера изменений
+    живут в памяти процесса: между тестами они сбрасываются, так как id
+    ячеек в новой базе повторяются.
+    """
+
+    def setUp(self):
+        reset_dependency_index()
+        forget_aggregate_states()
+        changes._checked_sequences.clear()
+        self.user = User.objects.create_user('user', password='password')
+        self.spreadsheet = Spreadsheet.objects.create(name='Тест', owner=self.user)
+        self.sheet = Sheet.objects.create(spreadsheet=self.spreadsheet, name='Лист1')
+
+    def write(self, *updates):
+        """Записывает пакет {(row, column): текст}; текст с '=' - формула"""
+        batch = []
+        for values in updates:
+            for (row, column), text in values.items():
+                update = {'sheet_id': self.sheet.id, 'row': row, 'column': column}
+                if text.startswith('='):
+                    update.update(value='', formula=text)
+                else:
+                    update['value'] = text
+                batch.append(update)
+        cells, recalculated = apply_cell_updates({self.sheet.id: self.sheet}, batch)
+        return cells
+
+    def value(self, row, column):
+        return Cell.objects.get(sheet=self.sheet, row=row, column=column).value
+
+    def evaluate(self, formula):
+        return FormulaEngine(self.sheet).evaluate(formula)
+
+
+class FormulaParserTests(SimpleTestCase):
+
+    def test_compile_collects_references(self):
+        compiled = compile_formula('=A1+SUM(B2:C3)+Лист2!D4')
+        self.assertEqual(
+            sorted(compiled.rects(), key=str),
+            sorted([(None, 1, 1, 1, 1), (None, 2, 2, 3, 3), ('Лист2', 4, 4, 4, 4)], key=str),
+        )
+        self.assertIs(compile_formula('=A1+SUM(B2:C3)+Лист2!D4'), compiled)
+
+    def test_compile_rejects_broken_formulas(self):
+        for formula in ('=', '=1+', '=SUM(A1'):
+            with self.assertRaises(FormulaSyntaxError):
+                compile_formula(formula)
+
+    def test_rewrite_keeps_text_outside_references(self):
+        def rewrite(sheet, start, end):
+            if start.row == 2:
+                return None
+            return start._replace(column=3), end._replace(column=3)
+
+        self.assertEqual(rewrite_references('=A1 + "A1" + B2', rewrite), f'=C1 + "A1" + {INVALID_REFERENCE}')
+        self.assertEqual(rewrite_references('текст A1', rewrite), 'текст A1')
+
+    def test_shift_on_insert(self):
+        self.assertEqual(
+            shift_references('=A1 + A2+SUM(A1:A3)+"A2"+$A$2+Лист2!A2', 'row', 2, 1, {None}),
+            '=A1 + A3+SUM(A1:A4)+"A2"+$A$3+Лист2!A2',
+        )
+        self.assertEqual(
+            shift_references('=B1+SUM(A1:C1)+Лист2!B1', 'column', 1, 1, {'Лист2'}),
+            '=B1+SUM(A1:C1)+Лист2!C1',
+        )
+
+    def test_shift_on_delete(self):
+        self.assertEqual(
+            shift_references('=A2+SUM(A1:A3)+B:B+2:3', 'row', 2, -1, {None}),
+            f'={INVALID_REFERENCE}+SUM(A1:A2)+B:B+2:2',
+        )
+
+
+class RecalculationTests(SheetTestCase):
+
+    def test_dependents_follow_their_sources(self):
+        self.write({(1, 1): '1', (1, 4): '=B1+C1', (1, 3): '=B1*2', (1, 2): '=A1+1'})
+        cells, recalculated = apply_cell_updates(
+            {self.sheet.id: self.sheet},
+            [{'sheet_id': self.sheet.id, 'row': 1, 'column': 1, 'value': '5'}],
+        )
+        self.assertEqual([(cell.row, cell.column) for cell in recalculated], [(1, 2), (1, 3), (1, 4)])
+        self.assertEqual([self.value(1, column) for column in (2, 3, 4)], ['6', '12', '18'])
+
+    def test_cycle_marks_its_cells(self):
+        self.write({(1, 1): '=B1', (1, 2): '=A1+1'})
+        self.assertEqual(self.value(1, 1), CIRCULAR_REFERENCE_ERROR)
+        self.assertEqual(self.value(1, 2), CIRCULAR_REFERENCE_ERROR)
+
+        # Разрыв цикла снова вычисляет формулы
+        self.write({(1, 2): '4'})
+        self.assertEqual(self.value(1, 1), '4')
+
+
+class AggregateTests(SheetTestCase):
+
+    def test_incremental_aggregates_match_full_evaluation(self):
+        self.write({(row, 1): str(row) for row in range(1, 201)})
+        self.write({(1, 3): '=SUM(A1:B200)', (2, 3): '=COUNT(A1:B200)', (3, 3): '=AVERAGE(A1:B200)'})
+        self.assertEqual(self.value(1, 3), str(self.evaluate('=SUM(A1:B200)')))
+
+        # Числа становятся текстом, формулами и ошибкой одним пакетом
+        self.write({
+            (111, 1): 'txt',
+            (152, 1): '=A7+1',
+            (139, 1): '=A109+1',
+            (8, 1): '=1/0',
+            (5, 2): '0.5',
+        })
+        for row, formula in ((1, '=SUM(A1:B200)'), (2, '=COUNT(A1:B200)'), (3, '=AVERAGE(A1:B200)')):
+            self.assertAlmostEqual(float(self.value(row, 3)), float(self.evaluate(formula)), places=6)
+
+        # Формула снова становится числом
+        self.write({(152, 1): '3', (139, 1): ''})
+        for row, formula in ((1, '=SUM(A1:B200)'), (2, '=COUNT(A1:B200)'), (3, '=AVERAGE(A1:B200)')):
+            self.assertAlmostEqual(float(self.value(row, 3)), float(self.evaluate(formula)), places=6)
+
+
+class DependencyIndexTests(SheetTestCase):
+
+    def test_rolled_back_formula_change_keeps_old_dependencies(self):
+        self.write({(1, 1): '1', (1, 2): '5', (1, 3): '=A1'})
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.write({(1, 3): '=B1'})
+                self.assertEqual(self.value(1, 3), '5')
+                raise RuntimeError('откат')
+
+        self.write({(1, 1): '2'})
+        self.assertEqual(self.value(1, 3), '2')
+        self.write({(1, 2): '7'})
+        self.assertEqual(self.value(1, 3), '2')
+
+    def test_committed_formula_change_moves_dependencies(self):
+        self.write({(1, 1): '1', (1, 2): '5', (1, 3): '=A1'})
+        self.write({(1, 3): '=B1'})
+        self.write({(1, 1): '2', (1, 2): '6'})
+        self.assertEqual(self.value(1, 3), '6')
+
+    def test_release_evicts_sheet_indexes(self):
+        self.write({(1, 1): '1', (1, 3): '=A1'})
+        resident.acquire(self.spreadsheet.id)
+        self.assertIn(self.sheet.id, cell_dependencies._sheet_indexes)
+        resident.release(self.spreadsheet.id)
+        self.assertNotIn(self.sheet.id, cell_dependencies._sheet_indexes)
+        self.assertEqual(cell_dependencies._key_sheets, {})
+
+
+class ResidentTests(SheetTestCase):
+
+    def test_write_during_load_reaches_memory(self):
+        self.write({(1, 1): '1', (2, 1): '5'})
+        read = resident.ResidentSpreadsheet.read
+
+        def read_then_write(loading):
+            loaded = read(loading)
+            self.write({(1, 1): '2', (2, 1): ''})
+            return loaded
+
+        with mock.patch.object(resident.ResidentSpreadsheet, 'read', read_then_write):
+            loaded = resident.acquire(self.spreadsheet.id)
+        self.addCleanup(resident.release, self.spreadsheet.id)
+        values = loaded.sheets[self.sheet.id].values
+        self.assertEqual(values.get(1, 1), 2.0)
+        self.assertNotIn((2, 1), values)
+
+
+class ChangeLogTests(SheetTestCase):
+
+    def test_one_sequence_per_transaction(self):
+        with transaction.atomic():
+            self.write({(1, 1): '1'})
+            self.write({(2, 1): '2', (1, 2): '=A1+A2'})
+        self.spreadsheet.refresh_from_db()
+        self.assertEqual(self.spreadsheet.sequence, 1)
+        self.assertEqual(
+            set(CellChange.objects.values_list('row', 'column', 'sequence')),
+            {(1, 1, 1), (2, 1, 1), (1, 2, 1)},
+        )
+
+    def test_rolled_back_edit_leaves_no_log(self):
+        self.write({(1, 1): '1'})
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.write({(2, 1): '2'})
+                raise RuntimeError('откат')
+        self.write({(3, 1): '3'})
+        self.spreadsheet.refresh_from_db()
+        self.assertEqual(self.spreadsheet.sequence, 2)
+        self.assertEqual(
+            set(CellChange.objects.values_list('row', 'column', 'sequence')),
+            {(1, 1, 1), (3, 1, 2)},
+        )
@@ -1,37 +1,167 @@
+import csv
+import io
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
-from django.db import models
+from django.utils.http import parse_etags
+from django.db import models, transaction
 from .models import Spreadsheet, Sheet, Cell
 from .serializers import (
     SpreadsheetSerializer,
+    SpreadsheetSummarySerializer,
     SheetSerializer,
+    SheetMetaSerializer,
     CellSerializer,
     CellUpdateSerializer
 )
-from .formula_engine import FormulaEngine
-from .cell_dependencies import find_dependent_cells
+from .formula_engine import FormulaEngine, cell_to_value
+from .formula_parser import MAX_ROW, MAX_COLUMN
+from .cell_dependencies import (
+    update_cell_dependencies,
+    rebuild_dependencies,
+    reset_dependency_index,
+    forget_cell_dependencies,
+)
+from .recalculation import recalculate_dependent_cells, recalculate_cells
+from .aggregates import forget_aggregate_states
+from .imports import import_csv
+from .structure import shift_cells
+from .fill import copy_range
+from .edits import apply_cell_updates, cell_text
+from .consumers import broadcast
+from .changes import current_sequence, changes_since, check_caches
+from .snapshots import build_snapshot, snapshot_etag, encode_snapshot
+from .exports import EXPORT_FORMATS, sheet_csv, spreadsheet_csv, cells_ndjson, streaming_response
+from . import resident
+
+
+# Размер страницы ячеек диапазона по умолчанию и максимальный
+CELL_RANGE_PAGE_SIZE = 1000
+CELL_RANGE_MAX_PAGE_SIZE = 10000
+
 
+def _int_param(params, name, default=None):
+    """Целочисленный параметр запроса; ValueError, если он задан неверно"""
+    value = params.get(name)
+    if value is None or value == '':
+        if default is None:
+            raise ValueError(f'{name} обязателен')
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} должен быть целым числом')
 
-def _recalculate_dependent_cells(sheet, row, column):
+
+def _range_param(data, name, size=None):
     """
-    Пересчитывает все ячейки с формулами, которые зависят от указанной ячейки.
+    Прямоугольник (row1, col1, row2, col2) из объекта data[name] с полями
+    start_row, start_column, end_row, end_column. Если задан size
+    (высота, ширина), конец необязателен и по умолчанию дает прямоугольник этого размера.
     """
-    dependent_cells = find_dependent_cells(sheet, row, column)
-    
-    if not dependent_cells:
-        return
-    
-    engine = FormulaEngine(sheet)
-    
-    for cell in dependent_cells:
+    rect = data.get(name)
+    if not isinstance(rect, dict):
+        raise ValueError(f'{name} обязателен')
+    start_row = _int_param(rect, 'start_row')
+    start_column = _int_param(rect, 'start_column')
+    if size is None:
+        end_row = _int_param(rect, 'end_row')
+        end_column = _int_param(rect, 'end_column')
+    else:
+        end_row = _int_param(rect, 'end_row', start_row + size[0] - 1)
+        end_column = _int_param(rect, 'end_column', start_column + size[1] - 1)
+    if start_row < 1 or start_column < 1 or end_row < start_row or end_column < start_column:
+        raise ValueError(f'Неверный диапазон {name}')
+    return start_row, start_column, end_row, end_column
+
+
+def _export_params(request):
+    """Формат выгрузки (type=csv|ndjson) и флаг values (только значения, без формул)"""
+    export_format = request.query_params.get('type', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки '{export_format}'")
+    values_only = request.query_params.get('values') in ('1', 'true')
+    return export_format, values_only
+
+
+def _with_sheet_meta(queryset):
+    """Добавляет к листам число ячеек и размеры заполненной области (одним запросом)"""
+    return queryset.annotate(
+        cell_count=models.Count('cells'),
+        max_row=models.Max('cells__row'),
+        max_column=models.Max('cells__column'),
+    )
+
+
+def _recalculate_dependent_cells(sheet, row, column, change=None):
+    """
+    Пересчитывает все ячейки с формулами, которые зависят от указанной ячейки,
+    включая транзитивные зависимости (A1 -> B1 -> C1).
+    change - (старое, новое) значение ячейки для инкрементального пересчета агрегатов.
+    """
+    changes = {(row, column): change} if change else None
+    return recalculate_dependent_cells(sheet, [(row, column)], changes=changes)
+
+
+def _save_cell(update_serializer, formula_changed):
+    """
+    Сохраняет ячейку из CellUpdateSerializer одной записью: значение формулы
+    вычисляется до сохранения. formula_changed - запрос меняет формулу
+    (обновляется индекс зависимостей).
+    """
+    cell = update_serializer.instance
+    formula = update_serializer.validated_data.get('formula', cell.formula)
+    extra = {}
+    if formula:
+        check_caches([cell.sheet_id])
         try:
-            cell.value = engine.evaluate(cell.formula)
-            cell.save()
+            extra['value'] = FormulaEngine(cell.sheet).evaluate(formula)
         except Exception as e:
-            cell.value = f'#ОШИБКА: {str(e)}'
-            cell.save()
+            extra['value'] = f'#ОШИБКА: {str(e)}'
+    update_serializer.save(**extra)
+    if formula_changed:
+        update_cell_dependencies(cell)
+
+
+def _shift_sheet(request, sheet, axis, sign):
+    """
+    Вставка (sign=1) или удаление (sign=-1) строк/колонок листа: поля at
+    (номер первой строки или колонки) и count (по умолчанию 1).
+    """
+    try:
+        at = _int_param(request.data, 'at')
+        count = _int_param(request.data, 'count', 1)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if at < 1 or count < 1:
+        return Response({'error': 'at и count должны быть положительными'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    result = shift_cells(sheet, axis, at, sign * count)
+    broadcast(sheet.spreadsheet_id, {
+        'type': 'sheet_structure_changed',
+        'user_id': request.user.id,
+        'username': request.user.username,
+        'sheet_id': sheet.id,
+        'axis': axis,
+        'at': at,
+        'count': sign * count,
+    })
+    return Response(result)
+
+
+def _refresh_sheet_references(spreadsheet):
+    """
+    Перестраивает зависимости таблицы и пересчитывает формулы со ссылками на
+    другие листы после создания, переименования или удаления листа.
+    """
+    cells = rebuild_dependencies(spreadsheet)
+    recalculate_cells(
+        [(cell.sheet_id, cell.row, cell.column) for cell in cells],
+        include_changed=True,
+    )
 
 
 class SpreadsheetViewSet(viewsets.ModelViewSet):
@@ -43,11 +173,24 @@ class SpreadsheetViewSet(viewsets.ModelViewSet):
         """Фильтруем таблицы по владельцу и общим"""
         user = self.request.user
         if user.is_authenticated:
-            return Spreadsheet.objects.filter(
+            queryset = Spreadsheet.objects.filter(
                 models.Q(owner=user) | models.Q(shared_with=user)
             ).distinct()
+            if self.action == 'list':
+                # Список строится за постоянное число запросов, без ячеек
+                queryset = queryset.select_related('owner').prefetch_related(
+                    'shared_with',
+                    models.Prefetch('sheets', queryset=Sheet.objects.only('id', 'spreadsheet_id', 'name', 'order')),
+                )
+            return queryset
         return Spreadsheet.objects.none()
 
+    def get_serializer_class(self):
+        """Для списка таблиц - облегченное представление без ячеек"""
+        if self.action == 'list':
+            return SpreadsheetSummarySerializer
+        return SpreadsheetSerializer
+
     def create(self, request):
         """Создать новую таблицу"""
         serializer = self.get_serializer(data=request.data)
@@ -75,6 +218,9 @@ class SpreadsheetViewSet(viewsets.ModelViewSet):
             order=spreadsheet.sheets.count()
         )
         
+        # Формулы могли уже ссылаться на лист с таким именем
+        _refresh_sheet_references(spreadsheet)
+        
         serializer = SheetSerializer(sheet)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -149,6 +295,39 @@ class SpreadsheetViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Потоковая выгрузка всех листов таблицы: type=csv (по ячейке на строку:
+        sheet, row, column, content) или type=ndjson; values=1 - значения вместо формул (для CSV).
+        """
+        spreadsheet = self.get_object()
+        try:
+            export_format, values_only = _export_params(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if export_format == 'csv':
+            chunks = spreadsheet_csv(spreadsheet, values_only)
+        else:
+            chunks = cells_ndjson(spreadsheet.sheets.all())
+        return streaming_response(request._request, chunks, export_format, spreadsheet.name)
+
+    @action(detail=True, methods=['get'])
+    def changes(self, request, pk=None):
+        """
+        Ячейки, измененные после изменения с номером since (для догрузки после
+        переподключения). Без since возвращается только текущий номер - с него
+        клиент начинает отсчет перед загрузкой ячеек.
+        """
+        spreadsheet = self.get_object()
+        if request.query_params.get('since') in (None, ''):
+            return Response({'sequence': current_sequence(spreadsheet.id)})
+        try:
+            since = _int_param(request.query_params, 'since')
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(changes_since(spreadsheet.id, since))
+
     @action(detail=True, methods=['get'])
     def shared_users(self, request, pk=None):
         """Получить список пользователей с доступом"""
@@ -184,7 +363,117 @@ class SheetViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        return super().destroy(request, *args, **kwargs)
+        response = super().destroy(request, *args, **kwargs)
+        reset_dependency_index(sheet.id)
+        _refresh_sheet_references(spreadsheet)
+        return response
+
+    def perform_update(self, serializer):
+        """При переименовании листа обновляем ссылки формул на него"""
+        old_name = serializer.instance.name
+        sheet = serializer.save()
+        if sheet.name != old_name:
+            _refresh_sheet_references(sheet.spreadsheet)
+
+    @action(detail=True, methods=['post'], parser_classes=[MultiPartParser])
+    def import_csv(self, request, pk=None):
+        """
+        Импорт CSV-файла (поле file) в лист. Необязательные поля: start_row,
+        start_column (левый верхний угол, по умолчанию A1) и delimiter.
+        """
+        sheet = self.get_object()
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'Необходимо передать файл file'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            start_row = _int_param(request.data, 'start_row', 1)
+            start_column = _int_param(request.data, 'start_column', 1)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        delimiter = request.data.get('delimiter') or ','
+        if len(delimiter) != 1:
+            return Response({'error': 'delimiter должен быть одним символом'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        try:
+            result = import_csv(sheet, lines, start_row, start_column, delimiter)
+        except (UnicodeDecodeError, csv.Error) as e:
+            return Response({'error': f'Ошибка чтения CSV: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+    @action(detail=True, methods=['post'])
+    def insert_rows(self, request, pk=None):
+        """Вставить count пустых строк перед строкой at"""
+        return _shift_sheet(request, self.get_object(), 'row', 1)
+
+    @action(detail=True, methods=['post'])
+    def delete_rows(self, request, pk=None):
+        """Удалить count строк начиная со строки at"""
+        return _shift_sheet(request, self.get_object(), 'row', -1)
+
+    @action(detail=True, methods=['post'])
+    def insert_columns(self, request, pk=None):
+        """Вставить count пустых колонок перед колонкой at"""
+        return _shift_sheet(request, self.get_object(), 'column', 1)
+
+    @action(detail=True, methods=['post'])
+    def delete_columns(self, request, pk=None):
+        """Удалить count колонок начиная с колонки at"""
+        return _shift_sheet(request, self.get_object(), 'column', -1)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Потоковая выгрузка листа: type=csv (таблица, начиная с A1) или
+        type=ndjson (объект ячейки на строку); values=1 - значения вместо формул (для CSV).
+        """
+        sheet = self.get_object()
+        try:
+            export_format, values_only = _export_params(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if export_format == 'csv':
+            chunks = sheet_csv(sheet, values_only)
+        else:
+            chunks = cells_ndjson([sheet])
+        return streaming_response(request._request, chunks, export_format, sheet.name)
+
+    @action(detail=True, methods=['get'])
+    def snapshot(self, request, pk=None):
+        """
+        Компактный снимок ячеек листа (см. snapshots.build_snapshot) с сильным
+        ETag по версии листа: если лист не менялся, возвращается 304.
+        Клиентам, принимающим gzip, снимок отдается сжатым.
+        """
+        sheet = self.get_object()
+        compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        etag = snapshot_etag(sheet.id, sheet.version, compress)
+        
+        # If-None-Match сравнивается слабо: W/"x" совпадает с "x", '*' - с любым
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if '*' in if_none_match or etag in (tag.removeprefix('W/') for tag in if_none_match):
+            response = HttpResponseNotModified()
+        else:
+            snapshot = build_snapshot(sheet, sheet.version)
+            response = HttpResponse(encode_snapshot(snapshot, compress), content_type='application/json')
+            if compress:
+                response['Content-Encoding'] = 'gzip'
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+    @action(detail=False, methods=['get'], url_path='meta')
+    def meta_list(self, request):
+        """Листы (с фильтром по spreadsheet_id) без ячеек"""
+        sheets = _with_sheet_meta(self.get_queryset())
+        return Response(SheetMetaSerializer(sheets, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def meta(self, request, pk=None):
+        """Лист без ячеек: число ячеек и размеры заполненной области"""
+        sheet = get_object_or_404(_with_sheet_meta(self.get_queryset()), pk=pk)
+        return Response(SheetMetaSerializer(sheet).data)
 
 
 class CellViewSet(viewsets.ModelViewSet):
@@ -212,77 +501,144 @@ class CellViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        sheet = get_object_or_404(Sheet, id=sheet_id)
-        
-        # Получаем или создаем ячейку
-        cell, created = Cell.objects.get_or_create(
-            sheet=sheet,
-            row=row,
-            column=column,
-            defaults={'value': '', 'formula': '', 'style': {}}
-        )
-        
-        # Обновляем данные ячейки
-        update_serializer = CellUpdateSerializer(cell, data=request.data, partial=True)
-        update_serializer.is_valid(raise_exception=True)
-        update_serializer.save()
-        
-        # Перезагружаем объект из БД
-        cell.refresh_from_db()
-        
-        # Если есть формула, вычисляем значение
-        if cell.formula:
-            engine = FormulaEngine(sheet)
-            try:
-                cell.value = engine.evaluate(cell.formula)
-                cell.save()
-            except Exception as e:
-                cell.value = f'#ОШИБКА: {str(e)}'
-                cell.save()
+        try:
+            row = _int_param(request.data, 'row')
+            column = _int_param(request.data, 'column')
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Перезагружаем еще раз после вычисления
-        cell.refresh_from_db()
+        sheet = get_object_or_404(Sheet, id=sheet_id)
         
-        # Если ячейка была изменена (не формула, а значение), пересчитываем зависимые формулы
-        # Проверяем, что это изменение значения, а не добавление/изменение формулы
-        was_value_update = 'value' in request.data and not request.data.get('formula')
-        if was_value_update or (not cell.formula and cell.value):
-            _recalculate_dependent_cells(sheet, cell.row, cell.column)
+        with transaction.atomic():
+            # Получаем ячейку или готовим новую (она вставится одним сохранением)
+            cell = Cell.objects.filter(sheet=sheet, row=row, column=column).first()
+            created = cell is None
+            if created:
+                cell = Cell(sheet=sheet, row=row, column=column, value='', formula='', style={})
+            
+            previous_value = cell_to_value(cell.value)
+            
+            # Обновляем данные ячейки
+            update_serializer = CellUpdateSerializer(cell, data=request.data, partial=True)
+            update_serializer.is_valid(raise_exception=True)
+            _save_cell(update_serializer, 'formula' in request.data)
+            
+            # Пересчитываем зависимые формулы (значение ячейки могло измениться и при смене формулы)
+            change = (previous_value, cell_to_value(cell.value))
+            _recalculate_dependent_cells(sheet, cell.row, cell.column, change)
         
         serializer = CellSerializer(cell)
         return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
     def update(self, request, pk=None):
         """Обновить ячейку"""
-        cell = self.get_object()
-        update_serializer = CellUpdateSerializer(cell, data=request.data, partial=True)
-        update_serializer.is_valid(raise_exception=True)
-        update_serializer.save()
+        with transaction.atomic():
+            cell = self.get_object()
+            previous_value = cell_to_value(cell.value)
+            update_serializer = CellUpdateSerializer(cell, data=request.data, partial=True)
+            update_serializer.is_valid(raise_exception=True)
+            _save_cell(update_serializer, 'formula' in request.data)
+            
+            # Пересчитываем зависимые формулы (значение ячейки могло измениться и при смене формулы)
+            change = (previous_value, cell_to_value(cell.value))
+            _recalculate_dependent_cells(cell.sheet, cell.row, cell.column, change)
         
-        # Перезагружаем объект из БД
-        cell.refresh_from_db()
+        serializer = CellSerializer(cell)
+        return Response(serializer.data)
+
+    def perform_destroy(self, instance):
+        """Удаление ячейки с пересчетом зависящих от нее формул"""
+        cell_id = instance.pk
+        previous_value = cell_to_value(instance.value)
+        instance.delete()
+        resident.discard_cell(cell_id, instance.sheet_id, instance.row, instance.column)
+        forget_cell_dependencies([(instance.sheet_id, cell_id)])
+        forget_aggregate_states([cell_id])
+        _recalculate_dependent_cells(instance.sheet, instance.row, instance.column, (previous_value, ''))
+
+    @action(detail=False, methods=['get'], url_path='range')
+    def cell_range(self, request):
+        """
+        Ячейки прямоугольника листа в порядке (row, column) постранично.
         
-        # Если есть формула, вычисляем значение
-        if cell.formula:
-            engine = FormulaEngine(cell.sheet)
-            try:
-                cell.value = engine.evaluate(cell.formula)
-                cell.save()
-            except Exception as e:
-                cell.value = f'#ОШИБКА: {str(e)}'
-                cell.save()
+        Параметры: sheet_id, start_row, end_row, start_column, end_column
+        (границы окна, по умолчанию весь лист), limit и ключ продолжения
+        after_row/after_column из поля next предыдущей страницы.
+        """
+        params = request.query_params
+        try:
+            sheet_id = _int_param(params, 'sheet_id')
+            start_row = _int_param(params, 'start_row', 1)
+            end_row = _int_param(params, 'end_row', MAX_ROW)
+            start_column = _int_param(params, 'start_column', 1)
+            end_column = _int_param(params, 'end_column', MAX_COLUMN)
+            limit = _int_param(params, 'limit', CELL_RANGE_PAGE_SIZE)
+            after_row = _int_param(params, 'after_row', 0)
+            after_column = _int_param(params, 'after_column', 0)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or limit > CELL_RANGE_MAX_PAGE_SIZE:
+            return Response(
+                {'error': f'limit должен быть от 1 до {CELL_RANGE_MAX_PAGE_SIZE}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Перезагружаем еще раз после вычисления
-        cell.refresh_from_db()
+        sheet = get_object_or_404(Sheet, id=sheet_id)
+        cells = Cell.objects.filter(
+            sheet=sheet,
+            row__range=(start_row, end_row),
+            column__range=(start_column, end_column),
+        ).filter(
+            models.Q(row__gt=after_row) | models.Q(row=after_row, column__gt=after_column)
+        ).order_by('row', 'column').values(*CellSerializer.Meta.fields)
         
-        # Если ячейка была изменена (не формула, а значение), пересчитываем зависимые формулы
-        # Проверяем, что это изменение значения, а не добавление/изменение формулы
-        was_value_update = 'value' in request.data and not request.data.get('formula')
-        if was_value_update or (not cell.formula and cell.value):
-            _recalculate_dependent_cells(cell.sheet, cell.row, cell.column)
+        page = list(cells[:limit + 1])
+        next_key = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_key = {'row': page[-1]['row'], 'column': page[-1]['column']}
         
-        serializer = CellSerializer(cell)
-        return Response(serializer.data)
+        return Response({'cells': page, 'next': next_key})
+
+    @action(detail=False, methods=['post'])
+    def copy_range(self, request):
+        """
+        Копирование диапазона с заполнением: source - прямоугольник источника
+        (лист source_sheet_id, по умолчанию sheet_id), destination - прямоугольник
+        приемника на листе sheet_id (без end_row/end_column - размера источника).
+        Относительные ссылки формул сдвигаются, как при копировании в Excel.
+        """
+        sheet_id = request.data.get('sheet_id')
+        if not sheet_id:
+            return Response({'error': 'sheet_id обязателен'}, status=status.HTTP_400_BAD_REQUEST)
+        sheet = get_object_or_404(Sheet, id=sheet_id)
+        source_sheet = get_object_or_404(Sheet, id=request.data.get('source_sheet_id') or sheet_id)
+        if source_sheet.spreadsheet_id != sheet.spreadsheet_id:
+            return Response(
+                {'error': 'Источник должен быть в той же таблице'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            source = _range_param(request.data, 'source')
+            size = (source[2] - source[0] + 1, source[3] - source[1] + 1)
+            destination = _range_param(request.data, 'destination', size)
+            result = copy_range(source_sheet, source, sheet, destination)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        start_row, start_column, end_row, end_column = destination
+        broadcast(sheet.spreadsheet_id, {
+            'type': 'range_updated',
+            'user_id': request.user.id,
+            'username': request.user.username,
+            'sheet_id': sheet.id,
+            'start_row': start_row,
+            'start_column': start_column,
+            'end_row': end_row,
+            'end_column': end_column,
+        })
+        return Response(result)
 
     @action(detail=False, methods=['post'])
     def batch_update(self, request):
@@ -297,41 +653,22 @@ class CellViewSet(viewsets.ModelViewSet):
             )
         
         sheet = get_object_or_404(Sheet, id=sheet_id)
-        engine = FormulaEngine(sheet)
-        results = []
-        
-        for update in updates:
-            row = update.get('row')
-            column = update.get('column')
-            
-            if row is None or column is None:
-                continue
-            
-            cell, _ = Cell.objects.get_or_create(
-                sheet=sheet,
-                row=row,
-                column=column,
-                defaults={'value': '', 'formula': '', 'style': {}}
-            )
-            
-            if 'value' in update:
-                cell.value = update['value']
-                cell.formula = ''
-            if 'formula' in update:
-                cell.formula = update['formula']
-                try:
-                    cell.value = engine.evaluate(cell.formula)
-                except Exception as e:
-                    cell.value = f'#ОШИБКА: {str(e)}'
-            if 'style' in update:
-                cell.style = update['style']
-            
-            cell.save()
-            results.append(CellSerializer(cell).data)
-            
-            # Пересчитываем зависимые ячейки, если было изменение значения
-            if 'value' in update and not update.get('formula'):
-                _recalculate_dependent_cells(sheet, row, column)
+        try:
+            # Числа из JSON записываются как текст ячейки
+            updates = [
+                dict(update, sheet_id=sheet.id, **{
+                    field: cell_text(update[field]) for field in ('value', 'formula') if field in update
+                })
+                for update in updates
+                if update.get('row') is not None and update.get('column') is not None
+            ]
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        cells, _ = apply_cell_updates({sheet.id: sheet}, updates)
         
+        results = CellSerializer(
+            [cells[(sheet.id, int(update['row']), int(update['column']))] for update in updates],
+            many=True,
+        ).data
         return Response(results, status=status.HTTP_200_OK)
 
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+from collections import namedtuple
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .models import Sheet
+from .edits import apply_cell_updates
+from .consumers import group_name, encode_event, cell_payload, cell_rejected, range_rejected
+
+
+logger = logging.getLogger(__name__)
+
+# Писатели таблиц процесса: {spreadsheet_id: SpreadsheetWriter}
+_writers = {}
+
+# Правка в очереди писателя: автор, его канал (для отказа), обновления ячеек
+# и блок из range_update (sheet_id, start_row, start_column, values) или None
+QueuedEdit = namedtuple('QueuedEdit', ['user', 'channel_name', 'updates', 'area'])
+
+
+class SpreadsheetWriter:
+    """
+    Единственный писатель ячеек таблицы в процессе.
+
+    Правки из WebSocket-подключений ставятся в очередь и применяются по
+    порядку поступления пачками: правки, накопившиеся за окно
+    SPREADSHEET_WRITE_WINDOW секунд (и пока записывалась предыдущая пачка),
+    записываются одной транзакцией с одним пересчетом и рассылаются всем
+    подключенным, включая авторов, одним сообщением cells_updated (блоки из
+    range_update - отдельным компактным сообщением на блок). Порядок правок каждого клиента сохраняется.
+    Если пачка не записалась, ее правки записываются по одной: неудачная
+    правка не теряет остальные, ее автор получает cell_rejected/range_rejected.
+    Задача писателя живет, пока очередь не пуста.
+    """
+
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def submit(self, edit):
+        self.queue.put_nowait(edit)
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+
+    async def run(self):
+        window = getattr(settings, 'SPREADSHEET_WRITE_WINDOW', 0.02)
+        batch_size = getattr(settings, 'SPREADSHEET_WRITE_BATCH', 1000)
+        try:
+            while not self.queue.empty():
+                await asyncio.sleep(window)
+                # Блок из range_update не делится между пачками
+                batch = [self.queue.get_nowait()]
+                size = len(batch[0].updates)
+                while not self.queue.empty() and size < batch_size:
+                    batch.append(self.queue.get_nowait())
+                    size += len(batch[-1].updates)
+                await self.write(batch)
+        finally:
+            self.task = None
+            if _writers.get(self.spreadsheet_id) is self:
+                del _writers[self.spreadsheet_id]
+
+    async def write(self, batch):
+        try:
+            cells, recalculated = await database_sync_to_async(write_cell_updates)(
+                self.spreadsheet_id, [update for edit in batch for update in edit.updates]
+            )
+            failed = set()
+        except Exception:
+            logger.exception('Пачка правок таблицы %s не записана, правки записываются по одной', self.spreadsheet_id)
+            cells = None
+        if cells is None:
+            cells, recalculated, failed = await self.write_each(batch)
+
+        # Правки одной записи относятся к одному листу: записаны все или
+        # (лист удален, запись не удалась) ни одной
+        written = []
+        rejected = []
+        for index, edit in enumerate(batch):
+            if edit.updates:
+                first = edit.updates[0]
+                if index not in failed and (first['sheet_id'], first['row'], first['column']) in cells:
+                    written.append(edit)
+                else:
+                    rejected.append(edit)
+
+        events = []
+        covered = set()
+        for edit in written:
+            if edit.area is not None:
+                events.append(range_event(edit.user, edit.area, cells))
+                covered.update((update['sheet_id'], update['row'], update['column']) for update in edit.updates)
+
+        # Отдельные правки и пересчитанные ячейки вне блоков - одним сообщением
+        # всем, включая авторов; user_id указан, если такие правки пачки одного автора
+        payload = {}
+        for edit in written:
+            if edit.area is None:
+                for update in edit.updates:
+                    coordinate = (update['sheet_id'], update['row'], update['column'])
+                    payload[coordinate] = cells[coordinate]
+        for cell in recalculated:
+            coordinate = (cell.sheet_id, cell.row, cell.column)
+            if coordinate not in covered:
+                payload.setdefault(coordinate, cell)
+        if payload:
+            users = {edit.user.id: edit.user for edit in written if edit.area is None}
+            user = next(iter(users.values())) if len(users) == 1 else None
+            events.append({
+                'type': 'cells_updated',
+                'user_id': user.id if user else None,
+                'username': user.username if user else None,
+                'cells': [cell_payload(cell) for cell in payload.values()],
+            })
+
+        channel_layer = get_channel_layer()
+        for event in events:
+            await channel_layer.group_send(group_name(self.spreadsheet_id), encode_event(event))
+        for edit in rejected:
+            await channel_layer.send(edit.channel_name, rejection_event(edit))
+
+    async def write_each(self, batch):
+        """
+        Записывает правки пачки по одной (каждую своей транзакцией).
+        Возвращает записанные ячейки и пересчитанные (последнее значение ячейки)
+        так же, как write_cell_updates для всей пачки, и номера незаписанных правок.
+        """
+        cells = {}
+        recalculated = {}
+        failed = set()
+        for index, edit in enumerate(batch):
+            try:
+                edit_cells, edit_recalculated = await database_sync_to_async(write_cell_updates)(
+                    self.spreadsheet_id, edit.updates
+                )
+            except Exception:
+                logger.exception('Правка пользователя %s в таблице %s не записана', edit.user.id, self.spreadsheet_id)
+                failed.add(index)
+                continue
+            cells.update(edit_cells)
+            for cell in edit_recalculated:
+                coordinate = (cell.sheet_id, cell.row, cell.column)
+                recalculated[coordinate] = cell
+                # Ячейка предыдущей правки могла быть пересчитана этой
+                if coordinate in cells:
+                    cells[coordinate].value = cell.value
+        return cells, list(recalculated.values()), failed
+
+
+def rejection_event(edit):
+    """Сообщение автору о незаписанной правке (для обработчика edit_rejected подключения)"""
+    error = 'Правка не записана'
+    if edit.area is not None:
+        message = range_rejected(error, edit.area)
+    else:
+        first = edit.updates[0]
+        message = cell_rejected(first['sheet_id'], first['row'], first['column'], error)
+    return {'type': 'edit_rejected', 'text': json.dumps(message, ensure_ascii=False)}
+
+
+def range_event(user, area, cells):
+    """
+    Компактное сообщение о записанном блоке: значения (после пересчета) и
+    формулы построчно; None - ячейка блока не менялась, formulas опускается,
+    если формул в блоке нет
+    """
+    sheet_id, start_row, start_column, values = area
+    result = []
+    formulas = []
+    for row, line in enumerate(values, start_row):
+        result_line = []
+        formula_line = []
+        for column, item in enumerate(line, start_column):
+            cell = cells.get((sheet_id, row, column)) if item is not None else None
+            result_line.append(cell.value if cell else None)
+            formula_line.append(cell.formula if cell else '')
+        result.append(result_line)
+        formulas.append(formula_line)
+    event = {
+        'type': 'range_values_updated',
+        'user_id': user.id,
+        'username': user.username,
+        'sheet_id': sheet_id,
+        'start_row': start_row,
+        'start_column': start_column,
+        'values': result,
+    }
+    if any(formula for line in formulas for formula in line):
+        event['formulas'] = formulas
+    return event
+
+
+def submit_cell_updates(spreadsheet_id, user, channel_name, updates, area=None):
+    """
+    Ставит правки ячеек в очередь писателя таблицы. channel_name - канал
+    подключения автора (для сообщения об отказе). area = (sheet_id,
+    start_row, start_column, values) - правки записывают блок из range_update
+    и рассылаются одним компактным сообщением.
+    """
+    writer = _writers.get(spreadsheet_id)
+    if writer is None or writer.loop is not asyncio.get_running_loop():
+        writer = _writers[spreadsheet_id] = SpreadsheetWriter(spreadsheet_id)
+    writer.submit(QueuedEdit(user, channel_name, updates, area))
+
+
+def write_cell_updates(spreadsheet_id, updates):
+    """
+    Записывает пачку правок ячеек таблицы (см. apply_cell_updates). Правки
+    листов других таблиц отбрасываются.
+    Возвращает (записанные ячейки {(sheet_id, row, column): Cell}, пересчитанные ячейки).
+    """
+    sheets = Sheet.objects.filter(
+        spreadsheet_id=spreadsheet_id,
+        id__in={update['sheet_id'] for update in updates},
+    ).in_bulk()
+    updates = [update for update in updates if update['sheet_id'] in sheets]
+    if not updates:
+        return {}, []
+    return apply_cell_updates(sheets, updates)
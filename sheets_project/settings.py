@@ -76,6 +76,20 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Положение курсора пользователя рассылается не чаще раза за интервал (секунды)
+SPREADSHEET_CURSOR_INTERVAL = 0.1
+
+# Входящие сообщения одного WebSocket-подключения: в среднем не больше
+# SPREADSHEET_MESSAGE_RATE в секунду, подряд - не больше SPREADSHEET_MESSAGE_BURST;
+# сверх лимита перемещения курсора отбрасываются, правки отклоняются
+SPREADSHEET_MESSAGE_RATE = 50
+SPREADSHEET_MESSAGE_BURST = 200
+
+# Правки ячеек из WebSocket записываются пачками: собираются за окно (секунды),
+# в пачке не больше SPREADSHEET_WRITE_BATCH правок
+SPREADSHEET_WRITE_WINDOW = 0.02
+SPREADSHEET_WRITE_BATCH = 1000
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases